@@ -0,0 +1,200 @@
+"""
+Module for approximate nearest neighbor search over the CLIP embeddings. Implements an inverted
+file index (IVF): the embeddings are clustered with spherical k-means into coarse lists and a
+query only scores the images in the lists whose centroids are closest to it. Supports
+incremental inserts, deletes via tombstones and persistence to disk. Small libraries are
+searched exactly, the index only starts clustering once it has enough images.
+"""
+
+# Standard library imports
+import copy
+from pathlib import Path
+from typing import Collection, List, Optional, Tuple
+
+# External library imports
+import numpy as np
+
+###########################################################################################
+
+
+class IVFIndex:
+    """
+    Inverted file index over the rows of an embedding matrix. The index only stores row ids,
+    the vectors themselves stay in the matrix that is passed to search.
+
+    Knobs:
+        n_lists: Number of coarse lists, None to use 4 * sqrt(number of images).
+        nprobe: Number of lists scanned per query. Higher means better recall but slower search.
+        min_train_size: Below this number of images every query is answered exactly.
+        retrain_factor: Retrain the centroids once the index grew by this factor since training.
+    """
+
+    def __init__(self, n_lists: Optional[int] = None, nprobe: int = 8, min_train_size: int = 4096,
+                 retrain_factor: float = 4.0, kmeans_iterations: int = 10, seed: int = 0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.retrain_factor = retrain_factor
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+
+        self.centroids: Optional[np.ndarray] = None  # None while the index is untrained
+        self.assignments = np.zeros(0, dtype=np.int32)  # List id of every row, -1 if not listed
+        self.tombstones = np.zeros(0, dtype=bool)  # Deleted rows
+        self.trained_size = 0
+        self._lists: Optional[List[np.ndarray]] = None  # Row ids per list, rebuilt lazily
+
+    def __len__(self):
+        return int(len(self.tombstones) - self.tombstones.sum())
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def add(self, matrix: np.ndarray, rows: np.ndarray):
+        """
+        Adds rows of the matrix to the index.
+
+        Parameters:
+            matrix (np.ndarray): The full L2-normalized embedding matrix.
+            rows (np.ndarray): Row ids to add, the index grows to cover all of them.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        size = max(len(self.tombstones), int(rows.max()) + 1)
+        if size > len(self.tombstones):
+            grow = size - len(self.tombstones)
+            self.assignments = np.concatenate([self.assignments, np.full(grow, -1, dtype=np.int32)])
+            self.tombstones = np.concatenate([self.tombstones, np.zeros(grow, dtype=bool)])
+        self.tombstones[rows] = False
+
+        if self.is_trained and len(self) > self.trained_size * self.retrain_factor:
+            self.train(matrix)
+        elif self.is_trained:
+            self.assignments[rows] = np.argmax(matrix[rows] @ self.centroids.T, axis=1)
+            self._lists = None
+        elif len(self) >= self.min_train_size:
+            self.train(matrix)
+
+    def copy(self) -> "IVFIndex":
+        """A copy that rows can be added to or removed from without affecting this index."""
+        index = copy.copy(self)
+        index.assignments = self.assignments.copy()
+        index.tombstones = self.tombstones.copy()
+        return index
+
+    def remove(self, rows):
+        """Marks rows as deleted, they are skipped by every search from now on."""
+        self.tombstones[np.asarray(rows, dtype=np.int64)] = True
+
+    def train(self, matrix: np.ndarray):
+        """Clusters all live rows with spherical k-means and assigns every row to its list."""
+        live = np.flatnonzero(~self.tombstones)
+        n_lists = self.n_lists or int(4 * np.sqrt(len(live)))
+        n_lists = max(1, min(n_lists, len(live)))
+        rng = np.random.default_rng(self.seed)
+
+        # Training on a sample is enough for the coarse centroids
+        sample = live if len(live) <= 256 * n_lists else rng.choice(live, 256 * n_lists, replace=False)
+        vectors = matrix[sample]
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, vectors)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty clusters keep their old centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        self.centroids = centroids.astype(np.float32)
+        self.assignments[:] = -1
+        self.assignments[live] = np.argmax(matrix[live] @ self.centroids.T, axis=1)
+        self.trained_size = len(live)
+        self._lists = None
+        print(f"Trained IVF index with {n_lists} lists on {len(live)} images.")
+
+    def candidates(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """
+        Returns the live row ids in the nprobe lists closest to the query,
+        all live rows if the index is untrained.
+        """
+        if not self.is_trained:
+            return np.flatnonzero(~self.tombstones)
+        if self._lists is None:
+            self.set_lists(*self.list_arrays())
+
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probed = np.argsort(-(self.centroids @ query))[:nprobe]
+        rows = np.concatenate([self._lists[i] for i in probed])
+        return rows[~self.tombstones[rows]]
+
+    def list_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Row ids of all lists concatenated, and the start of every list in them plus the end."""
+        order = np.argsort(self.assignments, kind="stable")
+        bounds = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+        return order, bounds
+
+    def set_lists(self, order: np.ndarray, bounds: np.ndarray):
+        """Sets the lists from the arrays returned by list_arrays, e.g. views of shared memory."""
+        self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, k: int = 1, nprobe: Optional[int] = None,
+               exclude: Collection[int] = (), score_matrix: Optional[np.ndarray] = None,
+               score_query: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Finds the k rows with the highest cosine similarity to the query.
+
+        Parameters:
+            matrix (np.ndarray): The full L2-normalized embedding matrix.
+            query (np.ndarray): L2-normalized query vector.
+            k (int): Number of results.
+            nprobe (int): Lists to scan, defaults to the nprobe of the index. Is widened
+                automatically if the probed lists hold fewer than k rows after filtering.
+            exclude: Row ids that must not be returned (placed or rejected images).
+            score_matrix (np.ndarray): Scores the candidates against these rows instead of the matrix,
+                e.g. a reduced copy of it. Needs score_query as well.
+            score_query (np.ndarray): Query in the space of score_matrix.
+
+        Returns:
+            list: (row id, similarity) pairs, best first.
+        """
+        nprobe = nprobe or self.nprobe
+        exclude = np.fromiter(exclude, dtype=np.int64) if len(exclude) else np.zeros(0, dtype=np.int64)
+        while True:
+            rows = self.candidates(query, nprobe)
+            if len(exclude):
+                rows = rows[~np.isin(rows, exclude)]
+            if len(rows) >= k or not self.is_trained or nprobe >= len(self.centroids):
+                break
+            nprobe *= 2
+
+        if len(rows) == 0:
+            return []
+        if score_matrix is not None:
+            scores = score_matrix[rows] @ score_query
+        else:
+            scores = matrix[rows] @ query
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def save(self, path: Path):
+        """Writes the index to an .npz file."""
+        np.savez(
+            path,
+            centroids=self.centroids if self.is_trained else np.zeros((0, 0), dtype=np.float32),
+            assignments=self.assignments,
+            tombstones=self.tombstones,
+            trained_size=np.array(self.trained_size),
+        )
+
+    def load(self, path: Path):
+        """Reads an index written by save."""
+        with np.load(path) as data:
+            self.centroids = data["centroids"] if data["centroids"].size else None
+            self.assignments = data["assignments"]
+            self.tombstones = data["tombstones"]
+            self.trained_size = int(data["trained_size"])
+        self._lists = None
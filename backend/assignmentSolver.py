@@ -0,0 +1,135 @@
+"""
+Module to solve the linear assignment problem between collage slots and candidate images.
+Every slot gets at most one image and every image is used at most once, so that the summed
+score of all assignments is maximal. Small problems are solved exactly with the Hungarian
+method (shortest augmenting paths with potentials), very large ones greedily.
+"""
+
+# Standard library imports
+from typing import List, Tuple
+
+# External library imports
+import numpy as np
+
+###########################################################################################
+
+# Above this number of matrix cells the exact solver gets too slow for a request
+MAX_EXACT_CELLS = 2_000_000
+
+
+def solve_assignment(scores: np.ndarray, maximize: bool = True) -> List[Tuple[int, int]]:
+    """
+    Assigns rows (slots) to columns (candidates) so that the summed score is optimal.
+
+    Parameters:
+        scores (np.ndarray): Score matrix of shape (rows, cols).
+        maximize (bool): Maximize the summed score if True, minimize it otherwise.
+
+    Returns:
+        list: (row, col) pairs, min(rows, cols) of them.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if scores.size == 0:
+        return []
+
+    cost = -scores if maximize else scores
+    if cost.size > MAX_EXACT_CELLS:
+        return greedy_assignment(cost)
+
+    # The exact solver expects at least as many columns as rows
+    if cost.shape[0] > cost.shape[1]:
+        return [(row, col) for col, row in hungarian(cost.T)]
+    return hungarian(cost)
+
+
+def hungarian(cost: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Minimum cost assignment of every row to a distinct column, requires rows <= cols.
+    Runs in O(rows^2 * cols), the inner loop over the columns is vectorized.
+
+    Parameters:
+        cost (np.ndarray): Cost matrix of shape (rows, cols).
+
+    Returns:
+        list: (row, col) pairs, one for every row.
+    """
+    n, m = cost.shape
+    # Shift costs to be non-negative, this does not change the optimal assignment
+    cost = cost - cost.min()
+
+    # Index 0 is a virtual column/row, real indices are shifted by one
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    assigned_row = np.zeros(m + 1, dtype=np.int64)  # Row assigned to column j, 0 if free
+    way = np.zeros(m + 1, dtype=np.int64)
+
+    for i in range(1, n + 1):
+        assigned_row[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+
+        # Grow the shortest path tree until a free column is reached
+        while True:
+            used[j0] = True
+            i0 = assigned_row[j0]
+            free = ~used[1:]
+
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            improved = free & (reduced < minv[1:])
+            minv[1:][improved] = reduced[improved]
+            way[1:][improved] = j0
+
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+
+            u[assigned_row[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+
+            j0 = j1
+            if assigned_row[j0] == 0:
+                break
+
+        # Flip the assignments along the augmenting path
+        while j0 != 0:
+            j1 = way[j0]
+            assigned_row[j0] = assigned_row[j1]
+            j0 = j1
+
+    return sorted(
+        (int(assigned_row[j]) - 1, j - 1)
+        for j in range(1, m + 1)
+        if assigned_row[j] != 0
+    )
+
+
+def greedy_assignment(cost: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Approximate minimum cost assignment: repeatedly takes the cheapest remaining pair
+    whose row and column are both still free.
+
+    Parameters:
+        cost (np.ndarray): Cost matrix of shape (rows, cols).
+
+    Returns:
+        list: (row, col) pairs, min(rows, cols) of them.
+    """
+    n, m = cost.shape
+    order = np.argsort(cost, axis=None, kind="stable")
+    row_used = np.zeros(n, dtype=bool)
+    col_used = np.zeros(m, dtype=bool)
+    pairs = []
+
+    for flat_idx in order:
+        row, col = divmod(int(flat_idx), m)
+        if row_used[row] or col_used[col]:
+            continue
+        row_used[row] = True
+        col_used[col] = True
+        pairs.append((row, col))
+        if len(pairs) == min(n, m):
+            break
+
+    return sorted(pairs)
@@ -0,0 +1,92 @@
+"""
+Benchmark for the PCA prefiltering of the embedding store. Reports recall@k of "prefilter in the
+reduced space, re-rank the shortlist in the full space" against exact search, together with the
+time per query of both.
+
+Usage (from the backend directory):
+    python benchmarkPcaRecall.py                       # Embeddings of uploaded_images, if there are any
+    python benchmarkPcaRecall.py --synthetic 50000     # Synthetic CLIP-like embeddings
+"""
+
+# Standard library imports
+import argparse
+import time
+from pathlib import Path
+
+# External library imports
+import numpy as np
+
+# Local imports
+from embeddingStore import EmbeddingStore
+from pcaProjection import PCAProjection
+
+###########################################################################################
+
+
+def synthetic_embeddings(count: int, dim: int = 1024, rank: int = 64, seed: int = 0) -> np.ndarray:
+    """Normalized embeddings whose variance is concentrated in a few directions, like CLIP's."""
+    rng = np.random.default_rng(seed)
+    basis = rng.normal(size=(rank, dim))
+    basis /= np.linalg.norm(basis, axis=1, keepdims=True)
+    weights = rng.normal(size=(count, rank)) * np.linspace(3.0, 0.3, rank)
+    vectors = weights @ basis + rng.normal(size=(count, dim)) * 0.3
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic", type=int, default=0, help="Number of synthetic embeddings to use")
+    parser.add_argument("--store", type=Path, default=Path("uploaded_images"), help="Directory of the embedding store")
+    parser.add_argument("--dims", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--shortlist-factors", type=int, nargs="+", default=[2, 4, 8, 16])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        matrix = synthetic_embeddings(args.synthetic)
+    else:
+        store = EmbeddingStore(args.store, reduced_dims=None)
+        store.load()
+        if len(store) == 0:
+            parser.error(f"No embeddings found in {args.store}, use --synthetic instead.")
+        matrix = store.vectors(store.image_names())
+    print(f"{len(matrix)} embeddings of dimension {matrix.shape[1]}, k = {args.k}")
+
+    # Queries look like the selection queries: the mean of a few placed neighbors
+    rng = np.random.default_rng(1)
+    queries = matrix[rng.integers(0, len(matrix), size=(args.queries, 3))].mean(axis=1)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact_top = []
+    start = time.perf_counter()
+    for query in queries:
+        scores = matrix @ query
+        top = np.argpartition(-scores, args.k - 1)[:args.k]
+        exact_top.append(top[np.argsort(-scores[top])])
+    exact_time = (time.perf_counter() - start) / len(queries)
+
+    print(f"exact search: {exact_time * 1000:.3f} ms/query")
+    print(f"{'dims':>6} {'variance':>9} {'shortlist':>10} {'recall@k':>9} {'ms/query':>9}")
+    for dims in args.dims:
+        projection = PCAProjection(dims)
+        projection.fit(matrix[:20000])
+        reduced = projection.transform(matrix).astype(np.float16).astype(np.float32)
+
+        for factor in args.shortlist_factors:
+            shortlist_size = min(args.k * factor, len(matrix))
+            hits = 0
+            start = time.perf_counter()
+            for query, truth in zip(queries, exact_top):
+                coarse = reduced @ projection.transform_query(query)
+                shortlist = np.argpartition(-coarse, shortlist_size - 1)[:shortlist_size]
+                fine = matrix[shortlist] @ query
+                found = shortlist[np.argsort(-fine)[:args.k]]
+                hits += len(np.intersect1d(found, truth))
+            elapsed = (time.perf_counter() - start) / len(queries)
+            recall = hits / (len(queries) * args.k)
+            print(f"{dims:>6} {projection.explained_variance:>9.1%} {shortlist_size:>10} {recall:>9.3f} {elapsed * 1000:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
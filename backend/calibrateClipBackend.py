@@ -0,0 +1,214 @@
+"""
+Calibration and accuracy check of the CLIP inference backends, see clipModel.py.
+
+With --calibrate the image encoder is quantized statically for the int8-static backend: FX graph
+mode quantization inserts observers into the convolutions, the calibration images are run through
+them to record the activation ranges, then the encoder is converted to int8, traced, frozen and
+saved to CLIP_INT8_DIR. Only the ResNet models can be quantized statically.
+
+The check then encodes the images of resources/similarityTest with every backend and reports
+    - the cosine similarity of its image and prompt embeddings to the eager ones (worst case),
+    - whether it ranks the candidate images the same as eager against the mean of the placed
+      neighbors (top, bottom, left, right), which is what the image selection depends on,
+    - images per second at batch size 1 and --batch, and the speedup over eager.
+
+Usage (from the backend directory):
+    python calibrateClipBackend.py --calibrate --calibration-images uploaded_images
+    python calibrateClipBackend.py --backends eager int8-static --threads 4
+    python calibrateClipBackend.py --model ViT-B/32 --backends eager torchscript int8-dynamic
+"""
+
+# Standard library imports
+import argparse
+import copy
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+# External library imports
+import clip
+import numpy as np
+import torch
+from PIL import Image
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+# Local imports
+from clipModel import CLIP_BACKENDS, CLIP_MODEL, ClipEncoder, load_encoder
+
+###########################################################################################
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+# The placed images of the similarity test, all other images are candidates for the slot between them
+NEIGHBORS = ["top", "bottom", "left", "right"]
+
+PROMPTS = ["a dog", "a cat", "a dog on the grass", "a person at the beach", "a red car"]
+
+
+class ImageEncoder(torch.nn.Module):
+    """
+    The forward of CLIP's ModifiedResNet without its cast to the weight dtype, FX cannot trace
+    that cast once the first convolution is fused with its batch norm.
+    """
+
+    def __init__(self, visual):
+        super().__init__()
+        self.visual = visual
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        visual = self.visual
+        x = visual.relu1(visual.bn1(visual.conv1(x)))
+        x = visual.relu2(visual.bn2(visual.conv2(x)))
+        x = visual.relu3(visual.bn3(visual.conv3(x)))
+        x = visual.avgpool(x)
+        x = visual.layer1(x)
+        x = visual.layer2(x)
+        x = visual.layer3(x)
+        x = visual.layer4(x)
+        return visual.attnpool(x)
+
+
+def load_images(directory: Path, preprocess: Callable, limit: int = 0) -> Dict[str, torch.Tensor]:
+    """Preprocessed images of a directory by file stem, sorted by name, at most limit if given."""
+    paths = sorted(path for path in directory.iterdir() if path.suffix.lower() in IMAGE_SUFFIXES)
+    if limit:
+        paths = paths[:limit]
+    return {path.stem: preprocess(Image.open(path).convert("RGB")) for path in paths}
+
+
+def quantize_image_encoder(encoder: ClipEncoder, calibration: torch.Tensor, batch: int) -> torch.jit.ScriptModule:
+    """
+    Statically quantizes the image encoder.
+
+    Parameters:
+        encoder (ClipEncoder): Eager encoder of a ResNet model.
+        calibration (torch.Tensor): Preprocessed images the activation ranges are recorded on,
+            they should look like the images the server encodes.
+        batch (int): Batch size of the calibration passes.
+
+    Returns:
+        The quantized encoder, traced and frozen.
+    """
+    if not hasattr(encoder.model.visual, "layer4"):
+        raise ValueError(f"{encoder.model_name} is not a ResNet model, it cannot be quantized statically.")
+    image_encoder = ImageEncoder(copy.deepcopy(encoder.model.visual).float()).eval()
+    images, _ = encoder.example_inputs()
+    # The attention pool stays in float: it consists of linear layers around a multi-head attention
+    # call FX cannot trace into, and it is a small part of the cost next to the convolutions
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    qconfig_mapping.set_module_name("visual.attnpool", None)
+    custom_config = PrepareCustomConfig().set_non_traceable_module_names(["visual.attnpool"])
+    prepared = prepare_fx(image_encoder, qconfig_mapping, example_inputs=(images,), prepare_custom_config=custom_config)
+    with torch.no_grad():
+        for start in range(0, len(calibration), batch):
+            prepared(calibration[start:start + batch])
+        quantized = convert_fx(prepared)
+        return torch.jit.freeze(torch.jit.trace(quantized, images).eval())
+
+
+def normalized(features: torch.Tensor) -> np.ndarray:
+    features = features.float().numpy()
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+
+def encode(encoder: Callable, inputs: torch.Tensor, batch: int) -> np.ndarray:
+    """Normalized features of all inputs."""
+    with torch.no_grad():
+        return normalized(torch.cat([encoder(inputs[start:start + batch]) for start in range(0, len(inputs), batch)]))
+
+
+def images_per_second(encoder: Callable, images: torch.Tensor, batch: int, repeats: int) -> float:
+    inputs = images.repeat((batch + len(images) - 1) // len(images), 1, 1, 1)[:batch]
+    with torch.no_grad():
+        # The first calls of a traced module optimize its graph, they are not timed
+        encoder(inputs)
+        encoder(inputs)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            encoder(inputs)
+    return repeats * batch / (time.perf_counter() - start)
+
+
+def candidate_ranking(names: List[str], features: np.ndarray) -> List[str]:
+    """Candidates ordered by their similarity to the mean of the neighbors, best first."""
+    by_name = dict(zip(names, features))
+    query = np.mean([by_name[name] for name in NEIGHBORS if name in by_name], axis=0)
+    candidates = [name for name in names if name not in NEIGHBORS]
+    return sorted(candidates, key=lambda name: -float(by_name[name] @ query))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=CLIP_MODEL, help="CLIP model, e.g. RN50 or ViT-B/32")
+    parser.add_argument("--calibrate", action="store_true", help="Quantize the image encoder for int8-static")
+    parser.add_argument("--calibration-images", type=Path, default=Path("uploaded_images"))
+    parser.add_argument("--calibration-limit", type=int, default=256, help="Largest number of calibration images")
+    parser.add_argument("--images", type=Path, default=Path("resources/similarityTest"))
+    parser.add_argument("--backends", nargs="+", default=list(CLIP_BACKENDS), choices=CLIP_BACKENDS)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="Torch threads, all cores if 0")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    encoder = load_encoder(args.model, "eager")
+    test_images = load_images(args.images, encoder.preprocess)
+    if not test_images:
+        parser.error(f"No images found in {args.images}.")
+    names = list(test_images)
+    images = torch.stack(list(test_images.values()))
+    tokens = clip.tokenize(PROMPTS)
+
+    if args.calibrate:
+        calibration = {}
+        if args.calibration_images.is_dir():
+            calibration = load_images(args.calibration_images, encoder.preprocess, args.calibration_limit)
+        if not calibration:
+            print(f"No images in {args.calibration_images}, calibrating on {args.images}.")
+            calibration = test_images
+        start = time.perf_counter()
+        quantized = quantize_image_encoder(encoder, torch.stack(list(calibration.values())), args.batch)
+        torch.jit.save(quantized, str(encoder.int8_visual_path))
+        print(f"Calibrated on {len(calibration)} images in {time.perf_counter() - start:.1f}s, "
+              f"saved to {encoder.int8_visual_path}.")
+
+    eager_images, eager_texts = encoder.load_backend("eager")
+    reference_images = encode(eager_images, images, args.batch)
+    reference_texts = encode(eager_texts, tokens, args.batch)
+    reference_ranking = candidate_ranking(names, reference_images)
+    print(f"Eager ranking of the candidates: {', '.join(reference_ranking)}")
+
+    eager_speed = {}
+    print(f"{'backend':>14} {'image cos':>10} {'text cos':>9} {'ranking':>8} "
+          f"{'img/s @1':>9} {f'img/s @{args.batch}':>10} {'speedup':>8}")
+    for backend in args.backends:
+        try:
+            image_encoder, text_encoder = encoder.load_backend(backend)
+        except (RuntimeError, FileNotFoundError) as e:
+            print(f"{backend:>14} skipped: {e}")
+            continue
+        image_features = encode(image_encoder, images, args.batch)
+        text_features = encode(text_encoder, tokens, args.batch)
+        image_cosine = float(np.min(np.sum(image_features * reference_images, axis=1)))
+        text_cosine = float(np.min(np.sum(text_features * reference_texts, axis=1)))
+        ranking = candidate_ranking(names, image_features)
+        if ranking == reference_ranking:
+            agreement = "same"
+        elif ranking[0] == reference_ranking[0]:
+            agreement = "top-1"
+        else:
+            agreement = "differs"
+
+        speed = {batch: images_per_second(image_encoder, images, batch, args.repeats) for batch in (1, args.batch)}
+        if backend == "eager":
+            eager_speed = speed
+        speedup = f"{speed[args.batch] / eager_speed[args.batch]:.2f}x" if eager_speed else "-"
+        print(f"{backend:>14} {image_cosine:>10.4f} {text_cosine:>9.4f} {agreement:>8} "
+              f"{speed[1]:>9.1f} {speed[args.batch]:>10.1f} {speedup:>8}")
+
+
+if __name__ == "__main__":
+    main()
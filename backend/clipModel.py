@@ -0,0 +1,184 @@
+"""
+Module holding the CLIP models used by the whole backend. Every model is loaded once per process
+and shared by main.py and promptProcessing.py. serve.py imports it before forking the workers, so
+all workers share the weights copy-on-write.
+
+CLIP_MODEL and CLIP_BACKEND name the model and inference backend new embeddings are produced with.
+Requests are encoded by the active encoder, which main.py switches to CLIP_MODEL once the library
+has been re-encoded with it, see embeddingNamespace.py.
+
+The encoders run on one of several inference backends:
+    eager: The model as loaded by clip.load, the only backend that runs on the GPU.
+    torchscript: Image and text encoder traced and frozen, which folds the batch norms into the
+        convolutions and fuses elementwise ops.
+    int8-dynamic: Linear layers quantized to int8 at load time (text transformer, attention pool).
+    int8-static: Image encoder with int8 convolutions, written by calibrateClipBackend.py to
+        CLIP_INT8_DIR, text encoder as in int8-dynamic. ResNet models only.
+The quantized backends produce slightly different embeddings, so every embedding records the id of
+the encoder it was produced by, see EmbeddingStore.
+"""
+
+# Standard library imports
+import os
+import re
+from pathlib import Path
+from typing import Callable, Dict, Tuple
+
+# External library imports
+import clip
+import torch
+
+###########################################################################################
+
+CLIP_MODEL = os.environ.get("CLIP_MODEL", "RN50")
+
+CLIP_BACKENDS = ("eager", "torchscript", "int8-dynamic", "int8-static")
+CLIP_BACKEND = os.environ.get("CLIP_BACKEND", "eager")
+
+# Directory of the quantized image encoders of the int8-static backend, see calibrateClipBackend.py
+CLIP_INT8_DIR = Path(os.environ.get("CLIP_INT8_DIR", "."))
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def file_safe(name: str) -> str:
+    """Model names like "ViT-B/32" as part of a file name."""
+    return re.sub(r"[^A-Za-z0-9.-]+", "-", name)
+
+
+class TextEncoder(torch.nn.Module):
+    """model.encode_text as forward, so it can be traced."""
+
+    def __init__(self, clip_model):
+        super().__init__()
+        self.clip_model = clip_model
+
+    def forward(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self.clip_model.encode_text(tokens)
+
+
+class ClipEncoder:
+    """
+    One CLIP model on one inference backend.
+
+    Attributes:
+        model_name: Name of the model as passed to clip.load.
+        backend: The inference backend in use, eager if the requested one cannot be built here.
+        model: The eager model.
+        preprocess: Turns a PIL image into the input of the image encoder.
+    """
+
+    def __init__(self, model_name: str, backend: str):
+        self.model_name = model_name
+        self.model, self.preprocess = clip.load(model_name, device=device)
+        # Inference only, nothing may write to the weights or they stop being shared between workers
+        self.model.eval()
+        for parameter in self.model.parameters():
+            parameter.requires_grad_(False)
+        self.backend, self._encode_image, self._encode_text = self.select_backend(backend)
+
+    @property
+    def id(self) -> str:
+        """Recorded with every embedding, embeddings of different encoders are not exactly comparable."""
+        return f"{self.model_name}/{self.backend}"
+
+    @property
+    def int8_visual_path(self) -> Path:
+        """Quantized image encoder of the int8-static backend."""
+        return CLIP_INT8_DIR / f"clip_int8_visual_{file_safe(self.model_name)}.pt"
+
+    def example_inputs(self, batch: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Preprocessed images and tokenized texts of the shape the encoders expect, for tracing."""
+        resolution = self.model.visual.input_resolution
+        return torch.zeros(batch, 3, resolution, resolution), clip.tokenize(["a photo"] * batch)
+
+    def load_backend(self, backend: str) -> Tuple[Callable[[torch.Tensor], torch.Tensor],
+                                                  Callable[[torch.Tensor], torch.Tensor]]:
+        """
+        Builds the encoders of an inference backend from the loaded model.
+
+        Parameters:
+            backend (str): One of CLIP_BACKENDS, all but "eager" run on the CPU only.
+
+        Returns:
+            tuple: The image encoder and the text encoder, each maps a batch to a batch of features.
+        """
+        if backend not in CLIP_BACKENDS:
+            raise ValueError(f"Unknown CLIP backend '{backend}', expected one of {CLIP_BACKENDS}.")
+        model = self.model
+        if backend == "eager":
+            return model.encode_image, model.encode_text
+        if device != "cpu":
+            raise RuntimeError(f"The {backend} backend runs on the CPU only.")
+
+        if backend == "torchscript":
+            images, tokens = self.example_inputs()
+            with torch.no_grad():
+                visual = torch.jit.freeze(torch.jit.trace(model.visual, images).eval())
+                text = torch.jit.freeze(torch.jit.trace(TextEncoder(model), tokens).eval())
+            return visual, text
+
+        # Dynamic quantization covers the linear layers, the convolutions of the ResNet need the
+        # calibrated static quantization instead
+        quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        if backend == "int8-dynamic":
+            return quantized.encode_image, quantized.encode_text
+        if not self.int8_visual_path.exists():
+            raise FileNotFoundError(f"{self.int8_visual_path} not found, create it with calibrateClipBackend.py.")
+        return torch.jit.load(str(self.int8_visual_path), map_location="cpu"), quantized.encode_text
+
+    def select_backend(self, backend: str) -> Tuple[str, Callable, Callable]:
+        """Like load_backend, but falls back to eager if the backend cannot be built here."""
+        try:
+            return (backend,) + self.load_backend(backend)
+        except (RuntimeError, FileNotFoundError) as e:
+            print(f"CLIP backend '{backend}' unavailable for {self.model_name}, using eager: {e}")
+            return ("eager",) + self.load_backend("eager")
+
+    def encode_images(self, images: torch.Tensor) -> torch.Tensor:
+        """Features of a batch of preprocessed images, shape (batch, 3, height, width)."""
+        return self._encode_image(images.to(device))
+
+    def encode_texts(self, tokens: torch.Tensor) -> torch.Tensor:
+        """Features of a batch of tokenized texts, see clip.tokenize."""
+        return self._encode_text(tokens.to(device))
+
+
+# Every encoder loaded so far by model name and requested backend
+encoders: Dict[Tuple[str, str], ClipEncoder] = {}
+
+
+def load_encoder(model_name: str, backend: str) -> ClipEncoder:
+    """Returns the encoder of the model on the backend, loading it on first use."""
+    if (model_name, backend) not in encoders:
+        encoders[(model_name, backend)] = ClipEncoder(model_name, backend)
+    return encoders[(model_name, backend)]
+
+
+# The encoder requests are encoded with
+active = load_encoder(CLIP_MODEL, CLIP_BACKEND)
+
+
+def use_encoder(encoder: ClipEncoder):
+    """Makes encoder the one preprocess, encode_images and encode_texts use."""
+    global active
+    active = encoder
+
+
+def active_encoder() -> ClipEncoder:
+    return active
+
+
+def preprocess(image) -> torch.Tensor:
+    """Input of the active image encoder for a PIL image."""
+    return active.preprocess(image)
+
+
+def encode_images(images: torch.Tensor) -> torch.Tensor:
+    """Features of a batch of preprocessed images by the active encoder."""
+    return active.encode_images(images)
+
+
+def encode_texts(tokens: torch.Tensor) -> torch.Tensor:
+    """Features of a batch of tokenized texts by the active encoder."""
+    return active.encode_texts(tokens)
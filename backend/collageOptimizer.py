@@ -0,0 +1,151 @@
+"""
+Module to optimize the arrangement of a whole collage with simulated annealing. Starting from
+the current grid, it proposes swaps of two placed images and replacements of a placed image
+with an unused one. Every proposal is scored incrementally: only the edges touching the changed
+slots are looked up in a precomputed image-to-image similarity matrix. The best arrangement
+found within the wall-clock budget is returned.
+"""
+
+# Standard library imports
+import math
+import random
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# External library imports
+import numpy as np
+
+###########################################################################################
+
+# Unplaced images considered for replacements, the most similar to the collage first
+DEFAULT_POOL_SIZE = 256
+
+
+def optimize_arrangement(slot_images: Sequence[Optional[str]], adjacency: Sequence[Sequence[int]],
+                         movable: Sequence[bool], candidates: Sequence[str], embeddings: np.ndarray,
+                         rows: Dict[str, int], budget_s: float = 1.0, pool_size: int = DEFAULT_POOL_SIZE,
+                         seed: Optional[int] = None) -> Tuple[List[Optional[str]], float, float]:
+    """
+    Rearranges the images of the movable slots so that the summed similarity over all edges
+    between filled slots is as high as possible.
+
+    Parameters:
+        slot_images: Image placed in every slot, None for an empty slot.
+        adjacency: Neighbor slot indices of every slot. Works for any shape, not just rectangles.
+        movable: Whether the optimizer may change the image of a slot (False for user placements).
+        candidates: Unplaced images that may replace placed ones.
+        embeddings: L2-normalized embedding matrix of the library.
+        rows: Maps an image name to its row in the embedding matrix.
+        budget_s: Wall-clock budget in seconds.
+        pool_size: Maximum number of candidates considered for replacements.
+        seed: Seed for the random number generator.
+
+    Returns:
+        tuple: (best slot images, score of the initial arrangement, score of the best arrangement)
+    """
+    deadline = time.perf_counter() + budget_s
+    rng = random.Random(seed)
+
+    # Images in play: everything placed plus a pool of the best matching unplaced candidates
+    placed = [name for name in slot_images if name is not None]
+    placed_set = set(placed)
+    candidates = [name for name in candidates if name in rows and name not in placed_set]
+    if len(candidates) > pool_size and placed:
+        collage_mean = embeddings[[rows[name] for name in placed]].mean(axis=0)
+        candidate_scores = embeddings[[rows[name] for name in candidates]] @ collage_mean
+        keep = np.argsort(-candidate_scores)[:pool_size]
+        candidates = [candidates[i] for i in keep]
+    pool = placed + candidates
+
+    # Cached neighbor-similarity lookup between all images in play
+    pool_vectors = embeddings[[rows[name] for name in pool]]
+    similarity = (pool_vectors @ pool_vectors.T).tolist()
+
+    current = [-1] * len(slot_images)
+    next_image = 0
+    for slot, name in enumerate(slot_images):
+        if name is not None:
+            current[slot] = next_image
+            next_image += 1
+    unused = list(range(len(placed), len(pool)))
+
+    movable_slots = [slot for slot in range(len(current)) if movable[slot] and current[slot] != -1]
+    initial_score = _arrangement_score(current, adjacency, similarity)
+    if not movable_slots:
+        return list(slot_images), initial_score, initial_score
+
+    def slot_gain(slot: int, image: int, ignore: int = -1) -> float:
+        # Similarity of an image placed at a slot with its filled neighbors
+        total = 0.0
+        for neighbor in adjacency[slot]:
+            if neighbor != ignore and current[neighbor] != -1:
+                total += similarity[image][current[neighbor]]
+        return total
+
+    def propose() -> Tuple[float, tuple]:
+        slot = rng.choice(movable_slots)
+        if unused and (len(movable_slots) < 2 or rng.random() < 0.5):
+            unused_idx = rng.randrange(len(unused))
+            image = unused[unused_idx]
+            delta = slot_gain(slot, image) - slot_gain(slot, current[slot])
+            return delta, ("replace", slot, unused_idx)
+        other = rng.choice(movable_slots)
+        if other == slot:
+            return 0.0, ("noop",)
+        a, b = current[slot], current[other]
+        delta = (slot_gain(slot, b, ignore=other) + slot_gain(other, a, ignore=slot)
+                 - slot_gain(slot, a, ignore=other) - slot_gain(other, b, ignore=slot))
+        return delta, ("swap", slot, other)
+
+    def apply(move: tuple):
+        if move[0] == "replace":
+            _, slot, unused_idx = move
+            unused[unused_idx], current[slot] = current[slot], unused[unused_idx]
+        elif move[0] == "swap":
+            _, slot, other = move
+            current[slot], current[other] = current[other], current[slot]
+
+    # Start temperature from the typical size of a worsening move
+    samples = [abs(propose()[0]) for _ in range(32)]
+    start_temperature = max(sum(samples) / len(samples), 1e-3)
+    end_temperature = start_temperature * 1e-3
+
+    score = initial_score
+    best_score = score
+    best = list(current)
+    start = time.perf_counter()
+    iteration = 0
+    temperature = start_temperature
+
+    while True:
+        # Checking the clock is comparatively expensive, only do it every few iterations
+        if iteration % 256 == 0:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            progress = (now - start) / max(deadline - start, 1e-9)
+            temperature = start_temperature * (end_temperature / start_temperature) ** progress
+        iteration += 1
+
+        delta, move = propose()
+        if delta >= 0 or rng.random() < math.exp(delta / temperature):
+            apply(move)
+            score += delta
+            if score > best_score + 1e-9:
+                best_score = score
+                best = list(current)
+
+    print(f"Annealing ran {iteration} iterations, score {initial_score:.3f} -> {best_score:.3f}")
+    return [pool[image] if image != -1 else None for image in best], initial_score, best_score
+
+
+def _arrangement_score(current: List[int], adjacency: Sequence[Sequence[int]], similarity: List[List[float]]) -> float:
+    """Summed similarity over all edges between filled slots, every edge counted once."""
+    total = 0.0
+    for slot, neighbors in enumerate(adjacency):
+        if current[slot] == -1:
+            continue
+        for neighbor in neighbors:
+            if neighbor > slot and current[neighbor] != -1:
+                total += similarity[current[slot]][current[neighbor]]
+    return total
@@ -0,0 +1,251 @@
+"""
+Module for the state of the collages that are being edited. Every browser session gets its own
+collage per component, so two users on the same shape no longer overwrite each other. The collages
+live in a store split into shards, every shard guards its dictionary with its own lock, and every
+collage carries an asyncio lock that serializes the handlers changing it. Requests on different
+collages never wait for each other. Memory stays bounded: the exclusion history of a slot is capped,
+and collages nobody used for a while are evicted.
+"""
+
+# Standard library imports
+import asyncio
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from typing import Any, Dict, FrozenSet, Hashable, List, Optional, Set, Tuple
+
+###########################################################################################
+
+# Session used by clients that do not send a session id
+DEFAULT_SESSION = "default"
+
+# Number of shards of the collage store
+COLLAGE_SHARDS = 16
+
+# Rejected images remembered per slot, the oldest rejection is forgotten first
+MAX_EXCLUSIONS_PER_SLOT = 32
+
+# Collages not used for this long are evicted
+COLLAGE_TTL_S = 3600
+
+# Above this number of collages the least recently used ones are evicted
+MAX_COLLAGES = 1000
+
+
+def collage_key(session_id: str, component_name: str) -> str:
+    """Id of the collage of a component within a session."""
+    return f"{session_id or DEFAULT_SESSION}:{component_name}"
+
+
+class ExclusionHistory:
+    """
+    Images rejected by re-rolls, per slot. Keeps the max_per_slot most recent rejections of every slot,
+    a rejected image is not offered for that slot again as long as it is remembered.
+    """
+
+    def __init__(self, max_per_slot: int = MAX_EXCLUSIONS_PER_SLOT):
+        self.max_per_slot = max_per_slot
+        self._slots: Dict[Hashable, "OrderedDict[str, None]"] = {}
+
+    def add(self, slot: Hashable, image_name: str):
+        history = self._slots.setdefault(slot, OrderedDict())
+        history[image_name] = None
+        history.move_to_end(image_name)
+        while len(history) > self.max_per_slot:
+            history.popitem(last=False)
+
+    def get(self, slot: Hashable) -> FrozenSet[str]:
+        """Images excluded for the slot."""
+        history = self._slots.get(slot)
+        return frozenset(history) if history else frozenset()
+
+    def clear(self):
+        self._slots.clear()
+
+    def items(self) -> List[Tuple[Hashable, List[str]]]:
+        """(slot, excluded images) pairs, the images oldest rejection first."""
+        return [(slot, list(history)) for slot, history in self._slots.items() if history]
+
+    def __len__(self):
+        return sum(len(history) for history in self._slots.values())
+
+    def nbytes(self) -> int:
+        """Approximate memory used by the history."""
+        size = sys.getsizeof(self._slots)
+        for slot, history in self._slots.items():
+            size += sys.getsizeof(slot) + sys.getsizeof(history)
+            size += sum(sys.getsizeof(image_name) for image_name in history)
+        return size
+
+
+class CollageState:
+    """
+    Everything the backend knows about one collage.
+
+    Attributes:
+        session_id: Session the collage belongs to.
+        component_name: Shape of the collage, e.g. "heartComponent".
+        data: The grid, see group_elements_fixed_10x10.
+        version: Counter for optimistic concurrency, increased on every change.
+        cell_index: Maps cell id -> (row_idx, col_idx).
+        slot_coordinates: Maps cell id -> (left, top) pixel position in the template.
+        ai_placed: Ids of the cells whose image was chosen by the AI.
+        slot_graph: (template, SlotGraph) the slot graph was built for.
+        frontier: SlotFrontier of the grid.
+        excluded_images: Images rejected per (row_idx, col_idx) by re-rolls.
+        candidate_queues: Ranked candidates per (row_idx, col_idx), see find_most_similar_image.
+        subscribers: Open WebSocket connections that get pushed the changed cells.
+        speculation_task: Background task precomputing candidates.
+        remote_sync_task: Background task pushing the changes of other workers to the subscribers.
+        lock: Held by every handler while it changes the collage.
+        last_used: time.monotonic() of the last access.
+    """
+
+    def __init__(self, session_id: str, component_name: str, max_exclusions_per_slot: int = MAX_EXCLUSIONS_PER_SLOT):
+        self.session_id = session_id
+        self.component_name = component_name
+        self.data: List[List[Any]] = []
+        self.version = 0
+        self.cell_index: Dict[int, Tuple[int, int]] = {}
+        self.slot_coordinates: Dict[int, Tuple[float, float]] = {}
+        self.ai_placed: Set[int] = set()
+        self.slot_graph = None
+        self.frontier = None
+        self.excluded_images = ExclusionHistory(max_exclusions_per_slot)
+        self.candidate_queues: Dict[Tuple[int, int], Tuple[Tuple[frozenset, int], deque]] = {}
+        self.subscribers: Set[Any] = set()
+        self.speculation_task: Optional[asyncio.Task] = None
+        self.remote_sync_task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+    @property
+    def collage_id(self) -> str:
+        return collage_key(self.session_id, self.component_name)
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The collage as JSON-serializable dictionary, for the state backend."""
+        return {
+            "version": self.version,
+            "data": self.data,
+            "slot_coordinates": [[cell_id, left, top] for cell_id, (left, top) in self.slot_coordinates.items()],
+            "ai_placed": sorted(self.ai_placed),
+            "exclusions": [[row_idx, col_idx, names] for (row_idx, col_idx), names in self.excluded_images.items()],
+        }
+
+    def restore(self, state: Dict[str, Any]):
+        """
+        Replaces the collage by a snapshot another worker stored. Everything derived from the grid is
+        dropped, the caller has to rebuild cell_index and frontier.
+        """
+        self.version = state["version"]
+        # JSON turns the cell tuples into lists
+        self.data = [[tuple(item) if isinstance(item, list) else item for item in row] for row in state["data"]]
+        self.slot_coordinates = {cell_id: (left, top) for cell_id, left, top in state["slot_coordinates"]}
+        self.ai_placed = set(state["ai_placed"])
+        self.excluded_images.clear()
+        for row_idx, col_idx, names in state["exclusions"]:
+            for name in names:
+                self.excluded_images.add((row_idx, col_idx), name)
+        self.cell_index = {}
+        self.frontier = None
+        self.candidate_queues.clear()
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Approximate size of the parts of the collage that grow with use."""
+        queued = sum(len(queue) for _, queue in self.candidate_queues.values())
+        return {
+            "exclusions": len(self.excluded_images),
+            "exclusion_bytes": self.excluded_images.nbytes(),
+            "queued_candidates": queued,
+        }
+
+
+class CollageStore:
+    """
+    Collages by id, split into shards with one lock each. The shard locks only guard adding and
+    removing collages, changes to a collage are serialized by its own asyncio lock.
+    """
+
+    def __init__(self, shards: int = COLLAGE_SHARDS, ttl_s: float = COLLAGE_TTL_S, max_collages: int = MAX_COLLAGES,
+                 max_exclusions_per_slot: int = MAX_EXCLUSIONS_PER_SLOT):
+        self._shards: List[Dict[str, CollageState]] = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self.ttl_s = ttl_s
+        self.max_collages = max_collages
+        self.max_exclusions_per_slot = max_exclusions_per_slot
+
+    def _shard(self, collage_id: str) -> int:
+        return zlib.crc32(collage_id.encode()) % len(self._shards)
+
+    def get(self, session_id: str, component_name: str) -> Optional[CollageState]:
+        """Returns the collage, None if the session has not sent it yet."""
+        collage_id = collage_key(session_id, component_name)
+        collage = self._shards[self._shard(collage_id)].get(collage_id)
+        if collage is not None:
+            collage.touch()
+        return collage
+
+    def get_or_create(self, session_id: str, component_name: str) -> CollageState:
+        """Returns the collage, creating an empty one for a new session or component."""
+        collage_id = collage_key(session_id, component_name)
+        shard = self._shard(collage_id)
+        with self._locks[shard]:
+            collage = self._shards[shard].get(collage_id)
+            if collage is None:
+                collage = CollageState(session_id or DEFAULT_SESSION, component_name, self.max_exclusions_per_slot)
+                self._shards[shard][collage_id] = collage
+        collage.touch()
+        return collage
+
+    def remove(self, collage_id: str) -> Optional[CollageState]:
+        shard = self._shard(collage_id)
+        with self._locks[shard]:
+            return self._shards[shard].pop(collage_id, None)
+
+    def collages(self) -> List[CollageState]:
+        """Snapshot of all collages."""
+        collages = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                collages.extend(shard.values())
+        return collages
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def evict_idle(self) -> List[CollageState]:
+        """
+        Removes the collages not used for ttl_s seconds, then the least recently used ones while there are
+        more than max_collages. Collages with an open WebSocket are in use and never evicted.
+
+        Returns:
+            The evicted collages, so the caller can stop their background tasks.
+        """
+        now = time.monotonic()
+        idle = [collage for collage in self.collages() if not collage.subscribers]
+        idle.sort(key=lambda collage: collage.last_used)
+        excess = len(self) - self.max_collages
+
+        evicted = []
+        for collage in idle:
+            if now - collage.last_used <= self.ttl_s and excess <= 0:
+                break
+            if self.remove(collage.collage_id) is not None:
+                evicted.append(collage)
+                excess -= 1
+        return evicted
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Summed memory_usage of all collages, plus their number."""
+        usage = {"collages": 0, "exclusions": 0, "exclusion_bytes": 0, "queued_candidates": 0}
+        for collage in self.collages():
+            usage["collages"] += 1
+            for key, value in collage.memory_usage().items():
+                usage[key] += value
+        return usage
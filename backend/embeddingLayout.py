@@ -0,0 +1,109 @@
+"""
+Module to lay out a library of images over a collage shape, so that similar images end up
+next to each other and the whole shape shows a smooth similarity gradient. The CLIP embeddings
+are projected to 2D with PCA and the projected points are mapped onto the slot coordinates of
+the template by linear assignment. Large layouts are split by recursive bisection into blocks
+that are small enough to be assigned exactly.
+"""
+
+# Standard library imports
+from typing import List, Sequence, Tuple
+
+# External library imports
+import numpy as np
+
+# Local imports
+from assignmentSolver import solve_assignment
+
+###########################################################################################
+
+# Blocks with at most this many slots are assigned exactly
+LEAF_SIZE = 256
+
+
+def project_to_2d(vectors: np.ndarray) -> np.ndarray:
+    """
+    Projects embeddings onto their two principal components.
+
+    Parameters:
+        vectors (np.ndarray): Embeddings of shape (number of images, dimension).
+
+    Returns:
+        np.ndarray: Projected points of shape (number of images, 2), first column has the most variance.
+    """
+    centered = vectors - vectors.mean(axis=0)
+    if len(vectors) < 2:
+        return np.zeros((len(vectors), 2))
+
+    # Eigenvectors of the (dimension x dimension) covariance are cheaper than an SVD for many images
+    if centered.shape[0] > centered.shape[1]:
+        _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        components = eigenvectors[:, ::-1][:, :2]
+    else:
+        _, _, vt = np.linalg.svd(centered, full_matrices=False)
+        components = vt[:2].T
+    points = centered @ components
+    if points.shape[1] < 2:
+        points = np.hstack([points, np.zeros((len(points), 2 - points.shape[1]))])
+    return points
+
+
+def layout_on_slots(points: np.ndarray, slot_coordinates: Sequence[Tuple[float, float]]) -> List[Tuple[int, int]]:
+    """
+    Maps projected points onto slots so that neighborhoods in the projection are kept.
+
+    Parameters:
+        points (np.ndarray): Projected points of shape (number of images, 2).
+        slot_coordinates: (x, y) position of every slot.
+
+    Returns:
+        list: (slot index, point index) pairs, min(number of slots, number of points) of them.
+    """
+    slots = np.asarray(slot_coordinates, dtype=np.float64).reshape(-1, 2)
+    points = np.asarray(points, dtype=np.float64)
+    if len(slots) == 0 or len(points) == 0:
+        return []
+
+    # The direction with the most variance goes along the longer side of the shape
+    if np.ptp(slots[:, 1]) > np.ptp(slots[:, 0]):
+        points = points[:, ::-1]
+
+    pairs = []
+    _bisect(slots, points, np.arange(len(slots)), np.arange(len(points)), pairs)
+    return sorted(pairs)
+
+
+def _bisect(slots: np.ndarray, points: np.ndarray, slot_ids: np.ndarray, point_ids: np.ndarray,
+            pairs: List[Tuple[int, int]]):
+    """Splits slots and points along the same axis until the blocks can be assigned exactly."""
+    if len(slot_ids) == 0 or len(point_ids) == 0:
+        return
+    if len(slot_ids) <= LEAF_SIZE:
+        _assign_block(slots[slot_ids], points[point_ids], slot_ids, point_ids, pairs)
+        return
+
+    block_slots = slots[slot_ids]
+    axis = 0 if np.ptp(block_slots[:, 0]) >= np.ptp(block_slots[:, 1]) else 1
+    slot_order = slot_ids[np.argsort(block_slots[:, axis], kind="stable")]
+    point_order = point_ids[np.argsort(points[point_ids, axis], kind="stable")]
+
+    # Both halves get the same share of points as they have of slots
+    half = len(slot_order) // 2
+    point_half = int(round(len(point_order) * half / len(slot_order)))
+    _bisect(slots, points, slot_order[:half], point_order[:point_half], pairs)
+    _bisect(slots, points, slot_order[half:], point_order[point_half:], pairs)
+
+
+def _assign_block(block_slots: np.ndarray, block_points: np.ndarray, slot_ids: np.ndarray,
+                  point_ids: np.ndarray, pairs: List[Tuple[int, int]]):
+    """Exact assignment within a block, both point sets scaled to the unit square first."""
+    def normalize(coordinates):
+        low = coordinates.min(axis=0)
+        extent = np.ptp(coordinates, axis=0)
+        return (coordinates - low) / np.where(extent > 0, extent, 1.0)
+
+    slots_unit = normalize(block_slots)
+    points_unit = normalize(block_points)
+    cost = ((slots_unit[:, np.newaxis, :] - points_unit[np.newaxis, :, :]) ** 2).sum(axis=2)
+    for slot, point in solve_assignment(cost, maximize=False):
+        pairs.append((int(slot_ids[slot]), int(point_ids[point])))
@@ -0,0 +1,125 @@
+"""
+Module for the namespaces of the embedding store. Embeddings of different CLIP models, inference
+backends or image preparation are not comparable (a ViT-B/32 embedding does not even have the
+dimension of an RN50 one), so every combination keeps its own store in its own directory:
+
+    uploaded_images/embeddings/
+        active.json: The namespace that serves requests, shared by all workers.
+        RN50_eager_p1/: Store files of RN50 on the eager backend, image preparation version 1.
+        ViT-B-32_int8-dynamic_p1/: ...
+
+When the configured namespace differs from the active one, the library is re-encoded into the
+configured namespace in the background (see reencodeJob.py) while the active one keeps serving.
+Once every image is encoded, active.json is replaced in one rename, which switches all workers.
+"""
+
+# Standard library imports
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# Local imports
+from clipModel import file_safe
+
+###########################################################################################
+
+# Version of the image preparation before encoding (the prepare and preprocess stages of the ingest
+# graph in main.py). Bump it whenever that changes, the library is then re-encoded into a new namespace.
+PREPROCESS_VERSION = 1
+
+
+class EmbeddingNamespace:
+    """
+    The model, inference backend and image preparation embeddings were produced with.
+
+    Attributes:
+        model_name: CLIP model, e.g. "RN50".
+        backend: Inference backend, see clipModel.CLIP_BACKENDS.
+        preprocess_version: Version of the image preparation, see PREPROCESS_VERSION.
+    """
+
+    def __init__(self, model_name: str, backend: str, preprocess_version: int = PREPROCESS_VERSION):
+        self.model_name = model_name
+        self.backend = backend
+        self.preprocess_version = preprocess_version
+
+    @property
+    def name(self) -> str:
+        """Name of the store directory."""
+        return f"{file_safe(self.model_name)}_{self.backend}_p{self.preprocess_version}"
+
+    def directory(self, root: Path) -> Path:
+        """Directory of the store, created if it does not exist yet."""
+        directory = Path(root) / self.name
+        directory.mkdir(parents=True, exist_ok=True)
+        return directory
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"model": self.model_name, "backend": self.backend, "preprocess_version": self.preprocess_version}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "EmbeddingNamespace":
+        return cls(data["model"], data["backend"], data["preprocess_version"])
+
+    def __eq__(self, other):
+        return isinstance(other, EmbeddingNamespace) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return self.name
+
+
+class ActiveNamespace:
+    """
+    The file naming the namespace that serves. It is re-read only when it changed on disk, so
+    workers can check it on every request.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._mtime_ns: Optional[int] = None
+        self._namespace: Optional[EmbeddingNamespace] = None
+
+    def get(self) -> Optional[EmbeddingNamespace]:
+        """The active namespace, None if none was set yet."""
+        try:
+            mtime_ns = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if mtime_ns != self._mtime_ns:
+            with open(self.path, "r") as f:
+                self._namespace = EmbeddingNamespace.from_dict(json.load(f))
+            self._mtime_ns = mtime_ns
+        return self._namespace
+
+    def set(self, namespace: EmbeddingNamespace):
+        """Switches to namespace. The file is replaced in one rename, readers see either namespace."""
+        temporary = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(temporary, "w") as f:
+            json.dump(namespace.to_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+
+def migrate_legacy_store(files: List[Path], directory: Path) -> bool:
+    """
+    Moves the store files of the layout before namespaces, directly in the upload directory, into
+    the directory of their namespace.
+
+    Parameters:
+        files: The files of a store in the old location, see EmbeddingStore.files.
+        directory: Directory of the namespace they were produced in.
+
+    Returns:
+        bool: Whether there was anything to move.
+    """
+    existing = [path for path in files if path.exists()]
+    if existing:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+    for path in existing:
+        os.replace(path, Path(directory) / path.name)
+    return bool(existing)
@@ -0,0 +1,688 @@
+"""
+Module to keep the CLIP embeddings of all uploaded images in one L2-normalized matrix (one row
+per image), so similarities against the whole library are a single matrix product instead of a
+loop over a JSON dictionary. The full-precision matrix lives in a memory-mapped file, in memory
+only a compact copy (float16 or per-row scaled int8) is kept. Once the library is large enough,
+a PCA projection to a few dimensions is fitted and a reduced copy is kept as well. Searches
+prefilter candidates through an IVF index, score them on the reduced (or compact) copy and
+re-rank the shortlist exactly against the memory-mapped rows. A k-nearest-neighbor graph over
+the library is maintained on every insert, so the images closest to a set of placed images can be
+looked up instead of searched.
+
+Files written to the store directory:
+    embeddings.f32: Normalized float32 rows, appended on every insert.
+    embeddings.json: File names, norms, deleted flags and encoders of the rows.
+    ann_index.npz: The nearest neighbor index.
+    pca.npz: The PCA projection.
+    knn_graph.npz: The neighbor lists.
+"""
+
+# Standard library imports
+import copy
+import json
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Any, Collection, Dict, Iterable, List, Optional, Tuple
+
+# External library imports
+import numpy as np
+
+# Local imports
+from annIndex import IVFIndex
+from knnGraph import KNNGraph
+from pcaProjection import PCAProjection
+
+###########################################################################################
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+class CompactMatrix:
+    """
+    In-memory copy of the embedding matrix in reduced precision. Indexing returns
+    dequantized float32 rows, so it can be used wherever the full matrix is expected.
+    Grows by doubling its capacity, appending a row does not copy the whole matrix.
+    """
+
+    def __init__(self, precision: str, dim: int = 0):
+        if precision not in ("float16", "int8"):
+            raise ValueError(f"Unsupported compact precision '{precision}'.")
+        self.precision = precision
+        self._codes = np.zeros((0, dim), dtype=np.float16 if precision == "float16" else np.int8)
+        self._scales = np.zeros(0, dtype=np.float32)  # One scale per row, only used for int8
+        self._size = 0
+
+    @classmethod
+    def from_arrays(cls, precision: str, codes: np.ndarray, scales: np.ndarray) -> "CompactMatrix":
+        """Wraps existing codes and scales, e.g. views of shared memory, without copying them."""
+        matrix = cls(precision, codes.shape[1])
+        matrix._codes, matrix._scales, matrix._size = codes, scales, len(codes)
+        return matrix
+
+    def __len__(self):
+        return self._size
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The codes and scales of all rows."""
+        return self._codes[:self._size], self._scales[:self._size]
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._size, self._codes.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self._codes[:self._size].nbytes + (self._scales[:self._size].nbytes if self.precision == "int8" else 0)
+
+    def _encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if self.precision == "float16":
+            return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        codes = np.clip(np.round(vectors / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def append(self, vectors: np.ndarray):
+        """Appends normalized float32 rows."""
+        if self._codes.shape[1] == 0:
+            self._codes = np.zeros((0, vectors.shape[1]), dtype=self._codes.dtype)
+        needed = self._size + len(vectors)
+        if needed > len(self._codes):
+            capacity = max(needed, 2 * len(self._codes), 64)
+            codes = np.zeros((capacity, vectors.shape[1]), dtype=self._codes.dtype)
+            codes[:self._size] = self._codes[:self._size]
+            scales = np.zeros(capacity, dtype=np.float32)
+            scales[:self._size] = self._scales[:self._size]
+            self._codes, self._scales = codes, scales
+        codes, scales = self._encode(vectors)
+        self._codes[self._size:needed] = codes
+        self._scales[self._size:needed] = scales
+        self._size = needed
+
+    def copy(self) -> "CompactMatrix":
+        """A copy of the rows, appending to or changing it does not affect this matrix."""
+        codes, scales = self.arrays()
+        return CompactMatrix.from_arrays(self.precision, codes.copy(), scales.copy())
+
+    def set_row(self, row: int, vector: np.ndarray):
+        """Replaces a single row."""
+        codes, scales = self._encode(vector[np.newaxis, :])
+        self._codes[row] = codes[0]
+        self._scales[row] = scales[0]
+
+    def __getitem__(self, rows) -> np.ndarray:
+        codes = self._codes[:self._size][rows].astype(np.float32)
+        if self.precision == "int8":
+            codes *= self._scales[:self._size][rows][..., np.newaxis]
+        return codes
+
+
+class EmbeddingStore:
+    """
+    Store of image embeddings.
+
+    Attributes:
+        names: File names of the stored images, index i belongs to row i of the matrix.
+            Deleted images keep their row, it is tombstoned.
+        rows: Maps the file name of every live (not deleted) image to its row in the matrix.
+        matrix: Full-precision L2-normalized embeddings (memory-mapped), shape (number of images, dimension).
+        compact: What searches score against, the compact copy or the full matrix for float32 precision.
+        norms: Original L2 norm of every embedding, so the raw vectors can be restored.
+        version: Incremented on every change, can be used to invalidate caches.
+        index: Approximate nearest neighbor index over the rows of the matrix.
+        projection: PCA projection used for prefiltering, None until the library is large enough.
+        reduced: Projected copy of the matrix (float16), only used when there is a projection.
+        knn_graph: Top-K neighbor list of every image.
+        read_only: Whether the arrays are views of shared memory, see from_shared.
+        encoder: Id of the model and inference backend new embeddings come from, see clipModel.py.
+        encoders: Ids of all encoders that produced rows, row_encoders holds the position in this
+            list for every row.
+    """
+
+    def __init__(self, directory: Path, index: Optional[IVFIndex] = None, precision: str = "float32",
+                 rerank_factor: int = 8, reduced_dims: Optional[int] = 128, projection_min_size: int = 1024,
+                 refit_factor: float = 2.0, graph_k: int = 32, encoder: str = "unknown"):
+        """
+        Parameters:
+            directory (Path): Directory the store files are written to.
+            index (IVFIndex): Nearest neighbor index to use, a default one if None.
+            precision (str): Precision of the in-memory copy, one of "float32", "float16", "int8".
+            rerank_factor (int): A search for k results re-ranks the best k * rerank_factor
+                results of the compact or reduced copy exactly.
+            reduced_dims (int): Dimensions of the PCA projection, None to never project.
+            projection_min_size (int): Number of images at which the projection is fitted first.
+            refit_factor (float): Refit the projection once the library grew by this factor since fitting.
+            graph_k (int): Length of the neighbor list kept for every image.
+            encoder (str): Id of the encoder the added embeddings come from.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown embedding precision '{precision}', expected one of {PRECISIONS}.")
+        self.directory = Path(directory)
+        self.matrix_path = self.directory / "embeddings.f32"
+        self.metadata_path = self.directory / "embeddings.json"
+        self.index_path = self.directory / "ann_index.npz"
+        self.legacy_path = self.directory / "encoded_images.json"
+        self.projection_path = self.directory / "pca.npz"
+        self.graph_path = self.directory / "knn_graph.npz"
+        self.precision = precision
+        self.rerank_factor = rerank_factor
+        self.reduced_dims = reduced_dims
+        self.projection_min_size = projection_min_size
+        self.refit_factor = refit_factor
+
+        self.names: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.deleted: List[bool] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.compact = self.matrix if precision == "float32" else CompactMatrix(precision)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.version = 0
+        self.index = index if index is not None else IVFIndex()
+        self.projection: Optional[PCAProjection] = None
+        self.reduced = CompactMatrix("float16")
+        self.knn_graph = KNNGraph(graph_k)
+        self.read_only = False
+        self.shared_bytes = 0
+        self.encoder = encoder
+        self.encoders: List[str] = []
+        self.row_encoders: List[int] = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def files(self) -> List[Path]:
+        """Paths of all files the store reads from its directory."""
+        return [self.matrix_path, self.metadata_path, self.index_path, self.legacy_path, self.projection_path,
+                self.graph_path]
+
+    def __contains__(self, name: str):
+        return name in self.rows
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    def encoder_counts(self) -> Dict[str, int]:
+        """Number of live images per encoder that produced their embedding."""
+        counts = Counter(self.row_encoders[row] for row in self.rows.values())
+        return {self.encoders[code]: count for code, count in counts.items()}
+
+    def _encoder_code(self) -> int:
+        if self.encoder not in self.encoders:
+            self.encoders.append(self.encoder)
+        return self.encoders.index(self.encoder)
+
+    def _warn_mixed_encoders(self):
+        counts = self.encoder_counts()
+        if set(counts) - {self.encoder}:
+            print(f"Embeddings by encoder: {counts}, new ones come from {self.encoder}. "
+                  f"Similarities between embeddings of different encoders are less accurate.")
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Bytes held in process memory, the memory-mapped matrix is paged in by the OS on demand."""
+        if self.read_only:
+            return {"shared_memory": self.shared_bytes}
+        compact_bytes = 0 if self.precision == "float32" else self.compact.nbytes
+        return {"compact": compact_bytes, "reduced": self.reduced.nbytes, "norms": self.norms.nbytes,
+                "mapped_file": self.matrix.nbytes}
+
+    def refit_projection(self):
+        """Fits the PCA projection to the live images and recomputes the reduced copy."""
+        live = np.array(sorted(self.rows.values()), dtype=np.int64)
+        if self.reduced_dims is None or len(live) < max(self.projection_min_size, self.reduced_dims):
+            return
+        # A sample is enough to estimate the principal components
+        sample = live if len(live) <= 20000 else np.random.default_rng(0).choice(live, 20000, replace=False)
+        projection = PCAProjection(self.reduced_dims)
+        projection.fit(np.asarray(self.matrix[np.sort(sample)]))
+
+        reduced = CompactMatrix("float16", projection.dims)
+        for start in range(0, len(self.names), 4096):
+            reduced.append(projection.transform(np.asarray(self.matrix[start:start + 4096])))
+        self.projection, self.reduced = projection, reduced
+        print(f"Fitted PCA projection to {projection.dims} dims on {len(sample)} images, "
+              f"keeping {projection.explained_variance:.0%} of the variance.")
+
+    def _update_projection(self, new_rows: List[int], replaced_rows: List[int]):
+        """Keeps the reduced copy in sync after rows were added or replaced, refitting when due."""
+        if self.reduced_dims is None:
+            return
+        if self.projection is None:
+            if len(self) >= self.projection_min_size:
+                self.refit_projection()
+            return
+        if len(self) >= self.projection.fitted_size * self.refit_factor:
+            self.refit_projection()
+            return
+        if new_rows:
+            self.reduced.append(self.projection.transform(np.asarray(self.matrix[new_rows])))
+        for row in replaced_rows:
+            self.reduced.set_row(row, self.projection.transform(np.asarray(self.matrix[[row]]))[0])
+
+    def _remap(self, count: int, dim: int):
+        """Maps the first count rows of the matrix file."""
+        if count == 0:
+            self.matrix = np.zeros((0, dim), dtype=np.float32)
+        else:
+            self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(count, dim))
+        if self.precision == "float32":
+            self.compact = self.matrix
+
+    def load(self):
+        """Loads the store from its directory, importing a legacy 'encoded_images.json' if there is one."""
+        if not self.metadata_path.exists():
+            # Rows without metadata cannot be matched to their images
+            if self.matrix_path.exists():
+                self.matrix_path.unlink()
+            if self.legacy_path.exists():
+                with open(self.legacy_path, "r") as f:
+                    self.add_many(json.load(f).items())
+            return
+
+        with open(self.metadata_path, "r") as f:
+            metadata = json.load(f)
+        dim = metadata["dim"]
+        # Rows appended after the metadata was last saved have no name, they are ignored and cut off
+        # by the next append. A missing matrix file holds no rows.
+        file_rows = self.matrix_path.stat().st_size // (4 * dim) if dim and self.matrix_path.exists() else 0
+        count = min(len(metadata["names"]), file_rows)
+
+        self.names = metadata["names"][:count]
+        self.deleted = metadata["deleted"][:count]
+        self.norms = np.asarray(metadata["norms"][:count], dtype=np.float32)
+        # Stores written before encoders were recorded hold embeddings of an unknown encoder
+        self.encoders = metadata.get("encoders", ["unknown"])
+        self.row_encoders = metadata.get("row_encoders", [0] * count)[:count]
+        self.rows = {name: row for row, name in enumerate(self.names) if not self.deleted[row]}
+        self._remap(count, dim)
+        self._warn_mixed_encoders()
+        if self.precision != "float32":
+            self.compact = CompactMatrix(self.precision, dim)
+            for start in range(0, count, 4096):
+                self.compact.append(np.asarray(self.matrix[start:start + 4096]))
+
+        # Reuse the saved index if it was written for exactly these rows
+        saved_index = None
+        if self.index_path.exists():
+            saved_index = IVFIndex(self.index.n_lists, self.index.nprobe, self.index.min_train_size,
+                                   self.index.retrain_factor, self.index.kmeans_iterations, self.index.seed)
+            saved_index.load(self.index_path)
+            if len(saved_index.tombstones) != count:
+                saved_index = None
+        if saved_index is not None:
+            self.index = saved_index
+        else:
+            self.index.add(self.compact, np.arange(count))
+            self.index.remove([row for row in range(count) if self.deleted[row]])
+
+        if self.reduced_dims is not None and self.projection_path.exists():
+            self.projection = PCAProjection(self.reduced_dims)
+            self.projection.load(self.projection_path)
+            self.reduced = CompactMatrix("float16", self.projection.dims)
+            for start in range(0, count, 4096):
+                self.reduced.append(self.projection.transform(np.asarray(self.matrix[start:start + 4096])))
+        else:
+            self._update_projection([], [])
+
+        saved_graph = None
+        if self.graph_path.exists():
+            saved_graph = KNNGraph(self.knn_graph.k)
+            saved_graph.load(self.graph_path)
+            if len(saved_graph) != count:
+                saved_graph = None
+        if saved_graph is not None:
+            self.knn_graph = saved_graph
+        else:
+            print(f"Building neighbor lists for {len(self)} images.")
+            self.knn_graph.add(self.matrix, list(self.rows.values()), self.search_rows)
+        self.version += 1
+
+    def refresh(self) -> bool:
+        """
+        Catches up with the rows another worker appended to the store files since they were read,
+        and with the images it deleted, without rebuilding the compact copy, index and neighbor
+        lists of the rows loaded already.
+
+        Returns:
+            bool: False if the files changed in another way (rows were rewritten, another dimension),
+                the store then has to be loaded again.
+        """
+        if self.read_only or not self.metadata_path.exists():
+            return False
+        with open(self.metadata_path, "r") as f:
+            metadata = json.load(f)
+        dim = metadata["dim"]
+        start = len(self.names)
+        if metadata["names"][:start] != self.names or (start and dim != self.dim):
+            return False
+        file_rows = self.matrix_path.stat().st_size // (4 * dim) if dim and self.matrix_path.exists() else 0
+        count = min(len(metadata["names"]), file_rows)
+        if count < start:
+            return False
+
+        for row in range(start):
+            if metadata["deleted"][row] and not self.deleted[row]:
+                self.rows.pop(self.names[row], None)
+                self.deleted[row] = True
+                self.index.remove([row])
+                self.knn_graph.remove(row)
+
+        if count > start:
+            self._remap(count, dim)
+            if self.precision != "float32":
+                for offset in range(start, count, 4096):
+                    self.compact.append(np.asarray(self.matrix[offset:min(offset + 4096, count)]))
+            self.norms = np.concatenate([self.norms, np.asarray(metadata["norms"][start:count], dtype=np.float32)])
+            self.encoders = metadata.get("encoders", self.encoders)
+            self.row_encoders.extend(metadata.get("row_encoders", [0] * count)[start:count])
+            self.deleted.extend(metadata["deleted"][start:count])
+            self.names.extend(metadata["names"][start:count])
+            new_rows = list(range(start, count))
+            live_rows = [row for row in new_rows if not self.deleted[row]]
+            self.index.add(self.compact, np.array(new_rows))
+            self.index.remove([row for row in new_rows if self.deleted[row]])
+            for row in live_rows:
+                self.rows[self.names[row]] = row
+            # After the names, a refit of the projection is due by the number of live images
+            self._update_projection(new_rows, [])
+            self.knn_graph.add(self.matrix, live_rows, self.search_rows)
+        self.version += 1
+        return True
+
+    def copy(self) -> "EmbeddingStore":
+        """
+        A copy that can be extended, refreshed and saved while this store keeps serving searches.
+        The in-memory rows, index and neighbor lists are copied, the matrix file is shared: rows are
+        only appended to it, except for replaced images, whose rows both stores see change.
+        """
+        store = copy.copy(self)
+        store.rows = dict(self.rows)
+        store.names = list(self.names)
+        store.deleted = list(self.deleted)
+        store.norms = self.norms.copy()
+        store.encoders = list(self.encoders)
+        store.row_encoders = list(self.row_encoders)
+        if self.precision != "float32":
+            store.compact = self.compact.copy()
+        store.index = self.index.copy()
+        store.reduced = self.reduced.copy()
+        store.knn_graph = self.knn_graph.copy()
+        return store
+
+    def export(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """Arrays and metadata the store can be rebuilt from with from_shared, see sharedEmbeddings.py."""
+        count = len(self.names)
+        arrays = {"matrix": np.asarray(self.matrix[:count]), "norms": self.norms}
+        if self.precision != "float32":
+            arrays["compact_codes"], arrays["compact_scales"] = self.compact.arrays()
+        projection = None
+        if self.projection is not None:
+            arrays["pca_mean"], arrays["pca_components"] = self.projection.mean, self.projection.components
+            arrays["reduced_codes"], arrays["reduced_scales"] = self.reduced.arrays()
+            projection = {"fitted_size": self.projection.fitted_size,
+                          "explained_variance": self.projection.explained_variance}
+        arrays["index_assignments"], arrays["index_tombstones"] = self.index.assignments, self.index.tombstones
+        if self.index.is_trained:
+            arrays["index_centroids"] = self.index.centroids
+            arrays["index_order"], arrays["index_bounds"] = self.index.list_arrays()
+        graph_size = len(self.knn_graph)
+        arrays["graph_ids"] = self.knn_graph.ids[:graph_size]
+        arrays["graph_similarities"] = self.knn_graph.similarities[:graph_size]
+        arrays["graph_deleted"] = self.knn_graph.deleted[:graph_size]
+
+        metadata = {
+            "names": self.names,
+            "deleted": self.deleted,
+            "dim": self.dim,
+            "precision": self.precision,
+            "version": self.version,
+            "index_trained_size": self.index.trained_size,
+            "projection": projection,
+            "encoders": self.encoders,
+            "row_encoders": self.row_encoders,
+        }
+        return arrays, metadata
+
+    @classmethod
+    def from_shared(cls, directory: Path, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any],
+                    index: Optional[IVFIndex] = None, writable: bool = False, **kwargs) -> "EmbeddingStore":
+        """
+        Rebuilds a store from the output of export.
+
+        Parameters:
+            directory (Path): Directory of the store files.
+            arrays: The exported arrays, e.g. read-only views of shared memory.
+            metadata: The exported metadata.
+            index (IVFIndex): Index to fill, carries the search knobs.
+            writable (bool): Without it the store uses the arrays as they are and cannot be changed.
+                With it they are copied and the full matrix is mapped from the directory, so images
+                can be added and the result exported again.
+            kwargs: Further arguments of the constructor.
+        """
+        take = np.array if writable else (lambda array: array)
+        store = cls(directory, index, precision=metadata["precision"], **kwargs)
+        store.read_only = not writable
+        store.names = list(metadata["names"])
+        store.deleted = list(metadata["deleted"])
+        store.encoders = list(metadata["encoders"])
+        store.row_encoders = list(metadata["row_encoders"])
+        store.rows = {name: row for row, name in enumerate(store.names) if not store.deleted[row]}
+        store.norms = take(arrays["norms"])
+        if writable:
+            store._remap(len(store.names), metadata["dim"])
+        else:
+            store.matrix = arrays["matrix"]
+            store.compact = store.matrix
+            store.shared_bytes = sum(array.nbytes for array in arrays.values())
+        if store.precision != "float32":
+            store.compact = CompactMatrix.from_arrays(store.precision, take(arrays["compact_codes"]),
+                                                      take(arrays["compact_scales"]))
+
+        if metadata["projection"] is not None:
+            store.projection = PCAProjection(arrays["pca_components"].shape[0])
+            store.projection.mean = take(arrays["pca_mean"])
+            store.projection.components = take(arrays["pca_components"])
+            store.projection.fitted_size = metadata["projection"]["fitted_size"]
+            store.projection.explained_variance = metadata["projection"]["explained_variance"]
+            store.reduced = CompactMatrix.from_arrays("float16", take(arrays["reduced_codes"]),
+                                                      take(arrays["reduced_scales"]))
+
+        store.index.assignments = take(arrays["index_assignments"])
+        store.index.tombstones = take(arrays["index_tombstones"])
+        store.index.trained_size = metadata["index_trained_size"]
+        if "index_centroids" in arrays:
+            store.index.centroids = take(arrays["index_centroids"])
+            store.index.set_lists(take(arrays["index_order"]), take(arrays["index_bounds"]))
+
+        store.knn_graph.set_arrays(take(arrays["graph_ids"]), take(arrays["graph_similarities"]),
+                                   take(arrays["graph_deleted"]))
+        store.version = metadata["version"]
+        return store
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ValueError("The embedding store is a read-only view of shared memory.")
+
+    def save(self):
+        """Writes names, norms and the index. The rows themselves are written when they are added."""
+        self._check_writable()
+        metadata = {
+            "dim": self.dim,
+            "names": self.names,
+            "deleted": self.deleted,
+            "norms": self.norms.tolist(),
+            "encoders": self.encoders,
+            "row_encoders": self.row_encoders,
+        }
+        # Replaced in one rename, workers refreshing from the files never read a partial file
+        temporary = self.metadata_path.with_name(f"{self.metadata_path.name}.{os.getpid()}.tmp")
+        with open(temporary, "w") as f:
+            json.dump(metadata, f)
+        os.replace(temporary, self.metadata_path)
+        self.index.save(self.index_path)
+        if self.projection is not None:
+            self.projection.save(self.projection_path)
+        self.knn_graph.save(self.graph_path)
+
+    def _append_rows(self, vectors: np.ndarray):
+        """
+        Appends normalized rows to the matrix file, right after the rows of the named images. Rows
+        an interrupted writer appended without saving the metadata have no name, they are cut off
+        first, otherwise every new row would be matched to the vector of the row before it.
+        """
+        with open(self.matrix_path, "ab") as f:
+            f.truncate(len(self.names) * vectors.shape[1] * 4)
+            f.write(vectors.tobytes())
+
+    def add(self, name: str, vector):
+        """Adds or replaces the embedding of a single image."""
+        self.add_many([(name, vector)])
+
+    def add_many(self, items: Iterable):
+        """
+        Adds or replaces the embeddings of several images at once.
+
+        Parameters:
+            items: Iterable of (file name, vector) pairs. A vector may have shape (dim,) or (1, dim).
+        """
+        self._check_writable()
+        changed_rows = []
+        new_rows = []
+        new_names = []
+        new_vectors = []
+        replaced = {}
+        for name, vector in items:
+            vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+            if name in self.rows:
+                replaced[self.rows[name]] = vector
+            else:
+                new_names.append(name)
+                new_vectors.append(vector)
+
+        code = self._encoder_code()
+        if replaced:
+            with open(self.matrix_path, "r+b") as f:
+                for row, vector in replaced.items():
+                    norm = float(np.linalg.norm(vector))
+                    normalized = (vector / max(norm, 1e-12)).astype(np.float32)
+                    f.seek(row * normalized.nbytes)
+                    f.write(normalized.tobytes())
+                    self.norms[row] = norm
+                    self.row_encoders[row] = code
+                    if self.precision != "float32":
+                        self.compact.set_row(row, normalized)
+                    changed_rows.append(row)
+
+        if new_vectors:
+            vectors = np.stack(new_vectors)
+            norms = np.linalg.norm(vectors, axis=1)
+            vectors = (vectors / np.maximum(norms, 1e-12)[:, np.newaxis]).astype(np.float32)
+            self._append_rows(vectors)
+            if self.precision != "float32":
+                self.compact.append(vectors)
+            self.norms = np.concatenate([self.norms, norms.astype(np.float32)])
+            for name in new_names:
+                self.rows[name] = len(self.names)
+                changed_rows.append(len(self.names))
+                new_rows.append(len(self.names))
+                self.names.append(name)
+                self.deleted.append(False)
+                self.row_encoders.append(code)
+
+        if changed_rows:
+            self._remap(len(self.names), self.dim if self.dim else len(new_vectors[0]))
+            self.index.add(self.compact, np.array(changed_rows))
+            self._update_projection(new_rows, list(replaced))
+            self.knn_graph.add(self.matrix, changed_rows, self.search_rows)
+        self.version += 1
+
+    def remove(self, name: str):
+        """Deletes an image, its row is tombstoned."""
+        self._check_writable()
+        row = self.rows.pop(name)
+        self.deleted[row] = True
+        self.index.remove([row])
+        self.knn_graph.remove(row)
+        self.version += 1
+
+    def image_names(self) -> List[str]:
+        """Returns the names of all live images."""
+        return list(self.rows)
+
+    def get(self, name: str) -> np.ndarray:
+        """Returns the normalized embedding of an image."""
+        return np.asarray(self.matrix[self.rows[name]])
+
+    def get_raw(self, name: str) -> np.ndarray:
+        """Returns the embedding of an image as produced by the model."""
+        row = self.rows[name]
+        return self.matrix[row] * self.norms[row]
+
+    def vectors(self, names: Iterable[str]) -> np.ndarray:
+        """Returns the normalized full-precision embeddings of the given images, one row per name."""
+        rows = [self.rows[name] for name in names]
+        if not rows:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.asarray(self.matrix[rows])
+
+    def neighbor_candidates(self, names: Iterable[str], exclude: Collection[str] = ()) -> List[str]:
+        """
+        Merges the neighbor lists of the given images.
+
+        Parameters:
+            names: Images whose neighbors are wanted, e.g. the images placed next to a slot.
+            exclude: Names of images that must not be returned.
+
+        Returns:
+            list: Names of the images in any of the neighbor lists, without duplicates.
+        """
+        rows = set()
+        # Lists of a read-only store cannot be recomputed, they are used as they are
+        matrix, search = (None, None) if self.read_only else (self.matrix, self.search_rows)
+        for name in names:
+            rows.update(self.knn_graph.neighbors(self.rows[name], matrix, search).tolist())
+        excluded = {self.rows[name] for name in exclude if name in self.rows}
+        return [self.names[row] for row in sorted(rows - excluded)]
+
+    def search(self, query: np.ndarray, k: int = 1, exclude: Collection[str] = (),
+               nprobe: Optional[int] = None) -> List[Tuple[str, float]]:
+        """
+        Finds the k images most similar to the query.
+
+        Parameters:
+            query (np.ndarray): Query vector, does not have to be normalized.
+            k (int): Number of results.
+            exclude: Names of images that must not be returned (placed or rejected images).
+            nprobe (int): Lists of the index to scan, defaults to the nprobe of the index.
+
+        Returns:
+            list: (file name, cosine similarity) pairs, best first.
+        """
+        excluded_rows = [self.rows[name] for name in exclude if name in self.rows]
+        return [(self.names[row], score) for row, score in self.search_rows(query, k, excluded_rows, nprobe)]
+
+    def search_rows(self, query: np.ndarray, k: int = 1, excluded_rows: Collection[int] = (),
+                    nprobe: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Same as search, but works on row ids instead of names."""
+        if len(self) == 0:
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        if self.precision == "float32" and self.projection is None:
+            return self.index.search(self.matrix, query, k=k, nprobe=nprobe, exclude=excluded_rows)
+
+        # Coarse scores on the reduced or compact copy, exact scores only for the shortlist
+        if self.projection is not None:
+            shortlist = self.index.search(self.compact, query, k=k * self.rerank_factor, nprobe=nprobe,
+                                          exclude=excluded_rows, score_matrix=self.reduced,
+                                          score_query=self.projection.transform_query(query))
+        else:
+            shortlist = self.index.search(self.compact, query, k=k * self.rerank_factor, nprobe=nprobe,
+                                          exclude=excluded_rows)
+        rows = np.array(sorted(row for row, _ in shortlist), dtype=np.int64)
+        if len(rows) == 0:
+            return []
+        scores = np.asarray(self.matrix[rows]) @ query
+        order = np.argsort(-scores)[:k]
+        return [(int(rows[i]), float(scores[i])) for i in order]
@@ -0,0 +1,110 @@
+"""
+Module to coalesce concurrent CLIP encode requests into batches. Handlers submit single inputs and
+await the result, a background task collects the queued inputs until the batch is full or the
+first input waited max_wait_s, then encodes all of them in one forward pass in a worker thread.
+One forward pass over 16 images costs far less than 16 passes over one, so under concurrent
+uploads and prompts throughput rises while a lone request waits at most max_wait_s longer.
+"""
+
+# Standard library imports
+import asyncio
+from typing import Callable, Dict, List, Optional, Tuple
+
+# External library imports
+import numpy as np
+import torch
+
+###########################################################################################
+
+# Largest number of inputs encoded in one forward pass
+MAX_BATCH = 32
+
+# Longest time the first input of a batch waits for more inputs
+MAX_WAIT_S = 0.005
+
+
+class EncoderBatcher:
+    """
+    Batching front of one encoder, e.g. model.encode_image.
+
+    Attributes:
+        encode: Maps a batch of inputs (first dimension is the batch) to a batch of features.
+        max_batch: Largest batch passed to encode.
+        max_wait_s: Longest time an input waits for others to join its batch.
+        stats: Number of encoded inputs and batches and the largest batch so far.
+    """
+
+    def __init__(self, encode: Callable[[torch.Tensor], torch.Tensor], max_batch: int = MAX_BATCH,
+                 max_wait_s: float = MAX_WAIT_S):
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_s
+        self.stats: Dict[str, int] = {"inputs": 0, "batches": 0, "largest_batch": 0}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, item: torch.Tensor) -> np.ndarray:
+        """
+        Encodes a single input.
+
+        Parameters:
+            item (torch.Tensor): The input without batch dimension, e.g. a preprocessed image.
+
+        Returns:
+            np.ndarray: Its features as float32.
+        """
+        if self._task is None or self._task.done():
+            # Created on first use, so every forked worker gets its own on its own event loop
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def submit_many(self, items: List[torch.Tensor]) -> List[np.ndarray]:
+        """Encodes several inputs, they share batches with each other and with concurrent requests."""
+        return list(await asyncio.gather(*(self.submit(item) for item in items)))
+
+    async def _collect(self) -> List[Tuple[torch.Tensor, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_s
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # Callers that gave up do not need their result
+        return [(item, future) for item, future in batch if not future.done()]
+
+    def _forward(self, inputs: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.encode(inputs).float().cpu().numpy()
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            try:
+                inputs = torch.stack([item for item, _ in batch])
+                # The forward pass runs in a thread, requests keep queueing for the next batch meanwhile
+                features = await asyncio.to_thread(self._forward, inputs)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.stats["inputs"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+            for (_, future), row in zip(batch, features):
+                if not future.done():
+                    future.set_result(row)
@@ -0,0 +1,90 @@
+"""
+Module for the preparation of uploaded images before they are encoded: the sharpened 600x600
+version that is served in place of the upload, and its thumbnail. It only depends on PIL, OpenCV
+and numpy, so the process pool of the ingest pipeline imports it without loading CLIP.
+"""
+
+# Standard library imports
+import io
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+# External library imports
+import cv2
+import numpy as np
+from PIL import Image, ImageEnhance
+
+###########################################################################################
+
+
+def resize_image_keep_aspect(image_path, output: Optional[BinaryIO] = None):
+    """
+    Sharpens images using laplace filter.
+    Applies sharpening with OpenCV and Floyd-Steinberg dithering (if PNG).
+
+    Parameters:
+        image_path (str): Path to the input image file (the file will be overwritten).
+        output (file object, optional): Receives the image instead of the input file, in the
+            format of the input file.
+    """
+    target_size = (600, 600)
+    upscale_factor = 8
+    highres_size = (target_size[0] * upscale_factor, target_size[1] * upscale_factor)
+
+    img = Image.open(image_path).convert("RGB")
+    img_large = img.resize(highres_size, Image.Resampling.LANCZOS)
+
+    # Using Laplacian filter to sharpen images
+    img_cv = np.array(img_large)
+    sharp = cv2.Laplacian(img_cv, cv2.CV_64F)
+    img_cv = cv2.convertScaleAbs(img_cv + sharp)
+
+    # Converting from cv2 array to PIL
+    img_sharp = Image.fromarray(img_cv)
+    enhancer = ImageEnhance.Sharpness(img_sharp)
+    img_sharp = enhancer.enhance(2.0)
+
+    # Downscaling image
+    img_final = img_sharp.resize(target_size, Image.Resampling.LANCZOS)
+
+    # Using dithering on pngs.
+    if image_path.lower().endswith(".png"):
+        img_final = img_final.convert("P", dither=Image.Dither.FLOYDSTEINBERG)
+
+    # Saving jpegs in RGB
+    if image_path.lower().endswith((".jpg", ".jpeg")):
+        img_final = img_final.convert("RGB")
+
+    if output is None:
+        img_final.save(image_path)
+    else:
+        img_final.save(output, format=Image.registered_extensions()[Path(image_path).suffix.lower()])
+
+
+def thumbnail_name(file_name: str) -> str:
+    """File name of the thumbnail of an image, thumbnails are always JPEGs."""
+    return f"{Path(file_name).stem}.jpg"
+
+
+def write_thumbnail(image_path, thumbnail_path, size: Tuple[int, int]):
+    """Writes a JPEG preview of the image in the given size, both paths may be file objects."""
+    img = Image.open(image_path).convert("RGB")
+    img = img.resize(size, Image.Resampling.LANCZOS)
+    img.save(thumbnail_path, format="JPEG", quality=80)
+
+
+def prepare_image(original_path: Path) -> bytes:
+    """
+    Prepare stage of the ingest: the sharpened and resized image, encoded in the format of the
+    original, which stays untouched. Runs in a worker process of the pipeline.
+    """
+    buffer = io.BytesIO()
+    resize_image_keep_aspect(str(original_path), buffer)
+    return buffer.getvalue()
+
+
+def thumbnail_image(prepared: bytes, size: Tuple[int, int]) -> bytes:
+    """Thumbnail stage of the ingest: the JPEG preview of a prepared image."""
+    buffer = io.BytesIO()
+    write_thumbnail(io.BytesIO(prepared), buffer, size)
+    return buffer.getvalue()
@@ -0,0 +1,83 @@
+"""
+Module for the result cache of the ingest stages, see ingestPipeline.py. Results are addressed by
+a key derived from the stage name, the stage version and the keys of the stage inputs, which in
+turn go back to the content hashes of the uploaded files. A result is therefore reused exactly as
+long as neither the content nor the version of any stage it depends on changed.
+
+Files written to the cache directory:
+    <stage>/<key[:2]>/<key>.pkl: Pickled outputs of one run of the stage.
+    items/<file name>.json: Keys of the source artifacts of an ingested image.
+    signature.json: The stage versions the library was last brought up to date with.
+"""
+
+# Standard library imports
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+###########################################################################################
+
+
+def content_hash(path: Path) -> str:
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_atomically(path: Path, data: bytes):
+    """Concurrent readers, also in other workers, see the old file or the complete new one."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+class IngestCache:
+    """Stage results and source keys of the ingested images, shared by all workers through the directory."""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _result_path(self, stage: str, key: str) -> Path:
+        return self.directory / stage / key[:2] / f"{key}.pkl"
+
+    def has(self, stage: str, key: str) -> bool:
+        return self._result_path(stage, key).exists()
+
+    def get(self, stage: str, key: str) -> Tuple[Any, ...]:
+        """The outputs of the stage stored under key."""
+        with open(self._result_path(stage, key), "rb") as f:
+            return pickle.load(f)
+
+    def put(self, stage: str, key: str, outputs: Tuple[Any, ...]):
+        write_atomically(self._result_path(stage, key), pickle.dumps(outputs, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def item_keys(self, name: str) -> Optional[Dict[str, str]]:
+        """Keys of the source artifacts of an image, None if it was not ingested through the cache."""
+        path = self.directory / "items" / f"{name}.json"
+        if not path.exists():
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def put_item_keys(self, name: str, keys: Dict[str, str]):
+        write_atomically(self.directory / "items" / f"{name}.json", json.dumps(keys).encode())
+
+    def signature(self) -> Optional[Dict[str, str]]:
+        """The stage versions the library was last brought up to date with, None if never."""
+        path = self.directory / "signature.json"
+        if not path.exists():
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def set_signature(self, signature: Dict[str, str]):
+        write_atomically(self.directory / "signature.json", json.dumps(signature).encode())
@@ -0,0 +1,334 @@
+"""
+Module for the staged ingest of uploaded images. Every stage runs its own number of workers and
+hands its results to the next stage through a bounded queue, so while image k is encoded, image
+k+1 is preprocessed and image k+2 resized. When a stage falls behind, the queue in front of it
+fills up and the stages before it wait, which bounds the images in flight by the queue sizes.
+
+The stages form a graph: every stage names the artifacts it reads and the ones it produces, e.g.
+"prepare" reads "original" and produces "prepared", "thumbnail" reads "prepared". Artifacts no
+stage produces are the sources an IngestItem brings along. The results of a stage are cached (see
+ingestCache.py) under a key of its name, its version and the keys of its inputs, which go back to
+the content hashes of the sources. For every item only the stages run whose result is not cached,
+plus the uncached stages they need inputs from. Adding a stage or bumping the version of one thus
+reruns that stage and the stages consuming its outputs, everything else is read from the cache.
+
+A stage runs its function in one of three ways:
+    process: In a process pool, for CPU-heavy work that holds the GIL (resizing, sharpening).
+        The function has to be picklable, i.e. defined at module level or a functools.partial of one,
+        in a module that is light to import: the pool's processes are forked from a fork server
+        that imports only that module, not from the multi-threaded server. The fork server is
+        started by IngestPipeline.start_fork_server, see serve.py. Without it, e.g. under
+        "uvicorn main:app", process stages run in a thread pool.
+    thread: In a thread pool, for file IO and work that releases the GIL.
+    async: As a coroutine on the event loop, e.g. submitting to an EncoderBatcher.
+
+Every stage counts its items, cache hits, errors, the time spent in its function and the time it
+was active, so its throughput and utilization show which stage limits the ingest.
+"""
+
+# Standard library imports
+import asyncio
+import hashlib
+import multiprocessing
+import multiprocessing.forkserver
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+# Local imports
+from ingestCache import IngestCache
+
+###########################################################################################
+
+STAGE_KINDS = ("process", "thread", "async")
+
+# Items waiting in front of every stage
+QUEUE_SIZE = 16
+
+
+def _key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+class Stage:
+    """
+    One step of the ingest.
+
+    Attributes:
+        name: Name in the stats and the cache.
+        function: Maps the values of the inputs to the values of the outputs, a tuple if there are
+            several outputs.
+        inputs: Names of the artifacts the function reads, in the order of its parameters.
+        outputs: Names of the artifacts the function produces.
+        version: Bump it whenever the function produces different outputs, cached results of
+            older versions are then ignored.
+        cache: Whether the outputs are cached. Stages whose outputs are cheap to recompute but
+            large to store, or are kept elsewhere, are not cached.
+        kind: How the function runs, one of STAGE_KINDS.
+        concurrency: Number of items the stage works on at the same time.
+        stats: Items the function ran for, items answered from the cache ("cached"), errors,
+            seconds spent in the function ("busy_s") and seconds the stage was active across all
+            runs ("active_s").
+        mp_context: Context of the fork server a process stage forks its pool from, None until
+            IngestPipeline.start_fork_server started one.
+    """
+
+    def __init__(self, name: str, function: Callable, inputs: List[str], outputs: List[str], version: int = 1,
+                 cache: bool = True, kind: str = "thread", concurrency: int = 1):
+        if kind not in STAGE_KINDS:
+            raise ValueError(f"Unknown stage kind '{kind}', expected one of {STAGE_KINDS}.")
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.version = version
+        self.cache = cache
+        self.kind = kind
+        self.concurrency = concurrency
+        self.stats: Dict[str, float] = {"items": 0, "cached": 0, "errors": 0, "busy_s": 0.0, "active_s": 0.0}
+        self.mp_context = None
+        self._executor: Optional[Executor] = None
+
+    def executor(self) -> Executor:
+        """The pool of the stage, created on first use, so each forked worker creates its own."""
+        if self._executor is None:
+            if self.kind == "process" and self.mp_context is not None:
+                self._executor = ProcessPoolExecutor(self.concurrency, mp_context=self.mp_context)
+            else:
+                self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix=f"ingest-{self.name}")
+        return self._executor
+
+    async def call(self, *values: Any) -> Tuple[Any, ...]:
+        """Runs the function, the outputs are returned as a tuple also if there is only one."""
+        if self.kind == "async":
+            result = await self.function(*values)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor(), self.function, *values)
+        return (result,) if len(self.outputs) == 1 else tuple(result)
+
+    def report(self) -> Dict[str, float]:
+        """The stats with the throughput and the share of its workers' time the stage was busy."""
+        active_s = self.stats["active_s"]
+        return dict(self.stats, busy_s=round(self.stats["busy_s"], 3), active_s=round(active_s, 3),
+                    items_per_s=round(self.stats["items"] / active_s, 2) if active_s else 0.0,
+                    utilization=round(self.stats["busy_s"] / (active_s * self.concurrency), 2) if active_s else 0.0)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class IngestItem:
+    """
+    One image passing the ingest.
+
+    Attributes:
+        name: File name of the image.
+        values: Artifacts by name. Holds the sources and any artifact known already, whose stage is
+            then skipped, and receives the artifacts the stages produce or load from the cache.
+        keys: Cache keys of the artifacts. Holds the keys of the given artifacts, e.g. the content
+            hash of the original, the keys of the others are derived while planning.
+        computed: Names of the stages whose function ran for the item.
+    """
+
+    def __init__(self, name: str, values: Dict[str, Any], keys: Dict[str, str]):
+        self.name = name
+        self.values = dict(values)
+        self.keys = dict(keys)
+        self.computed: Set[str] = set()
+        self._stage_keys: Dict[str, str] = {}
+        self._run: Set[str] = set()
+        self._load: Set[str] = set()
+
+
+class IngestPipeline:
+    """
+    The stage graph. Stages run in dependency order for every item, the items flow through all of
+    them at once.
+
+    Attributes:
+        stages: The stages, sorted so that every stage comes after the stages producing its inputs.
+        cache: Store of the stage results, None runs every stage.
+        queue_size: Items waiting in front of every stage.
+    """
+
+    def __init__(self, stages: List[Stage], cache: Optional[IngestCache] = None, queue_size: int = QUEUE_SIZE):
+        producers: Dict[str, Stage] = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f"Artifact '{output}' is produced by stages '{producers[output].name}' "
+                                     f"and '{stage.name}'.")
+                producers[output] = stage
+        self.stages: List[Stage] = []
+        pending = list(stages)
+        while pending:
+            ready = [stage for stage in pending
+                     if all(producers.get(name) in self.stages or name not in producers for name in stage.inputs)]
+            if not ready:
+                raise ValueError(f"The stages {[stage.name for stage in pending]} depend on each other in a cycle.")
+            self.stages.extend(ready)
+            pending = [stage for stage in pending if stage not in ready]
+        self.cache = cache
+        self.queue_size = queue_size
+
+    def start_fork_server(self, preload: List[str] = ()) -> bool:
+        """
+        Starts the fork server the pools of the process stages fork from, with the modules of their
+        functions preloaded. Forking the server itself could deadlock on locks held by its other
+        threads (torch, the encoder batcher, to_thread), so this has to run once per serving process
+        before it starts any thread. A pool process still imports the main script as __mp_main__
+        when it starts, so the main script has to be safe to import (see serve.py).
+
+        Parameters:
+            preload: Further modules to import into the fork server, e.g. the main script as a module,
+                so a pool process finds the modules the main script imports loaded already.
+
+        Returns:
+            False where there is no fork server, process stages then run in thread pools.
+        """
+        if "forkserver" not in multiprocessing.get_all_start_methods():
+            return False
+        process_stages = [stage for stage in self.stages if stage.kind == "process"]
+        modules = sorted({getattr(stage.function, "func", stage.function).__module__ for stage in process_stages})
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(modules + list(preload))
+        multiprocessing.forkserver.ensure_running()
+        for stage in process_stages:
+            stage.mp_context = context
+        return True
+
+    def signature(self) -> Dict[str, str]:
+        """The versions of all stages, it changes when a stage is added, removed or bumped."""
+        return {stage.name: str(stage.version) for stage in self.stages}
+
+    def plan(self, item: IngestItem):
+        """
+        Derives the keys of the item's artifacts and decides which stages run for it and which
+        outputs are read from the cache. Reads the cache directory, runs in a worker thread.
+        """
+        stage_keys = item._stage_keys
+        for stage in self.stages:
+            if all(name in item.keys for name in stage.inputs):
+                stage_keys[stage.name] = _key(stage.name, str(stage.version), *(item.keys[name] for name in stage.inputs))
+                for output in stage.outputs:
+                    item.keys.setdefault(output, _key(stage_keys[stage.name], output))
+
+        consumed = {name for stage in self.stages for name in stage.inputs}
+        needed: Set[str] = set()  # Artifacts the running stages read
+        for stage in reversed(self.stages):
+            if all(output in item.values for output in stage.outputs):
+                continue
+            outputs_needed = any(output in needed for output in stage.outputs)
+            key = stage_keys.get(stage.name)
+            if stage.cache and key is not None and self.cache is not None and self.cache.has(stage.name, key):
+                stage.stats["cached"] += 1
+                if outputs_needed:
+                    item._load.add(stage.name)
+                continue
+            if stage.cache or outputs_needed or not consumed.intersection(stage.outputs):
+                missing = [name for name in stage.inputs if name not in item.keys]
+                if missing:
+                    raise ValueError(f"Stage '{stage.name}' cannot run for {item.name}, {missing} are unknown.")
+                item._run.add(stage.name)
+                needed.update(stage.inputs)
+
+    async def _process(self, stage: Stage, item: IngestItem):
+        """Runs the stage for the item or loads its outputs from the cache, if the plan says so."""
+        if stage.name in item._load:
+            outputs = await asyncio.to_thread(self.cache.get, stage.name, item._stage_keys[stage.name])
+        elif stage.name in item._run:
+            outputs = await stage.call(*(item.values[name] for name in stage.inputs))
+            item.computed.add(stage.name)
+            if stage.cache and self.cache is not None:
+                await asyncio.to_thread(self.cache.put, stage.name, item._stage_keys[stage.name], outputs)
+        else:
+            return
+        item.values.update(zip(stage.outputs, outputs))
+
+    async def run(self, items: List[IngestItem]) -> List[Any]:
+        """
+        Passes the items through the stages. Concurrent runs share the pools of the stages.
+
+        Returns:
+            list: Every item with the artifacts it gained, in the order of the items. An item whose
+                planning or stage raised is replaced by the exception, it skipped the remaining stages.
+        """
+
+        def plan_all() -> List[Any]:
+            planned = []
+            for item in items:
+                try:
+                    self.plan(item)
+                    planned.append(item)
+                except Exception as e:
+                    planned.append(e)
+            return planned
+
+        planned = await asyncio.to_thread(plan_all)
+        results: List[Any] = [None] * len(items)
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages]
+        started = [None] * len(self.stages)
+        finished = [None] * len(self.stages)
+
+        async def feed():
+            for index, item in enumerate(planned):
+                await queues[0].put((index, item))
+            for _ in range(self.stages[0].concurrency):
+                await queues[0].put(None)
+
+        async def work(position: int):
+            stage = self.stages[position]
+            while True:
+                entry = await queues[position].get()
+                if entry is None:
+                    return
+                index, item = entry
+                if not isinstance(item, Exception) and stage.name in item._run:
+                    start = time.perf_counter()
+                    if started[position] is None:
+                        started[position] = start
+                    try:
+                        await self._process(stage, item)
+                        stage.stats["items"] += 1
+                    except Exception as e:
+                        item = e
+                        stage.stats["errors"] += 1
+                    finished[position] = time.perf_counter()
+                    stage.stats["busy_s"] += finished[position] - start
+                elif not isinstance(item, Exception):
+                    try:
+                        await self._process(stage, item)
+                    except Exception as e:
+                        item = e
+                if position + 1 < len(self.stages):
+                    await queues[position + 1].put((index, item))
+                else:
+                    results[index] = item
+
+        async def run_stage(position: int):
+            await asyncio.gather(*(work(position) for _ in range(self.stages[position].concurrency)))
+            if position + 1 < len(self.stages):
+                for _ in range(self.stages[position + 1].concurrency):
+                    await queues[position + 1].put(None)
+
+        await asyncio.gather(feed(), *(run_stage(position) for position in range(len(self.stages))))
+        for stage, start, end in zip(self.stages, started, finished):
+            if start is not None:
+                stage.stats["active_s"] += end - start
+        return results
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """Stats of every stage, see Stage.report."""
+        return {stage.name: stage.report() for stage in self.stages}
+
+    def bottleneck(self) -> Optional[str]:
+        """The stage whose workers were busiest, more workers there would speed up the ingest most."""
+        reports = self.report()
+        busiest = max(reports, key=lambda name: reports[name]["utilization"], default=None)
+        return busiest if busiest is not None and reports[busiest]["utilization"] > 0 else None
+
+    def shutdown(self):
+        for stage in self.stages:
+            stage.shutdown()
@@ -0,0 +1,153 @@
+"""
+Module for a k-nearest-neighbor graph over the image library. Every image keeps a list of its
+K most similar images. The lists are maintained incrementally: a new image gets its list from a
+nearest neighbor search and is inserted into the lists of those neighbors it beats. Deleted images
+are filtered out when a list is read, and a list that lost too many entries is recomputed.
+Selecting an image next to placed ones then only has to score the merged neighbor lists of the
+placed images instead of the whole library.
+"""
+
+# Standard library imports
+import copy
+from pathlib import Path
+from typing import Callable, Collection, List, Tuple
+
+# External library imports
+import numpy as np
+
+###########################################################################################
+
+# Signature of the search used to build lists: (query, k, excluded rows) -> [(row, similarity)]
+SearchFunction = Callable[[np.ndarray, int, Collection[int]], List[Tuple[int, float]]]
+
+
+class KNNGraph:
+    """
+    Top-K neighbor lists of all rows of an embedding matrix.
+
+    Attributes:
+        k: Length of every neighbor list.
+        ids: Neighbor row ids per row, shape (rows, k), -1 for unused entries.
+        similarities: Cosine similarity per entry, -inf for unused entries.
+        deleted: Rows that were removed from the library.
+    """
+
+    def __init__(self, k: int = 32):
+        self.k = k
+        self.ids = np.full((0, k), -1, dtype=np.int32)
+        self.similarities = np.full((0, k), -np.inf, dtype=np.float32)
+        self.deleted = np.zeros(0, dtype=bool)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self, size: int):
+        if size <= len(self.ids):
+            return
+        capacity = max(size, 2 * len(self.ids), 64)
+        ids = np.full((capacity, self.k), -1, dtype=np.int32)
+        similarities = np.full((capacity, self.k), -np.inf, dtype=np.float32)
+        deleted = np.zeros(capacity, dtype=bool)
+        ids[:self._size] = self.ids[:self._size]
+        similarities[:self._size] = self.similarities[:self._size]
+        deleted[:self._size] = self.deleted[:self._size]
+        self.ids, self.similarities, self.deleted = ids, similarities, deleted
+
+    def _set_list(self, row: int, neighbors: List[Tuple[int, float]]):
+        neighbors = neighbors[:self.k]
+        self.ids[row] = -1
+        self.similarities[row] = -np.inf
+        for position, (neighbor, similarity) in enumerate(neighbors):
+            self.ids[row, position] = neighbor
+            self.similarities[row, position] = similarity
+
+    def _offer(self, row: int, neighbor: int, similarity: float):
+        """
+        Inserts neighbor into the list of row if it beats the weakest entry. If it is listed
+        already, e.g. because its embedding was replaced, its similarity is updated instead.
+        The list stays sorted, most similar first.
+        """
+        if self.deleted[row]:
+            return
+        listed = np.flatnonzero(self.ids[row] == neighbor)
+        if len(listed):
+            self.similarities[row, listed[0]] = similarity
+        else:
+            weakest = int(np.argmin(self.similarities[row]))
+            if similarity <= self.similarities[row, weakest]:
+                return
+            self.ids[row, weakest] = neighbor
+            self.similarities[row, weakest] = similarity
+        order = np.argsort(-self.similarities[row], kind="stable")
+        self.ids[row] = self.ids[row, order]
+        self.similarities[row] = self.similarities[row, order]
+
+    def add(self, matrix: np.ndarray, rows: Collection[int], search: SearchFunction):
+        """
+        Builds the lists of new (or changed) rows and offers them to their neighbors' lists.
+
+        Parameters:
+            matrix (np.ndarray): The L2-normalized embedding matrix.
+            rows: Row ids to (re)build.
+            search: Nearest neighbor search over the library.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        self._grow(max(rows) + 1)
+        self._size = max(self._size, max(rows) + 1)
+        for row in rows:
+            self.deleted[row] = False
+            neighbors = search(np.asarray(matrix[row], dtype=np.float32), self.k, [row])
+            self._set_list(row, neighbors)
+            # Similarity is symmetric, so row is a candidate for the lists of its own neighbors
+            for neighbor, similarity in neighbors:
+                self._offer(neighbor, row, similarity)
+
+    def copy(self) -> "KNNGraph":
+        """A copy whose lists can be changed without affecting this graph."""
+        graph = copy.copy(self)
+        graph.ids = self.ids.copy()
+        graph.similarities = self.similarities.copy()
+        graph.deleted = self.deleted.copy()
+        return graph
+
+    def remove(self, row: int):
+        """Marks a row as deleted, it is dropped from other lists when they are read."""
+        self.deleted[row] = True
+        self.ids[row] = -1
+        self.similarities[row] = -np.inf
+
+    def neighbors(self, row: int, matrix: np.ndarray = None, search: SearchFunction = None) -> np.ndarray:
+        """
+        Returns the live neighbor row ids of a row. If matrix and search are given and the list
+        lost more than half of its entries to deletions, it is recomputed first.
+        """
+        ids = self.ids[row]
+        live = ids[(ids >= 0)]
+        live = live[~self.deleted[live]]
+        if len(live) < self.k // 2 and matrix is not None and search is not None:
+            self._set_list(row, search(np.asarray(matrix[row], dtype=np.float32), self.k, [row]))
+            ids = self.ids[row]
+            live = ids[(ids >= 0)]
+            live = live[~self.deleted[live]]
+        return live
+
+    def save(self, path: Path):
+        """Writes the graph to an .npz file."""
+        np.savez(path, ids=self.ids[:self._size], similarities=self.similarities[:self._size],
+                 deleted=self.deleted[:self._size])
+
+    def load(self, path: Path):
+        """Reads a graph written by save."""
+        with np.load(path) as data:
+            self.set_arrays(data["ids"], data["similarities"], data["deleted"])
+
+    def set_arrays(self, ids: np.ndarray, similarities: np.ndarray, deleted: np.ndarray):
+        """Uses the given lists, e.g. read from a file or views of shared memory."""
+        self.ids = ids
+        self.similarities = similarities
+        self.deleted = deleted
+        self.k = self.ids.shape[1]
+        self._size = len(self.ids)
@@ -1,44 +1,218 @@
 from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from fastapi.staticfiles import StaticFiles
-from PIL import Image, ImageOps, ImageEnhance
-from typing import Any, Dict, List, Tuple
+from PIL import Image, ImageOps
+from typing import Any, Dict, List, Optional, Set, Tuple
 from fastapi.responses import JSONResponse
 from itertools import chain
-from promptProcessing import find_image_according_to_prompt
+from collections import deque
+from promptProcessing import find_image_according_to_prompt, encode_prompt_batched
+from embeddingStore import EmbeddingStore
+from annIndex import IVFIndex
+from assignmentSolver import solve_assignment
+from collageOptimizer import optimize_arrangement
+from embeddingLayout import project_to_2d, layout_on_slots
+from slotFrontier import SlotFrontier
+from slotGraph import SlotGraph
+from collageState import (CollageState, CollageStore, DEFAULT_SESSION, COLLAGE_TTL_S, MAX_COLLAGES,
+                          MAX_EXCLUSIONS_PER_SLOT, collage_key)
+from stateBackend import create_state_backend
+from sharedEmbeddings import SharedEmbeddings
+from clipModel import ClipEncoder, active_encoder, load_encoder, use_encoder, preprocess, encode_images, encode_texts
+from embeddingNamespace import ActiveNamespace, EmbeddingNamespace, migrate_legacy_store
+from reencodeJob import JobLock, ReencodeJob
+from encoderBatcher import EncoderBatcher
+from imagePreparation import prepare_image, thumbnail_image, thumbnail_name, write_thumbnail
+from ingestPipeline import IngestItem, IngestPipeline, Stage
+from ingestCache import IngestCache, content_hash, write_atomically
 
 import uvicorn
+import asyncio
 import os
 import numpy as np
 import face_recognition
 import shutil
-import clip
 import time
 import torch
 import json
 import uuid
-import cv2
+import io
+import threading
+from functools import partial
 
 app = FastAPI()
 
-components_data: Dict[str, List[List[Dict[str, Any]]]] = {}
+# Collages idle for COLLAGE_TTL_S seconds are evicted, as are the least recently used ones beyond MAX_COLLAGES.
+# Every slot remembers the last MAX_EXCLUSIONS_PER_SLOT images rejected for it.
+COLLAGE_TTL_S = float(os.environ.get("COLLAGE_TTL_S", COLLAGE_TTL_S))
+MAX_COLLAGES = int(os.environ.get("MAX_COLLAGES", MAX_COLLAGES))
+MAX_EXCLUSIONS_PER_SLOT = int(os.environ.get("MAX_EXCLUSIONS_PER_SLOT", MAX_EXCLUSIONS_PER_SLOT))
+EVICTION_INTERVAL_S = 60
+
+# State of every collage per session and component, see collageState.py
+collages = CollageStore(ttl_s=COLLAGE_TTL_S, max_collages=MAX_COLLAGES, max_exclusions_per_slot=MAX_EXCLUSIONS_PER_SLOT)
+
+# Where collages and the image catalog are shared between worker processes, see stateBackend.py:
+# "memory" only allows a single worker, "sqlite" lets WORKERS processes share the database STATE_DB.
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_DB = Path(os.environ.get("STATE_DB", "collage_state.db"))
+WORKERS = int(os.environ.get("WORKERS", "1"))
+state_backend = create_state_backend(STATE_BACKEND, STATE_DB)
+
+# How often a worker checks whether other workers changed a collage it has subscribers for
+REMOTE_SYNC_INTERVAL_S = 0.5
+
+# Concurrent encode requests are batched: up to ENCODER_MAX_BATCH inputs per forward pass, the first
+# input waits at most ENCODER_MAX_WAIT_MS for others, see encoderBatcher.py
+ENCODER_MAX_BATCH = int(os.environ.get("ENCODER_MAX_BATCH", "32"))
+ENCODER_MAX_WAIT_MS = float(os.environ.get("ENCODER_MAX_WAIT_MS", "5"))
+image_encoder = EncoderBatcher(encode_images, ENCODER_MAX_BATCH, ENCODER_MAX_WAIT_MS / 1000)
+text_encoder = EncoderBatcher(encode_texts, ENCODER_MAX_BATCH, ENCODER_MAX_WAIT_MS / 1000)
 
 image_selection_mode = "similarity" # "See ImageSelectionModes in MainComponent.vue"
 
-# Initialize the CLIP model
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("RN50", device=device)
-
 # Ensure the 'uploaded_images' directory exists before mounting
 UPLOAD_DIR = Path("uploaded_images")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-# Clean up any existing files in the directory (optional)
-for file in UPLOAD_DIR.iterdir():
-    if file.is_file():
-        file.unlink()
+# Small previews of the uploaded images, served below /uploaded_images/thumbnails
+THUMBNAIL_DIR = UPLOAD_DIR / "thumbnails"
+THUMBNAIL_DIR.mkdir(exist_ok=True)
+THUMBNAIL_SIZE = (78, 78)  # Same size the grid components display the images in
+
+# One embedding store per CLIP model, inference backend and image preparation, see embeddingNamespace.py
+EMBEDDINGS_DIR = UPLOAD_DIR / "embeddings"
+
+# The uploads as they were received, the ingest derives everything else from them (see ingestPipeline.py)
+ORIGINALS_DIR = UPLOAD_DIR / "originals"
+
+# Results of the ingest stages, see ingestCache.py
+INGEST_CACHE_DIR = UPLOAD_DIR / "ingest_cache"
+
+# Clean up any existing files in the directory (optional).
+# A shared state backend outlives the workers, its collages still reference the uploaded images.
+if not state_backend.shared:
+    for file in UPLOAD_DIR.iterdir():
+        if file.is_file():
+            file.unlink()
+    for file in THUMBNAIL_DIR.iterdir():
+        if file.is_file():
+            file.unlink()
+    shutil.rmtree(EMBEDDINGS_DIR, ignore_errors=True)
+    shutil.rmtree(ORIGINALS_DIR, ignore_errors=True)
+    shutil.rmtree(INGEST_CACHE_DIR, ignore_errors=True)
+EMBEDDINGS_DIR.mkdir(exist_ok=True)
+ORIGINALS_DIR.mkdir(exist_ok=True)
+
+# Precision of the in-memory embedding copy: "float32", "float16" (2x smaller) or "int8" (4x smaller).
+# Top results are always re-ranked against the full-precision memory-mapped file.
+EMBEDDING_PRECISION = os.environ.get("EMBEDDING_PRECISION", "float16")
+
+# Name prefix of the shared memory segments the embedding store is published in, see sharedEmbeddings.py.
+# Empty keeps a private copy of the store in every worker.
+SHARED_EMBEDDINGS = os.environ.get("SHARED_EMBEDDINGS", "")
+shared_embeddings = SharedEmbeddings(SHARED_EMBEDDINGS) if SHARED_EMBEDDINGS else None
+
+# New embeddings belong to the namespace of the configured model and backend (CLIP_MODEL, CLIP_BACKEND).
+# Until the library is re-encoded into it, the namespace named by active.json keeps serving.
+target_namespace = EmbeddingNamespace(active_encoder().model_name, active_encoder().backend)
+active_namespace = ActiveNamespace(EMBEDDINGS_DIR / "active.json")
+serving_namespace = target_namespace
+
+# Job re-encoding the library into the target namespace, None unless this worker runs it
+reencode_job: Optional[ReencodeJob] = None
+
+# How often workers that do not run the re-encode job check whether the worker running it died
+REENCODE_RETRY_S = 30
+
+
+def activate_namespace(namespace: EmbeddingNamespace):
+    """Serves the embeddings of namespace from now on, requests are encoded with its encoder."""
+    global serving_namespace
+    use_encoder(load_encoder(namespace.model_name, namespace.backend))
+    serving_namespace = namespace
+    print(f"Serving the embeddings of namespace {namespace}, new embeddings go to {target_namespace}.")
+
+
+with state_backend.catalog_lock():
+    # Stores written before there were namespaces lie in the upload directory and hold RN50 embeddings
+    legacy_namespace = EmbeddingNamespace("RN50", "eager")
+    if (migrate_legacy_store(EmbeddingStore(UPLOAD_DIR).files(), EMBEDDINGS_DIR / legacy_namespace.name)
+            and active_namespace.get() is None):
+        active_namespace.set(legacy_namespace)
+    if active_namespace.get() is None:
+        active_namespace.set(target_namespace)
+activate_namespace(active_namespace.get())
+
+
+def create_index() -> IVFIndex:
+    """
+    Index knobs: probing more lists gives better recall but slower queries,
+    libraries below min_train_size are always searched exactly.
+    """
+    return IVFIndex(nprobe=8, min_train_size=4096)
+
+
+def load_embedding_store(namespace: Optional[EmbeddingNamespace] = None) -> EmbeddingStore:
+    """
+    CLIP embeddings of all uploaded images as one matrix, loaded from the directory of the
+    namespace, the serving one by default.
+    """
+    namespace = namespace or serving_namespace
+    encoder = load_encoder(namespace.model_name, namespace.backend)
+    store = EmbeddingStore(namespace.directory(EMBEDDINGS_DIR), create_index(), precision=EMBEDDING_PRECISION,
+                           encoder=encoder.id)
+    store.load()
+    return store
+
+
+def attach_embedding_store(writable: bool = False) -> Optional[EmbeddingStore]:
+    """
+    The embedding store of the generation published in shared memory, None if there is none.
+    Read-only unless writable, which copies it.
+    """
+    generation = shared_embeddings.attach()
+    if generation is None:
+        return None
+    # A generation of another namespace means the re-encode job switched namespaces
+    namespace = generation.metadata.get("namespace")
+    if namespace is not None and EmbeddingNamespace.from_dict(namespace) != serving_namespace:
+        activate_namespace(EmbeddingNamespace.from_dict(namespace))
+    return EmbeddingStore.from_shared(serving_namespace.directory(EMBEDDINGS_DIR), generation.arrays,
+                                      generation.metadata, create_index(), writable=writable,
+                                      encoder=active_encoder().id)
+
+
+def publish_embedding_store(store: EmbeddingStore, namespace: EmbeddingNamespace):
+    """Publishes the store as the new shared generation, tagged with its namespace."""
+    arrays, metadata = store.export()
+    metadata["namespace"] = namespace.to_dict()
+    shared_embeddings.publish(arrays, metadata)
+
+
+def open_embedding_store() -> EmbeddingStore:
+    """
+    Loads the embedding store. With shared embeddings only the first worker loads it from disk and
+    publishes it, the others attach to it. A single worker always publishes what it loaded, segments
+    left behind by an earlier run may not match the upload directory anymore.
+    """
+    if shared_embeddings is None:
+        return load_embedding_store()
+    with state_backend.catalog_lock():
+        store = attach_embedding_store() if state_backend.shared else None
+        if store is None:
+            publish_embedding_store(load_embedding_store(), serving_namespace)
+            store = attach_embedding_store()
+    return store
+
+
+embedding_store = open_embedding_store()
+
+# Catalog version and shared generation the embedding store was loaded at, see refresh_catalog
+catalog_version = state_backend.catalog_version()
+embedding_generation = shared_embeddings.generation() if shared_embeddings is not None else 0
 
 # Mount static files
 app.mount("/uploaded_images", StaticFiles(directory=str(UPLOAD_DIR)), name="uploaded_images")
@@ -52,9 +226,70 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
-for file in UPLOAD_DIR.iterdir():
-    if file.is_file():
-        file.unlink()
+if not state_backend.shared:
+    for file in UPLOAD_DIR.iterdir():
+        if file.is_file():
+            file.unlink()
+
+
+# Serializes changes to the embedding store of this worker, they run in worker threads. Changes are
+# made to a copy that replaces embedding_store in one assignment, readers never see a half-updated
+# store and do not take the lock. Code running in a thread binds the store once, see rank_candidates.
+embedding_store_lock = threading.RLock()
+
+
+def refresh_catalog():
+    """
+    Switches to the embeddings of the newest catalog if another worker added images since the
+    store was loaded or switched namespaces. Shared embeddings only need to attach to the new
+    generation, otherwise the rows appended since the store was read are loaded into a copy; only a namespace
+    switch or rewritten store files reload it completely. Blocks, async code runs it in a thread.
+    """
+    with embedding_store_lock:
+        _refresh_catalog()
+
+
+def _refresh_catalog():
+    global embedding_store, catalog_version, embedding_generation
+    switched = False
+    namespace = active_namespace.get()
+    if shared_embeddings is None and namespace is not None and namespace != serving_namespace:
+        activate_namespace(namespace)
+        switched = True
+    if shared_embeddings is not None:
+        generation = shared_embeddings.generation()
+        if generation == embedding_generation:
+            return
+        store = attach_embedding_store()
+        if store is None:
+            return
+        embedding_generation = generation
+    else:
+        current_version = state_backend.catalog_version()
+        if current_version == catalog_version and not switched:
+            return
+        if not switched:
+            # Requests keep searching the current store while the copy catches up
+            store = embedding_store.copy()
+            if store.refresh():
+                catalog_version = current_version
+                embedding_store = store
+                print(f"Caught up to {len(store)} embeddings of catalog version {catalog_version}.")
+                return
+        store = load_embedding_store()
+        catalog_version = current_version
+    # Keep the version increasing, candidate caches are keyed by it
+    store.version += embedding_store.version
+    embedding_store = store
+    print(f"Switched to {len(store)} embeddings of catalog version {catalog_version}, "
+          f"generation {embedding_generation}.")
+
+
+@app.middleware("http")
+async def sync_catalog(request, call_next):
+    if state_backend.shared or shared_embeddings is not None:
+        await asyncio.to_thread(refresh_catalog)
+    return await call_next(request)
 
 
 class Base64Image(BaseModel):
@@ -62,25 +297,36 @@ class Base64Image(BaseModel):
     content: str
 
 
-def create_collage_from_components(component_name: str, target_size: Tuple[int, int] = (200, 200)) -> Image:
+class CellUpdate(BaseModel):
+    fileName: Optional[str] = None  # None clears the cell
+    version: int  # Version of the component the client last saw
+    user_prompt: Optional[str] = None
+
+
+class ReshuffleRequest(BaseModel):
+    cell_ids: Optional[List[int]] = None  # None re-rolls every cell placed by the AI
+    version: Optional[int] = None  # Checked against the component version if given
+
+
+def create_collage_from_components(collage: CollageState, target_size: Tuple[int, int] = (200, 200)) -> Image:
     """
-    Creates a collage image from the components data based on the specified component name.
+    Creates a collage image from the grid of the given collage.
     Ensures all images are resized to the target size before placing them in the collage.
     Empty slots will be filled with a placeholder image.
 
     Args:
-        component_name: The name of the component to generate the collage for.
+        collage: The collage to generate the image for.
         target_size: The desired size (width, height) to which all images will be resized.
 
     Returns:
         A PIL Image object representing the collage.
     """
-    # Check if the component exists in components_data
-    if component_name not in components_data:
-        raise ValueError(f"Component {component_name} not found.")
+    # Check if the collage has a grid
+    if not collage.data:
+        raise ValueError(f"Component {collage.component_name} not found.")
 
     # Retrieve the 2D array of data (this contains the image file paths)
-    component_data = components_data[component_name]
+    component_data = collage.data
 
     # Determine the size of the collage
     rows = len(component_data)
@@ -114,89 +360,143 @@ def create_collage_from_components(component_name: str, target_size: Tuple[int,
     return collage
 
 
-def resize_image_keep_aspect(image_path):
+def create_thumbnail(file_name: str) -> str:
     """
-    Sharpens images using laplace filter.
-    Applies sharpening with OpenCV and Floyd-Steinberg dithering (if PNG).
+    Creates a small preview of an uploaded image, so clients do not have to download and rescale
+    the full image for every grid slot.
 
     Parameters:
-        image_path (str): Path to the input image file (the file will be overwritten).
-    """
-    target_size = (600, 600)
-    upscale_factor = 8
-    highres_size = (target_size[0] * upscale_factor, target_size[1] * upscale_factor)
+        file_name (str): Name of the image inside UPLOAD_DIR.
 
-    img = Image.open(image_path).convert("RGB")
-    img_large = img.resize(highres_size, Image.Resampling.LANCZOS)
-
-    # Using Laplacian filter to sharpen images
-    img_cv = np.array(img_large)
-    sharp = cv2.Laplacian(img_cv, cv2.CV_64F)
-    img_cv = cv2.convertScaleAbs(img_cv + sharp)
-
-    # Converting from cv2 array to PIL
-    img_sharp = Image.fromarray(img_cv)
-    enhancer = ImageEnhance.Sharpness(img_sharp)
-    img_sharp = enhancer.enhance(2.0)
-
-    # Downscaling image
-    img_final = img_sharp.resize(target_size, Image.Resampling.LANCZOS)
-
-    # Using dithering on pngs.
-    if image_path.lower().endswith(".png"):
-        img_final = img_final.convert("P", dither=Image.Dither.FLOYDSTEINBERG)
+    Returns:
+        str: URL path of the thumbnail.
+    """
+    thumbnail_path = THUMBNAIL_DIR / thumbnail_name(file_name)
+    if not (UPLOAD_DIR / file_name).exists():
+        return f"/uploaded_images/{file_name}"
+    if not thumbnail_path.exists():
+        write_thumbnail(UPLOAD_DIR / file_name, thumbnail_path, THUMBNAIL_SIZE)
+    return f"/uploaded_images/thumbnails/{thumbnail_path.name}"
 
-    # Saving jpegs in RGB
-    if image_path.lower().endswith((".jpg", ".jpeg")):
-        img_final = img_final.convert("RGB")
 
-    img_final.save(image_path)
+def save_original(file: UploadFile, file_name: str) -> IngestItem:
+    """Writes an upload to ORIGINALS_DIR, its content hash keys the cached results of its ingest."""
+    original_path = ORIGINALS_DIR / file_name
+    with open(original_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+    return IngestItem(file_name, {"name": file_name, "original": original_path},
+                      {"name": file_name, "original": content_hash(original_path)})
 
 
-@app.post("/saveImages")
-async def saveImages(files: List[UploadFile] = File(...)):
+def store_image(file_name: str, prepared: bytes, thumbnail: bytes) -> bool:
     """
-    Save the uploaded images to the server and encode them using the CLIP model
-    and saves them into the 'encoded_images.json' file.
+    Store stage of the ingest: writes the prepared image and its thumbnail where they are served.
+    Each file is replaced in one rename, clients never load a partially written one.
     """
-    try:
-        saved_files = []
-        encoded_images = {}
+    write_atomically(UPLOAD_DIR / file_name, prepared)
+    write_atomically(THUMBNAIL_DIR / thumbnail_name(file_name), thumbnail)
+    return True
 
-        for file in files:
-            file_extension = file.filename.split('.')[-1]
-            random_filename = f"{uuid.uuid4()}.{file_extension}"
-            file_path = os.path.join(UPLOAD_DIR, random_filename)
 
-            # print(f"Saving file: {file.filename} as {random_filename}")
+def preprocess_image(prepared: bytes) -> torch.Tensor:
+    """Preprocess stage of the ingest: the input of the image encoder for a prepared image."""
+    with Image.open(io.BytesIO(prepared)) as image:
+        return preprocess(image)
 
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
 
-            resize_image_keep_aspect(file_path)
+# Workers of every ingest stage. Preparing (8x upscale and sharpening) is by far the most expensive
+# step, it runs in INGEST_PREPARE_WORKERS processes once serve.py started the fork server of the
+# worker, otherwise in as many threads. The embed stage keeps enough images in flight to fill the
+# batches of the image encoder.
+INGEST_PREPARE_WORKERS = int(os.environ.get("INGEST_PREPARE_WORKERS", max(1, min(4, (os.cpu_count() or 1) // WORKERS))))
+INGEST_PREPROCESS_WORKERS = int(os.environ.get("INGEST_PREPROCESS_WORKERS", "2"))
 
-            # Load and preprocess the image
-            image = Image.open(file_path)
-            image_tensor = preprocess(image).unsqueeze(0).to(device)
+# The ingest graph. Bump the version of a stage when its function changes, backfill_ingest then
+# reruns it (and the stages reading its outputs) for the library. Embeddings are not cached here,
+# they are kept per namespace by the embedding stores: bump PREPROCESS_VERSION in
+# embeddingNamespace.py together with the prepare or preprocess stage to re-encode the library.
+ingest_cache = IngestCache(INGEST_CACHE_DIR)
+ingest_pipeline = IngestPipeline([
+    Stage("prepare", prepare_image, ["original"], ["prepared"], version=1,
+          kind="process", concurrency=INGEST_PREPARE_WORKERS),
+    Stage("thumbnail", partial(thumbnail_image, size=THUMBNAIL_SIZE), ["prepared"], ["thumbnail"], version=1),
+    Stage("store", store_image, ["name", "prepared", "thumbnail"], ["stored"], version=1, concurrency=2),
+    Stage("preprocess", preprocess_image, ["prepared"], ["clip_input"], cache=False,
+          concurrency=INGEST_PREPROCESS_WORKERS),
+    Stage("embed", image_encoder.submit, ["clip_input"], ["embedding"], cache=False,
+          kind="async", concurrency=ENCODER_MAX_BATCH),
+], ingest_cache)
 
-            # print(f"Image preprocessed for: {random_filename}")
 
-            # Encode the image using the CLIP model
-            with torch.no_grad():
-                encoded_image = model.encode_image(image_tensor).cpu().numpy()
+@app.on_event("shutdown")
+def stop_ingest_pipeline():
+    ingest_pipeline.shutdown()
 
-            # print(f"Image encoded for: {random_filename}")
 
-            # Store the encoded information in the dictionary
-            encoded_images[random_filename] = encoded_image.tolist()
+def add_embeddings(encoded_images: List[Tuple[str, np.ndarray]], encoder: ClipEncoder):
+    """
+    Adds the embeddings of new uploads to the store and the catalog. Blocks, runs in a thread.
 
-            saved_files.append(file_path)
+    Parameters:
+        encoded_images: (file name, embedding) pairs.
+        encoder: The encoder the embeddings come from, they are encoded again if the namespace
+            switched meanwhile.
+    """
+    global embedding_store, catalog_version
+    # The embedding files are shared by all workers, only one of them may append at a time
+    with state_backend.catalog_lock(), embedding_store_lock:
+        refresh_catalog()
+        if active_encoder() is not encoder:
+            # The namespace switched meanwhile, the features do not fit its store
+            with torch.no_grad():
+                features = encode_images(torch.stack([preprocess(Image.open(UPLOAD_DIR / name))
+                                                      for name, _ in encoded_images]))
+            encoded_images = list(zip([name for name, _ in encoded_images], features.float().cpu().numpy()))
+        # The store is extended on a copy, requests keep searching the current one meanwhile. Shared
+        # embeddings are published as a new generation, a store of this worker only replaces the old one
+        store = attach_embedding_store(writable=True) if shared_embeddings is not None else embedding_store.copy()
+
+        # Store the encoded information in the embedding store
+        store.add_many(encoded_images)
+
+        # Save all encoded images (including earlier uploads) to a file
+        store.save()
+        if shared_embeddings is not None:
+            publish_embedding_store(store, serving_namespace)
+        else:
+            embedding_store = store
+        catalog_version = state_backend.add_images([name for name, _ in encoded_images])
 
-        # Save the encoded images dictionary to a file
-        with open(os.path.join(UPLOAD_DIR, "encoded_images.json"), "w") as f:
-            json.dump(encoded_images, f)
 
-        print("Encoded images saved to encoded_images.json")
+@app.post("/saveImages")
+async def saveImages(files: List[UploadFile] = File(...)):
+    """
+    Save the uploaded images to the server and encode them using the CLIP model
+    and saves them into the embedding store. The images pass the stages of the
+    ingest graph concurrently, see ingestPipeline.py.
+    """
+    try:
+        file_names = [f"{uuid.uuid4()}.{file.filename.split('.')[-1]}" for file in files]
+        items = await asyncio.gather(*(asyncio.to_thread(save_original, file, file_name)
+                                       for file, file_name in zip(files, file_names)))
+        saved_files = [os.path.join(UPLOAD_DIR, file_name) for file_name in file_names]
+
+        # Prepare, store, preprocess and encode, batched with concurrent uploads
+        encoder = active_encoder()
+        results = await ingest_pipeline.run(items)
+        print(f"Ingest stages: {ingest_pipeline.report()}, bottleneck: {ingest_pipeline.bottleneck()}")
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        for item in items:
+            ingest_cache.put_item_keys(item.name, {"original": item.keys["original"]})
+        encoded_images = [(item.name, item.values["embedding"]) for item in items]
+
+        # The catalog lock blocks while another worker adds images, it is waited for in a thread
+        await asyncio.to_thread(add_embeddings, encoded_images, encoder)
+        await asyncio.to_thread(refresh_catalog)
+
+        print(f"Encoded images saved, memory used by embeddings: {embedding_store.memory_usage()}")
 
         return {
             "message": "Images saved and encoded successfully",
@@ -233,65 +533,512 @@ async def get_images():
         return JSONResponse(status_code=500, content={"message": "Failed to retrieve images", "error": str(e)})
 
 
+async def evict_idle_collages():
+    """Periodically drops the collages nobody used for a while."""
+    while True:
+        await asyncio.sleep(EVICTION_INTERVAL_S)
+        for collage in collages.evict_idle():
+            for task in (collage.speculation_task, collage.remote_sync_task):
+                if task is not None and not task.done():
+                    task.cancel()
+            print(f"Evicted idle collage {collage.collage_id}")
+        purged = state_backend.purge_collages(COLLAGE_TTL_S)
+        if purged:
+            print(f"Purged {purged} idle collages from the state backend")
+
+
+@app.on_event("startup")
+async def start_collage_eviction():
+    asyncio.create_task(evict_idle_collages())
+
+
+def switch_namespace(job: ReencodeJob):
+    """
+    Makes the namespace the job filled the serving one for all workers. Called under the catalog
+    lock, once the job encoded every image of the serving store.
+    """
+    job.finish(embedding_store.image_names())
+    if shared_embeddings is not None:
+        publish_embedding_store(job.store, target_namespace)
+    active_namespace.set(target_namespace)
+    refresh_catalog()
+
+
+def try_switch_namespace(job: ReencodeJob) -> bool:
+    """
+    Switches namespaces if the job encoded every image. Uploads are added under the catalog lock,
+    while it is held no image can be missed. Blocks, runs in a thread.
+    """
+    with state_backend.catalog_lock():
+        refresh_catalog()
+        if job.remaining(embedding_store.image_names()):
+            return False
+        switch_namespace(job)
+        return True
+
+
+async def reencode_embeddings():
+    """
+    Re-encodes the library into the target namespace while the serving one keeps answering
+    requests, then switches over. One worker runs the job, the others retry now and then in case
+    it dies and pick up the switch in refresh_catalog.
+    """
+    global reencode_job
+    lock = JobLock(EMBEDDINGS_DIR / "reencode.lock")
+    while not lock.acquire():
+        await asyncio.sleep(REENCODE_RETRY_S)
+        await asyncio.to_thread(refresh_catalog)
+        if serving_namespace == target_namespace:
+            return
+    try:
+        # The worker that held the lock may have finished the job
+        await asyncio.to_thread(refresh_catalog)
+        if serving_namespace == target_namespace:
+            return
+        encoder = load_encoder(target_namespace.model_name, target_namespace.backend)
+        store = await asyncio.to_thread(load_embedding_store, target_namespace)
+        reencode_job = ReencodeJob(store, encoder, UPLOAD_DIR)
+        print(f"Re-encoding {len(embedding_store)} images into namespace {target_namespace}, "
+              f"{len(store)} of them are encoded already.")
+        while True:
+            remaining = reencode_job.remaining(embedding_store.image_names())
+            if remaining:
+                await asyncio.to_thread(reencode_job.encode_batch, remaining[:reencode_job.batch_size])
+                await asyncio.to_thread(refresh_catalog)
+                continue
+            if await asyncio.to_thread(try_switch_namespace, reencode_job):
+                return
+    finally:
+        lock.release()
+
+
+@app.on_event("startup")
+async def start_reencode():
+    if serving_namespace != target_namespace:
+        asyncio.create_task(reencode_embeddings())
+
+
+# Images passed through the ingest graph at once while the library is brought up to date
+BACKFILL_CHUNK = 64
+
+
+def library_item(file_name: str) -> Optional[IngestItem]:
+    """
+    The sources of an image of the library for backfill_ingest, None if its files are gone. Its
+    embedding is given, embeddings are brought up to date by the re-encode job.
+    """
+    keys = ingest_cache.item_keys(file_name)
+    if keys is None:
+        if not (UPLOAD_DIR / file_name).exists():
+            return None
+        # Uploaded before the originals were kept: the prepared image stands in for the prepare stage,
+        # which cannot run again for it
+        keys = {"prepared": content_hash(UPLOAD_DIR / file_name)}
+        ingest_cache.put_item_keys(file_name, keys)
+    values = {"name": file_name, "embedding": embedding_store.get_raw(file_name)}
+    if "original" in keys:
+        values["original"] = ORIGINALS_DIR / file_name
+    else:
+        values["prepared"] = (UPLOAD_DIR / file_name).read_bytes()
+    return IngestItem(file_name, values, dict(keys, name=file_name))
+
+
+async def backfill_ingest():
+    """
+    Brings the library up to date with the ingest graph after a stage was added or its version
+    bumped. Only the stages whose results are not cached for the new graph run, everything else
+    is read from the cache. One worker runs it, it is skipped while the graph is unchanged.
+    """
+    signature = ingest_pipeline.signature()
+    if ingest_cache.signature() == signature:
+        return
+    lock = JobLock(INGEST_CACHE_DIR / "backfill.lock")
+    if not lock.acquire():
+        return
+    try:
+        names = embedding_store.image_names()
+        failed = 0
+        for start in range(0, len(names), BACKFILL_CHUNK):
+            chunk = names[start:start + BACKFILL_CHUNK]
+            items = [item for item in await asyncio.to_thread(lambda: [library_item(name) for name in chunk])
+                     if item is not None]
+            for result in await ingest_pipeline.run(items):
+                if isinstance(result, Exception):
+                    print(f"Ingest backfill failed for an image: {result}")
+                    failed += 1
+        ingest_cache.set_signature(signature)
+        print(f"Ingest backfill of {len(names)} images done, {failed} failed: {ingest_pipeline.report()}")
+    finally:
+        lock.release()
+
+
+@app.on_event("startup")
+async def start_ingest_backfill():
+    asyncio.create_task(backfill_ingest())
+
+
+@app.get("/stats/memory")
+def memory_stats():
+    """Gauge of the memory held by the collage states and the embeddings."""
+    return {"collages": collages.memory_usage(), "embeddings": embedding_store.memory_usage()}
+
+
+@app.get("/stats/encoders")
+def encoder_stats():
+    """
+    Number of inputs and batches the batching encoders ran so far, the encoder they run on, how
+    many stored embeddings every encoder produced and the progress of a re-encode job.
+    """
+    return {"image": image_encoder.stats, "text": text_encoder.stats, "encoder": active_encoder().id,
+            "embeddings": embedding_store.encoder_counts(), "namespace": serving_namespace.name,
+            "target_namespace": target_namespace.name,
+            "reencode": reencode_job.progress if reencode_job is not None else None}
+
+
+@app.get("/stats/ingest")
+def ingest_stats():
+    """
+    Throughput, cache hits and utilization of every ingest stage, the busiest one limits the
+    ingest, and the stage versions of the graph and of the library, which differ during a backfill.
+    """
+    return {"stages": ingest_pipeline.report(), "bottleneck": ingest_pipeline.bottleneck(),
+            "graph": ingest_pipeline.signature(), "library_graph": ingest_cache.signature()}
+
+
 @app.get("/ping")
 def ping():
-    collage = create_collage_from_components("rectangleComponent", target_size=(200, 200))  # Specify desired size
+    rectangle = collages.get(DEFAULT_SESSION, "rectangleComponent")
+    if rectangle is None:
+        raise HTTPException(status_code=404, detail="Component not found")
+    collage = create_collage_from_components(rectangle, target_size=(200, 200))  # Specify desired size
     collage.show()  # Show the generated collage
     collage.save("collage_output.jpg")  # Save the collage to a file
     return {"message": "pong"}
 
 
 @app.post("/positions")
-async def receive_positions(positions: str = Form(...), componentName: str = Form(...), user_prompt: str = Form(...)):
+async def receive_positions(positions: str = Form(...), componentName: str = Form(...), user_prompt: str = Form(...),
+                            session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
     parsed_positions = json.loads(positions)
     if componentName in ("heartComponent", "cloudComponent", "rectangleComponent", "triangleComponent"):
         array = group_elements_fixed_10x10(elements=parsed_positions, has_consistent_height=True)
     else:
         array = group_elements_fixed_10x10(elements=parsed_positions, has_consistent_height=False)
 
-    if user_prompt in ("", " ", None) or str(user_prompt) == "null":
-        print(f"No user prompt detected.")
-        add_component(component_name=componentName, data=array, prompt=None)
-    else:
-        print(f"User prompt detected: {user_prompt}")
-        add_component(component_name=componentName, data=array, prompt=user_prompt)
+    if user_prompt not in ("", " ", None) and str(user_prompt) != "null":
+        # Encoded before the lock is taken, together with the prompts of concurrent requests
+        await encode_prompt_batched(user_prompt, text_encoder)
+
+    collage = collages.get_or_create(session_id, componentName)
+    async with collage.lock:
+        base_version = await sync_collage(collage)
+        collage.slot_coordinates = {el['id']: (el['left'], el['top']) for el in parsed_positions}
+        if user_prompt in ("", " ", None) or str(user_prompt) == "null":
+            print(f"No user prompt detected.")
+            changed_positions = add_component(collage=collage, data=array, prompt=None)
+        else:
+            print(f"User prompt detected: {user_prompt}")
+            changed_positions = add_component(collage=collage, data=array, prompt=user_prompt)
+
+        await commit_collage(collage, base_version)
+        schedule_speculation(collage, changed_positions)
+        await broadcast_cells(collage, changed_positions)
+        return {"message": "Data received successfully", "version": collage.version}
 
-    return {"message": "Data received successfully"}
+@app.patch("/components/{component_name}/cells/{cell_id}")
+async def update_cell(component_name: str, cell_id: int, update: CellUpdate,
+                      session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
+    """
+    Updates a single cell of an already known component instead of resending the whole grid.
+    The client has to send the version it last saw. If the component changed in the meantime,
+    a 409 is returned and the client has to resynchronize via /positions.
+
+    Returns:
+        The new version and every cell that changed (the updated one and the AI placement, if any).
+    """
+    collage = await find_collage(session_id, component_name)
+    if collage is None:
+        raise HTTPException(status_code=404, detail="Cell not found")
+    if update.fileName and update.user_prompt not in (None, "", " ") and str(update.user_prompt) != "null":
+        # Encoded before the lock is taken, together with the prompts of concurrent requests
+        await encode_prompt_batched(update.user_prompt, text_encoder)
+
+    async with collage.lock:
+        base_version = await sync_collage(collage)
+        if cell_id not in collage.cell_index:
+            raise HTTPException(status_code=404, detail="Cell not found")
+        if update.version != collage.version:
+            raise HTTPException(status_code=409, detail={"message": "Version conflict", "version": collage.version})
+
+        row_idx, col_idx = collage.cell_index[cell_id]
+        image_name = update.fileName if update.fileName else '[]'
+        set_cell_image(collage, row_idx, col_idx, image_name)
+        collage.ai_placed.discard(cell_id)
+        changed_positions = [(row_idx, col_idx)]
+
+        # Only a placement by the user triggers an answer by the AI
+        if image_name != '[]':
+            prompt = update.user_prompt
+            if prompt in ("", " ") or str(prompt) == "null":
+                prompt = None
+            ai_position = respond_to_placement(collage, row_idx, col_idx, prompt)
+            if ai_position is not None:
+                changed_positions.append(ai_position)
+
+        collage.version += 1
+        await commit_collage(collage, base_version)
+        schedule_speculation(collage, changed_positions)
+        await broadcast_cells(collage, changed_positions)
+        return {
+            "version": collage.version,
+            "cells": [cell_to_dict(collage.data[r][c]) for r, c in changed_positions],
+        }
+
+@app.websocket("/ws/components/{component_name}")
+async def component_updates(websocket: WebSocket, component_name: str, session_id: str = DEFAULT_SESSION):
+    """
+    Pushes the cells that changed in the given component, so clients do not have to
+    poll /getArray and refetch the whole grid after every interaction.
+    Browsers cannot set headers on WebSockets, the session id is a query parameter here.
+    """
+    await websocket.accept()
+    collage = collages.get_or_create(session_id, component_name)
+    collage.subscribers.add(websocket)
+    task = collage.remote_sync_task
+    if state_backend.shared and (task is None or task.done()):
+        collage.remote_sync_task = asyncio.create_task(push_remote_changes(collage))
+    try:
+        while True:
+            # Clients do not send anything, this only waits for the disconnect
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        collage.subscribers.discard(websocket)
 
 @app.post("/new_selection")
-async def new_selection(component_name: str = Form(...), target_id: int = Form(...)):
+async def new_selection(component_name: str = Form(...), target_id: int = Form(...),
+                        session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
     """
     Sets new selection for the specified component and target_id.
     """
-    data = components_data[component_name]
-    row_idx, col_idx, _ = find_tuple_by_id(data, target_id)
+    collage = await find_collage(session_id, component_name)
+    if collage is None:
+        raise HTTPException(status_code=404, detail="Cell not found")
+
+    async with collage.lock:
+        base_version = await sync_collage(collage)
+        if target_id not in collage.cell_index:
+            raise HTTPException(status_code=404, detail="Cell not found")
+        row_idx, col_idx = collage.cell_index[target_id]
+
+        # Get the previously selected image
+        previous_image = collage.data[row_idx][col_idx][1]
+
+        # Mark the current position as empty
+        set_cell_image(collage, row_idx, col_idx, '[]')
+
+        collage.version += 1
+
+        # Select a new image, excluding the previous one
+        result = select_and_update_image(collage, row_idx, col_idx, exclude_image=previous_image)
+        if result and result[0] is not None:
+            most_similar_image, best_score, _ = result
+            update_component_data(collage, row_idx, col_idx, most_similar_image, best_score)
+
+        await commit_collage(collage, base_version)
+        schedule_speculation(collage, [(row_idx, col_idx)])
+        await broadcast_cells(collage, [(row_idx, col_idx)])
+        if not result:
+            return {"message": "No suitable image found"}
+        if result[0] is None:
+            return {"message": "No image found within the time budget", "version": collage.version, "partial": True}
+        return {"message": "Data received successfully", "version": collage.version, "partial": result[2]}
+
+@app.post("/autofill/{component_name}")
+async def autofill(component_name: str, session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
+    """
+    Fills every free slot of the component at once. Builds a slots x candidates score matrix from
+    the neighbor embeddings of every free slot and solves the assignment globally, so every image
+    is used at most once.
+
+    Returns:
+        The new version and every cell that was filled.
+    """
+    collage = await find_collage(session_id, component_name)
+    if collage is None:
+        raise HTTPException(status_code=404, detail="Component not found")
+
+    async with collage.lock:
+        base_version = await sync_collage(collage)
+        if not collage.cell_index:
+            raise HTTPException(status_code=404, detail="Component not found")
+        filled_positions = autofill_component(collage)
+        collage.version += 1
+        await commit_collage(collage, base_version)
+        schedule_speculation(collage, filled_positions)
+        await broadcast_cells(collage, filled_positions)
+        return {
+            "version": collage.version,
+            "cells": [cell_to_dict(collage.data[r][c]) for r, c in filled_positions],
+        }
+
+@app.post("/reshuffle/{component_name}")
+async def reshuffle(component_name: str, request: ReshuffleRequest,
+                    session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
+    """
+    Re-rolls several slots in one request instead of one /new_selection per slot. All slots are
+    scored against the library at once and no image is placed twice.
+
+    Returns:
+        The new version and every cell that changed.
+    """
+    collage = await find_collage(session_id, component_name)
+    if collage is None:
+        raise HTTPException(status_code=404, detail="Component not found")
 
-    # Get the previously selected image
-    previous_image = components_data[component_name][row_idx][col_idx][1]
+    async with collage.lock:
+        base_version = await sync_collage(collage)
+        if not collage.cell_index:
+            raise HTTPException(status_code=404, detail="Component not found")
+        if request.version is not None and request.version != collage.version:
+            raise HTTPException(status_code=409, detail={"message": "Version conflict", "version": collage.version})
+
+        changed_positions = reshuffle_component(collage, request.cell_ids)
+        collage.version += 1
+        await commit_collage(collage, base_version)
+        schedule_speculation(collage, changed_positions)
+        await broadcast_cells(collage, changed_positions)
+        return {
+            "version": collage.version,
+            "cells": [cell_to_dict(collage.data[r][c]) for r, c in changed_positions],
+        }
+
+# Largest annealing budget a client may ask for, each request occupies a worker thread that long
+OPTIMIZE_MAX_BUDGET_MS = int(os.environ.get("OPTIMIZE_MAX_BUDGET_MS", "5000"))
+
+
+@app.post("/optimize/{component_name}")
+async def optimize(component_name: str, budget_ms: int = Form(1000),
+                   session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
+    """
+    Improves the arrangement of the images placed by the AI with simulated annealing, swapping
+    them among each other and with unused images. Images placed by the user stay where they are.
+    The lock of the collage is not held while annealing, changes made in the meantime cause a 409.
+    budget_ms is clamped to OPTIMIZE_MAX_BUDGET_MS.
+
+    Returns:
+        The new version, the scores before and after and every cell that changed.
+    """
+    collage = await find_collage(session_id, component_name)
+    if collage is None:
+        raise HTTPException(status_code=404, detail="Component not found")
 
-    # Mark the current position as empty
-    components_data[component_name][row_idx][col_idx] = (
-        components_data[component_name][row_idx][col_idx][0],
-        '[]',
+    async with collage.lock:
+        version = await sync_collage(collage)
+        if not collage.cell_index:
+            raise HTTPException(status_code=404, detail="Component not found")
+        grid = collage.data
+        slot_graph = get_slot_graph(collage)
+        positions = slot_graph.positions
+        slot_images = [
+            grid[r][c][1] if grid[r][c][1] in embedding_store else None
+            for r, c in positions
+        ]
+        movable = [grid[r][c][0] in collage.ai_placed for r, c in positions]
+
+        adjacency = slot_graph.adjacency_lists()
+
+    available = set(get_available_images())
+    candidates = [name for name in embedding_store.image_names() if name in available]
+
+    # Annealing is CPU-bound, run it outside the event loop
+    best_images, initial_score, best_score = await asyncio.to_thread(
+        optimize_arrangement, slot_images, adjacency, movable, candidates,
+        embedding_store.matrix, embedding_store.rows, min(max(budget_ms, 0), OPTIMIZE_MAX_BUDGET_MS) / 1000.0,
     )
 
-    # Select a new image, excluding the previous one
-    result = select_and_update_image(component_name, row_idx, col_idx, exclude_image=previous_image)
-    if result:
-        most_similar_image, best_score = result
-        update_component_data(component_name, row_idx, col_idx, most_similar_image, best_score)
-    else:
-        return {"message": "No suitable image found"}
+    async with collage.lock:
+        if await sync_collage(collage) != version:
+            raise HTTPException(status_code=409, detail={"message": "Component changed during optimization",
+                                                         "version": collage.version})
+
+        changed_positions = []
+        for (row_idx, col_idx), before, after in zip(positions, slot_images, best_images):
+            if after != before:
+                update_component_data(collage, row_idx, col_idx, after, 0)
+                changed_positions.append((row_idx, col_idx))
+
+        collage.version += 1
+        await commit_collage(collage, version)
+        schedule_speculation(collage, changed_positions)
+        await broadcast_cells(collage, changed_positions)
+        return {
+            "version": collage.version,
+            "initial_score": initial_score,
+            "score": best_score,
+            "cells": [cell_to_dict(collage.data[r][c]) for r, c in changed_positions],
+        }
 
-    return {"message": "Data received successfully"}
+@app.post("/layout/{component_name}")
+async def layout(component_name: str, session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
+    """
+    Arranges the library over the whole shape: projects the embeddings of all images not picked by
+    the user to 2D and maps them onto the slot coordinates by linear assignment, so similar images
+    end up next to each other. Slots holding an image picked by the user are kept.
+
+    Returns:
+        The new version and every cell that changed.
+    """
+    collage = await find_collage(session_id, component_name)
+    if collage is None:
+        raise HTTPException(status_code=404, detail="Component not found")
+
+    async with collage.lock:
+        version = await sync_collage(collage)
+        if not collage.cell_index:
+            raise HTTPException(status_code=404, detail="Component not found")
+
+    # Projection and assignment are CPU-bound, run them outside the event loop
+    new_images = await asyncio.to_thread(layout_component, collage)
+
+    async with collage.lock:
+        if await sync_collage(collage) != version:
+            raise HTTPException(status_code=409, detail={"message": "Component changed during layout",
+                                                         "version": collage.version})
+
+        grid = collage.data
+        changed_positions = []
+        for (row_idx, col_idx), image_name in new_images.items():
+            if grid[row_idx][col_idx][1] == image_name:
+                continue
+            if image_name == '[]':
+                set_cell_image(collage, row_idx, col_idx, '[]')
+                collage.ai_placed.discard(grid[row_idx][col_idx][0])
+            else:
+                update_component_data(collage, row_idx, col_idx, image_name, 0)
+            changed_positions.append((row_idx, col_idx))
+
+        collage.version += 1
+        await commit_collage(collage, version)
+        schedule_speculation(collage, changed_positions)
+        await broadcast_cells(collage, changed_positions)
+        return {
+            "version": collage.version,
+            "cells": [cell_to_dict(collage.data[r][c]) for r, c in changed_positions],
+        }
 
 @app.get("/getArray")
-def get_array(component_name: str):
-    if component_name in components_data:
+async def get_array(component_name: str, session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
+    collage = await find_collage(session_id, component_name)
+    if collage is not None:
+        async with collage.lock:
+            await sync_collage(collage)
+    if collage is not None and collage.data:
         # Flatten the 2D list and remove empty lists or '_'
         flattened_array = list(chain.from_iterable(
             (item for item in sublist if item != '_' and item != '[]')
-            for sublist in components_data[component_name]
+            for sublist in collage.data
         ))
 
         return flattened_array
@@ -300,24 +1047,43 @@ def get_array(component_name: str):
 
 
 @app.post("/clearCollage")
-def clear_collage(component_name: str = Form(...)):
+async def clear_collage(component_name: str = Form(...), session_id: str = Header(DEFAULT_SESSION, alias="X-Session-Id")):
     print(f"Clearing component: {component_name}")
-    for row_idx, row in enumerate(components_data[component_name]):
-        for col_idx, item in enumerate(row):
-            row[col_idx] = None
-
-
-def add_component(component_name: str, data: List[Dict[str, Any]], prompt):
+    collage = await find_collage(session_id, component_name)
+    if collage is None:
+        return
+    async with collage.lock:
+        base_version = await sync_collage(collage)
+        # Cells keep their ids, so subscribers and later PATCH requests can still address them
+        cleared_positions = []
+        for row_idx, row in enumerate(collage.data):
+            for col_idx, item in enumerate(row):
+                if isinstance(item, tuple) and len(item) > 1 and item[1] != '[]':
+                    row[col_idx] = (item[0], '[]')
+                    cleared_positions.append((row_idx, col_idx))
+        collage.slot_graph = None
+        collage.frontier = build_slot_frontier(update_slot_graph(collage), collage.data)
+        collage.ai_placed = set()
+        collage.candidate_queues.clear()
+        collage.excluded_images.clear()
+        collage.version += 1
+        await commit_collage(collage, base_version)
+        await broadcast_cells(collage, cleared_positions)
+        return {"message": "Collage cleared", "version": collage.version}
+
+
+def add_component(collage: CollageState, data: List[Dict[str, Any]], prompt):
     """
-    Adds or updates the data for a specific component name in the global dictionary.
+    Adds or updates the grid of a collage.
 
-    :param component_name: Name of the component.
+    :param collage: State of the collage.
     :param data: List of position data dictionaries.
     :param prompt: Prompt for CLIP model, is None if no prompt was set.
+    :return: The (row_idx, col_idx) positions of the placed image and the answer of the AI.
     """
 
-    # Check if the component already exists in components_data
-    if component_name not in components_data or not components_data[component_name]:
+    # Check if the collage already has a grid
+    if not collage.data:
         # Now, we try to find the target_id from the first tuple in the data
         target_id = None
         for row in data:
@@ -335,46 +1101,253 @@ def add_component(component_name: str, data: List[Dict[str, Any]], prompt):
             print("No target_id found in the first element.")
     else:
         # If the component already exists, compare and get the new ID
-        target_id = compare_and_get_new_id(components_data[component_name], data)
+        target_id = compare_and_get_new_id(collage.data, data)
         if target_id is not None:
             row_idx, col_idx, matching_tuple = find_tuple_by_id(data, target_id)
             print(f"Found matching tuple: {matching_tuple} at position ({row_idx}, {col_idx})")
         else:
-            print(f"No new ID found to compare for component: {component_name}")
-
-    components_data[component_name] = data
+            print(f"No new ID found to compare for component: {collage.component_name}")
+
+    collage.data = data
+    collage.cell_index = build_cell_index(data)
+    collage.frontier = build_slot_frontier(update_slot_graph(collage), data)
+    # Cells placed by the AI stay AI-placed as long as the client sends them back unchanged
+    occupied_ids = {item[0] for row in data for item in row if isinstance(item, tuple) and item[1] != '[]'}
+    collage.ai_placed = (collage.ai_placed & occupied_ids) - {target_id}
+    collage.version += 1
     # Insert the most similar image after either finding the target_id or updating the data
 
-    if target_id is not None and prompt is None:
-        # Find row and col position based on the target_id
-        row_idx, col_idx, _ = find_tuple_by_id(data, target_id)
-        ai_insert_image(component_name, row_idx, col_idx)  # AI insert function
+    if target_id is None:
+        return []
 
-    elif target_id is not None:
-        row_idx, col_idx, _ = find_tuple_by_id(data, target_id)
-        placed_images = find_already_placed_images(component_name)
-        print(f"Found placed images:{placed_images}")
-        try:
-            filename = find_image_according_to_prompt(already_selected_images=placed_images, prompt=prompt)
-            row_idx, col_idx = find_free_neighbor(component_name, row_idx, col_idx)
-            update_component_data(component_name=component_name, row_idx=row_idx, col_idx=col_idx, image_name=filename,
-                                  score=1)
-        except ValueError as e:
-            print(f"No valid images processed. Error message: {e}")
+    # Find row and col position based on the target_id
+    row_idx, col_idx = collage.cell_index[target_id]
+    changed_positions = [(row_idx, col_idx)]
+    ai_position = respond_to_placement(collage, row_idx, col_idx, prompt)
+    if ai_position is not None:
+        changed_positions.append(ai_position)
+    return changed_positions
+
+
+def respond_to_placement(collage: CollageState, row_idx: int, col_idx: int, prompt) -> Optional[Tuple[int, int]]:
+    """
+    Lets the AI answer a placement of the user at (row_idx, col_idx) by filling a free neighbor slot.
+
+    :param collage: State of the collage.
+    :param row_idx: Row of the image placed by the user.
+    :param col_idx: Column of the image placed by the user.
+    :param prompt: Prompt for CLIP model, is None if no prompt was set.
+    :return: The (row_idx, col_idx) the AI placed an image at, None if nothing was placed.
+    """
+    if prompt is None:
+        return ai_insert_image(collage, row_idx, col_idx)  # AI insert function
+
+    placed_images = find_already_placed_images(collage)
+    print(f"Found placed images:{placed_images}")
+    try:
+        filename, _ = find_image_according_to_prompt(already_selected_images=placed_images, prompt=prompt)
+        row_idx, col_idx = find_next_slot(collage, row_idx, col_idx)
+        if not is_position_valid(row_idx, col_idx, collage):
+            return None
+        update_component_data(collage=collage, row_idx=row_idx, col_idx=col_idx, image_name=filename,
+                              score=1)
+        return row_idx, col_idx
+    except ValueError as e:
+        print(f"No valid images processed. Error message: {e}")
+        return None
 
 
-def ai_insert_image(component_name: str, row_idx: int, col_idx: int):
+def ai_insert_image(collage: CollageState, row_idx: int, col_idx: int) -> Optional[Tuple[int, int]]:
     # Handle prompt case
     if image_selection_mode == "style":
-        insert_image(component_name, row_idx, col_idx)
+        return insert_image(collage, row_idx, col_idx)
     # Handle face detection case
     elif image_selection_mode == "faceDetection":
-        print(f"Image selection mode 'faceDetection' is not supported for {component_name}.")
+        print(f"Image selection mode 'faceDetection' is not supported for {collage.component_name}.")
     # Handle similarity case
     elif image_selection_mode == "similarity":
-        insert_image(component_name, row_idx, col_idx)
+        return insert_image(collage, row_idx, col_idx)
     else:
-        print(f"Invalid image selection mode '{image_selection_mode}' for {component_name}.")
+        print(f"Invalid image selection mode '{image_selection_mode}' for {collage.component_name}.")
+    return None
+
+
+def build_cell_index(data: List[List[Any]]) -> Dict[int, Tuple[int, int]]:
+    """
+    Builds a lookup from cell id to its (row_index, col_index) in the given grid,
+    so single cells can be addressed without scanning the whole grid.
+    """
+    return {
+        item[0]: (row_idx, col_idx)
+        for row_idx, row in enumerate(data)
+        for col_idx, item in enumerate(row)
+        if isinstance(item, tuple) and len(item) > 0
+    }
+
+
+def get_slot_graph(collage: CollageState) -> SlotGraph:
+    """Returns the slot graph of the component, building it if there is none yet."""
+    cached = collage.slot_graph
+    return cached[1] if cached is not None else update_slot_graph(collage)
+
+
+def update_slot_graph(collage: CollageState) -> SlotGraph:
+    """
+    Returns the slot graph of the current grid of the component, only rebuilt if the template (the slots and
+    their coordinates) changed. Slots are the (row_index, col_index)
+    positions of the grid in row-major order. If the pixel coordinates of all slots are known, neighbors
+    are the slots that actually touch in the template, which also works for offset rows (hexagon, star,
+    fish). Otherwise the 4-neighborhood of the grid is used.
+    """
+    grid = collage.data
+    coordinates = collage.slot_coordinates
+    cells = [
+        ((row_idx, col_idx), coordinates.get(item[0]))
+        for row_idx, row in enumerate(grid)
+        for col_idx, item in enumerate(row)
+        if isinstance(item, tuple) and len(item) > 1
+    ]
+    template = tuple(cells)
+    cached = collage.slot_graph
+    if cached is not None and cached[0] == template:
+        return cached[1]
+
+    positions = [position for position, _ in cells]
+    if cells and all(coordinate is not None for _, coordinate in cells):
+        slot_graph = SlotGraph.from_coordinates(positions, [coordinate for _, coordinate in cells])
+    else:
+        slot_graph = SlotGraph.from_grid(positions)
+    collage.slot_graph = (template, slot_graph)
+    return slot_graph
+
+
+def build_slot_frontier(slot_graph: SlotGraph, data: List[List[Any]]) -> SlotFrontier:
+    """Builds the frontier of the given grid over the neighbors of the slot graph."""
+    neighbors = {position: slot_graph.neighbor_positions(position) for position in slot_graph.positions}
+    occupied = [(row_idx, col_idx) for row_idx, col_idx in slot_graph.positions if data[row_idx][col_idx][1] != '[]']
+    return SlotFrontier(neighbors, occupied)
+
+
+async def find_collage(session_id: str, component_name: str) -> Optional[CollageState]:
+    """
+    Returns the collage of the session, None if it does not exist. With a shared state backend this also
+    finds collages only another worker knows so far, sync_collage loads their content.
+    """
+    collage = collages.get(session_id, component_name)
+    if collage is None and state_backend.shared and await asyncio.to_thread(
+            state_backend.collage_version, collage_key(session_id, component_name)) > 0:
+        collage = collages.get_or_create(session_id, component_name)
+    return collage
+
+
+async def sync_collage(collage: CollageState) -> int:
+    """
+    Loads the changes other workers made to the collage. Has to be called under the lock of the
+    collage before it is read.
+
+    :param collage: State of the collage.
+    :return: The version the changes of the request have to be committed against, see commit_collage.
+    """
+    if not state_backend.shared:
+        return collage.version
+    # SQLite may wait for the lock of another worker, the event loop must not
+    state = await asyncio.to_thread(state_backend.load_collage, collage.collage_id, collage.version)
+    if state is not None:
+        restore_collage(collage, state)
+    return collage.version
+
+
+def restore_collage(collage: CollageState, state: Dict[str, Any]):
+    """Replaces the collage by the stored state and rebuilds what is derived from its grid."""
+    collage.restore(state)
+    collage.cell_index = build_cell_index(collage.data)
+    if collage.cell_index:
+        collage.frontier = build_slot_frontier(update_slot_graph(collage), collage.data)
+
+
+async def commit_collage(collage: CollageState, base_version: int):
+    """
+    Stores the changed collage in the state backend. If another worker changed it since base_version,
+    the changes of this request are dropped, the stored collage is loaded and a 409 is raised.
+
+    :param collage: State of the collage.
+    :param base_version: Version returned by sync_collage when the request started.
+    """
+    if not state_backend.shared or await asyncio.to_thread(
+            state_backend.save_collage, collage.collage_id, collage.snapshot(), base_version):
+        return
+    state = await asyncio.to_thread(state_backend.load_collage, collage.collage_id)
+    if state is not None:
+        restore_collage(collage, state)
+    raise HTTPException(status_code=409, detail={"message": "Version conflict", "version": collage.version})
+
+
+async def push_remote_changes(collage: CollageState):
+    """
+    Pushes the changes other workers make to the collage to the subscribers connected to this worker.
+    Runs as long as the collage has subscribers here.
+    """
+    while collage.subscribers:
+        await asyncio.sleep(REMOTE_SYNC_INTERVAL_S)
+        if await asyncio.to_thread(state_backend.collage_version, collage.collage_id) <= collage.version:
+            continue
+        async with collage.lock:
+            previous = collage.data
+            await sync_collage(collage)
+            changed_positions = [
+                (row_idx, col_idx)
+                for row_idx, row in enumerate(collage.data)
+                for col_idx, item in enumerate(row)
+                if isinstance(item, tuple) and (
+                    row_idx >= len(previous) or col_idx >= len(previous[row_idx])
+                    or previous[row_idx][col_idx] != item
+                )
+            ]
+            await broadcast_cells(collage, changed_positions)
+
+
+def set_cell_image(collage: CollageState, row_idx: int, col_idx: int, image_name: str):
+    """
+    Sets the image of a cell, keeping its id, and updates the frontier of the component.
+    '[]' empties the cell.
+    """
+    grid = collage.data
+    grid[row_idx][col_idx] = (grid[row_idx][col_idx][0], image_name)
+    frontier = collage.frontier
+    if frontier is not None:
+        frontier.set_occupied((row_idx, col_idx), image_name != '[]')
+
+
+def cell_to_dict(item: Tuple[int, str]) -> Dict[str, Any]:
+    """Converts a grid cell tuple into the representation sent to the frontend."""
+    return {"id": item[0], "fileName": item[1] if item[1] != '[]' else None}
+
+
+async def broadcast_cells(collage: CollageState, positions: List[Tuple[int, int]]):
+    """
+    Pushes the cells at the given positions together with their thumbnail URLs to every
+    client subscribed to the component.
+
+    :param collage: State of the collage.
+    :param positions: The (row_idx, col_idx) positions that changed.
+    """
+    subscribers = collage.subscribers
+    if not subscribers or not positions:
+        return
+
+    cells = []
+    for row_idx, col_idx in positions:
+        cell = cell_to_dict(collage.data[row_idx][col_idx])
+        cell["thumbnailUrl"] = create_thumbnail(cell["fileName"]) if cell["fileName"] else None
+        cells.append(cell)
+    message = {"version": collage.version, "cells": cells}
+
+    for websocket in list(subscribers):
+        try:
+            await websocket.send_json(message)
+        except Exception as e:
+            print(f"Dropping subscriber of {collage.component_name}: {e}")
+            subscribers.discard(websocket)
 
 
 def find_tuple_by_id(data: List[List[Any]], target_id: int) -> Tuple[int, int, Tuple[int, str]]:
@@ -408,8 +1381,8 @@ def compare_and_get_new_id(existing_data, new_data):
     Returns:
         The id of the new element, if found. None otherwise.
     """
-    # Flatten the existing and new data for easier comparison
-    flat_existing = [item for row in existing_data for item in row if isinstance(item, tuple)]
+    # Flatten the existing and new data for easier comparison, a set keeps the lookup O(1)
+    flat_existing = {item for row in existing_data for item in row if isinstance(item, tuple)}
     flat_new = [item for row in new_data for item in row if isinstance(item, tuple)]
     # Find the new element in flat_new that's not in flat_existing
     for item in flat_new:
@@ -432,64 +1405,6 @@ def get_available_images() -> List[str]:
     ]
 
 
-def find_position_with_most_neighbors(component_name: str) -> Tuple[int, int]:
-    """
-    Find the position with the most neighbors in the component's data list.
-    Returns the (row_index, col_index) of the position with the most neighbors.
-    If the best position is already occupied by an image, it chooses the next best one.
-    """
-    if component_name not in components_data or not components_data[component_name]:
-        return -1, -1
-
-    max_neighbors = -1
-    best_position = (-1, -1)
-    image_extensions = ('.jpeg', '.jpg', '.png', '.gif', '.bmp')
-    candidates = []  # Store potential positions sorted by number of neighbors
-
-    for row_idx, row in enumerate(components_data[component_name]):
-        for col_idx, item in enumerate(row):
-            if item != '_':
-                neighbors = 0
-
-                # Check all four possible neighbors
-                if row_idx > 0 and isinstance(components_data[component_name][row_idx - 1][col_idx], tuple) and len(
-                        components_data[component_name][row_idx - 1][col_idx]) > 1 and \
-                        components_data[component_name][row_idx - 1][col_idx][1].lower().endswith(image_extensions):
-                    neighbors += 1
-                if row_idx < len(components_data[component_name]) - 1 and isinstance(
-                        components_data[component_name][row_idx + 1][col_idx], tuple) and len(
-                        components_data[component_name][row_idx + 1][col_idx]) > 1 and \
-                        components_data[component_name][row_idx + 1][col_idx][1].lower().endswith(image_extensions):
-                    neighbors += 1
-                if col_idx > 0 and isinstance(components_data[component_name][row_idx][col_idx - 1], tuple) and len(
-                        components_data[component_name][row_idx][col_idx - 1]) > 1 and \
-                        components_data[component_name][row_idx][col_idx - 1][1].lower().endswith(image_extensions):
-                    neighbors += 1
-                if col_idx < len(row) - 1 and isinstance(components_data[component_name][row_idx][col_idx + 1],
-                                                         tuple) and len(
-                        components_data[component_name][row_idx][col_idx + 1]) > 1 and \
-                        components_data[component_name][row_idx][col_idx + 1][1].lower().endswith(image_extensions):
-                    neighbors += 1
-
-                # Add the position and its neighbor count to candidates
-                candidates.append(((row_idx, col_idx), neighbors))
-
-    # Sort candidates by number of neighbors in descending order
-    candidates.sort(key=lambda x: x[1], reverse=True)
-
-    # Choose the best position not occupied by an image
-    for position, neighbors in candidates:
-        row_idx, col_idx = position
-        item = components_data[component_name][row_idx][col_idx]
-
-        # Check if the position is NOT already occupied by an image
-        if not (isinstance(item, tuple) and len(item) > 1 and item[1].lower().endswith(image_extensions)):
-            best_position = position
-            break
-
-    return best_position
-
-
 def group_elements_fixed_10x10(elements, has_consistent_height):
     if not elements:
         return [["/" for _ in range(10)] for _ in range(10)]
@@ -529,215 +1444,390 @@ def group_elements_fixed_10x10(elements, has_consistent_height):
         file_name = (element["id"], element['fileName']) if element['fileName'] is not None else (element['id'], "[]")
         array_2d[r][c] = file_name
 
-        if file_name[1] != "[]":
-            neighbors = {
-                "top": array_2d[r - 1][c] if r > 0 else None,
-                "bottom": array_2d[r + 1][c] if r < rows - 1 else None,
-                "left": array_2d[r][c - 1] if c > 0 else None,
-                "right": array_2d[r][c + 1] if c < cols - 1 else None
-            }
-            print(f"Neighbors of image {file_name} at position ({r}, {c}): {neighbors}")
-
     return array_2d
 
 
-# Add this dictionary at the top of your file to store excluded images for each slot
-excluded_images_per_slot = {}
+# Number of candidates ranked at once for a slot. The rankings are cached per slot in
+# CollageState.candidate_queues, keyed by (neighbor images, library version), so re-rolls only pop the next one.
+RANKED_CANDIDATES = 64
+
+# Delay before speculating, so a burst of requests is not slowed down by rankings that become stale
+SPECULATION_DELAY_S = 0.05
 
-def select_and_update_image(component_name: str, row_idx: int, col_idx: int, exclude_image: str = None, prompt: str = None):
+# Slots ranked per speculation pass, see speculation_slots for their order
+SPECULATION_MAX_SLOTS = int(os.environ.get("SPECULATION_MAX_SLOTS", "16"))
+
+# Time budget of an interactive selection. Once it is used up, the best image found so far is
+# returned and marked as partial instead of searching the rest of the library.
+SELECTION_BUDGET_MS = int(os.environ.get("SELECTION_BUDGET_MS", "250"))
+
+def select_and_update_image(collage: CollageState, row_idx: int, col_idx: int, exclude_image: str = None, prompt: str = None,
+                            deadline: float = None):
     """
     Common logic to select and update an image based on similarity, style, and available neighbors.
+
+    Candidates are searched in priority order until the deadline (a time.monotonic() value, defaults
+    to SELECTION_BUDGET_MS from now). Returns (image, score, partial), where partial tells that the
+    deadline cut the search short and a better image may exist. None if no image was found,
+    (None, inf, True) if the deadline passed before any image was found.
     """
     start_time = time.time()
+    if deadline is None:
+        deadline = time.monotonic() + SELECTION_BUDGET_MS / 1000.0
 
-    available_images = get_available_images()
-    if not available_images:
-        print("No images available in the upload directory.")
+    if len(embedding_store) == 0:
+        print("No encoded images available.")
         return None
 
-    if not is_position_valid(row_idx, col_idx, component_name):
+    if not is_position_valid(row_idx, col_idx, collage):
         return None
 
-    encoded_tensors = load_encoded_image_tensors()
-    neighbor_tensors = get_neighbor_tensors(component_name, row_idx, col_idx, encoded_tensors)
+    neighbor_images = get_neighbor_images(collage, row_idx, col_idx)
 
-    if neighbor_tensors is None or neighbor_tensors.numel() == 0:
+    if not neighbor_images:
         print("No valid neighbors found.")
         return None
 
-    slot_key = f"{component_name}_{row_idx}_{col_idx}"
-    if slot_key not in excluded_images_per_slot:
-        excluded_images_per_slot[slot_key] = set()
-
+    slot_key = (row_idx, col_idx)
     if exclude_image:
-        excluded_images_per_slot[slot_key].add(exclude_image)
+        collage.excluded_images.add(slot_key, exclude_image)
+    excluded_images = collage.excluded_images.get(slot_key)
 
     if prompt:
-        filename = find_image_according_to_prompt(already_selected_images=find_already_placed_images(component_name), prompt=prompt)
-        row_idx, col_idx = find_free_neighbor(component_name, row_idx, col_idx)
-        update_component_data(component_name=component_name, row_idx=row_idx, col_idx=col_idx, image_name=filename, score=1)
-        return filename, 1
+        row_idx, col_idx = find_next_slot(collage, row_idx, col_idx)
+        if not is_position_valid(row_idx, col_idx, collage):
+            return None
+        filename, partial = find_image_according_to_prompt(already_selected_images=find_already_placed_images(collage),
+                                                           prompt=prompt, excluded_images=excluded_images,
+                                                           deadline=deadline)
+        update_component_data(collage=collage, row_idx=row_idx, col_idx=col_idx, image_name=filename, score=1)
+        return filename, 1, partial
 
     if image_selection_mode == "faceDetection":
-        most_similar_image, best_score = find_most_similar_face(available_images, neighbor_tensors, encoded_tensors, component_name, exclude_image)
+        neighbor_tensors = get_neighbor_tensors(neighbor_images)
+        most_similar_image, best_score, partial = find_most_similar_face(
+            embedding_store.image_names(), neighbor_tensors, collage, excluded_images, deadline)
     elif image_selection_mode == "similarity" or image_selection_mode == "style":
-        most_similar_image, best_score = find_most_similar_image(available_images, neighbor_tensors, encoded_tensors, component_name, exclude_image)
+        most_similar_image, best_score, partial = find_most_similar_image(
+            neighbor_images, collage, excluded_images, slot_key, deadline)
     else:
-        print(f"Invalid image selection mode '{image_selection_mode}' for {component_name}.")
+        print(f"Invalid image selection mode '{image_selection_mode}' for {collage.component_name}.")
         return None
 
-    if not most_similar_image or most_similar_image in excluded_images_per_slot[slot_key]:
+    if not most_similar_image:
+        if partial:
+            print("No image found before the deadline.")
+            return None, best_score, True
         print("No suitable image found.")
         return None
 
     end_time = time.time()
     elapsed_time = end_time - start_time
-    print(f"Execution time: {elapsed_time:.4f} seconds")
+    print(f"Execution time: {elapsed_time:.4f} seconds{' (partial)' if partial else ''}")
 
-    return most_similar_image, best_score
+    return most_similar_image, best_score, partial
 
-def insert_image(component_name: str, row_idx: int, col_idx: int):
-    """Insert the most similar image filename into the components_data dictionary."""
-    row_idx, col_idx = find_free_neighbor(component_name, row_idx, col_idx)
-    if not is_position_valid(row_idx, col_idx, component_name):
-        return
+def insert_image(collage: CollageState, row_idx: int, col_idx: int) -> Optional[Tuple[int, int]]:
+    """
+    Insert the most similar image filename into the grid of the collage.
+    Returns the (row_idx, col_idx) the image was inserted at, None if nothing was inserted.
+    """
+    row_idx, col_idx = find_next_slot(collage, row_idx, col_idx)
+    if not is_position_valid(row_idx, col_idx, collage):
+        return None
 
-    result = select_and_update_image(component_name, row_idx, col_idx)
-    if result:
-        most_similar_image, best_score = result
-        update_component_data(component_name, row_idx, col_idx, most_similar_image, best_score)
+    result = select_and_update_image(collage, row_idx, col_idx)
+    if result and result[0] is not None:
+        most_similar_image, best_score, _ = result
+        update_component_data(collage, row_idx, col_idx, most_similar_image, best_score)
+        return row_idx, col_idx
+    return None
 
 
-# ---------------- Helper Methods ---------------- #
+def schedule_speculation(collage: CollageState, changed_positions: List[Tuple[int, int]] = ()):
+    """
+    Starts ranking the candidates of the likely next placements of the component in the background,
+    cancelling a speculation that is still running for an older version.
+
+    :param collage: State of the collage.
+    :param changed_positions: The (row_idx, col_idx) positions the request changed, the latest last.
+    """
+    task = collage.speculation_task
+    if task is not None and not task.done():
+        task.cancel()
+    collage.speculation_task = asyncio.create_task(
+        speculate_candidates(collage, collage.version, list(changed_positions)))
 
 
-def find_free_neighbor(component_name: str, row_idx: int, col_idx: int) -> Tuple[int, int]:
+def speculation_slots(collage: CollageState, changed_positions: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
     """
-    Find the first free neighbor position for the given row and column index in the component's data list.
+    Orders the slots the next request of the component most likely targets, at most
+    SPECULATION_MAX_SLOTS of them:
+    1. Around the latest changes: the changed slot itself if the AI filled it (a re-roll of the answer
+       just shown), the slot find_next_slot fills after a drop there, then its other free neighbors.
+    2. The frontier by number of placed neighbors, as best_free_slot picks a slot once the
+       neighbors of a drop are full.
+    3. The remaining slots filled by the AI, which can be re-rolled.
+    """
+    frontier = collage.frontier
+    if frontier is None:
+        return []
+    grid = collage.data
+    ai_placed = collage.ai_placed
+
+    def is_reroll(position):
+        item = grid[position[0]][position[1]]
+        return item[1] != '[]' and item[0] in ai_placed
+
+    slots = {}
+    for position in reversed(changed_positions):
+        if position in frontier and is_reroll(position):
+            slots.setdefault(position)
+        for neighbor in frontier.neighbors.get(position, ()):
+            if frontier.is_free(neighbor):
+                slots.setdefault(neighbor)
+    for slot in frontier.best_free_slots(SPECULATION_MAX_SLOTS):
+        slots.setdefault(slot)
+    for cell_id in ai_placed:
+        position = collage.cell_index.get(cell_id)
+        if len(slots) >= SPECULATION_MAX_SLOTS:
+            break
+        if position is not None and position in frontier and is_reroll(position):
+            slots.setdefault(position)
+    return list(slots)[:SPECULATION_MAX_SLOTS]
 
-    A neighbor is considered free if its value is a tuple with the second element as '[]'.
 
-    Args:
-        component_name: The name of the component in the components_data.
-        row_idx: The starting row index.
-        col_idx: The starting column index.
+async def speculate_candidates(collage: CollageState, version: int, changed_positions: List[Tuple[int, int]]):
+    """
+    Fills collage.candidate_queues for the slots the next request most likely targets, in the order
+    of speculation_slots.
 
-    Returns:
-        The (row_index, col_index) of the first free neighbor position.
-        Returns (-1, -1) if no free neighbor is found.
+    Ranks one slot at a time in a worker thread, so the event loop keeps serving requests while a
+    slot is ranked. rank_candidates binds the embedding store once, a store replaced meanwhile only
+    makes the cache key outdated. Stops as soon as the component changes, since the rankings would
+    be stale.
+
+    :param collage: State of the collage.
+    :param version: Version of the component the speculation is for.
+    :param changed_positions: The positions the request changed, the latest last.
     """
-    if component_name not in components_data or not components_data[component_name]:
-        return -1, -1
+    await asyncio.sleep(SPECULATION_DELAY_S)
+    if collage.version != version or not collage.data:
+        return
 
-    # Define all possible neighbor offsets (top, bottom, left, right)
-    neighbor_offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+    placed_images = set(find_already_placed_images(collage))
+    ranked_slots = 0
+    for row_idx, col_idx in speculation_slots(collage, changed_positions):
+        if collage.version != version:
+            break
+        neighbor_images = get_neighbor_images(collage, row_idx, col_idx)
+        if not neighbor_images:
+            continue
 
-    for offset in neighbor_offsets:
-        neighbor_row = row_idx + offset[0]
-        neighbor_col = col_idx + offset[1]
+        slot_key = (row_idx, col_idx)
+        cache_key = (frozenset(neighbor_images), embedding_store.version)
+        cached = collage.candidate_queues.get(slot_key)
+        if cached is not None and cached[0] == cache_key and cached[1]:
+            continue
 
-        # Debugging: Show calculated neighbor position
-        print(f"Checking neighbor at ({neighbor_row}, {neighbor_col})")
+        excluded = placed_images | collage.excluded_images.get(slot_key)
+        ranked, _ = await asyncio.to_thread(rank_candidates, neighbor_images, excluded, RANKED_CANDIDATES)
+        if collage.version != version:
+            break
+        collage.candidate_queues[slot_key] = (cache_key, deque(ranked))
+        ranked_slots += 1
 
-        # Ensure neighbor position is within bounds
-        if 0 <= neighbor_row < len(components_data[component_name]) and \
-                0 <= neighbor_col < len(components_data[component_name][neighbor_row]):
+    if ranked_slots:
+        print(f"Precomputed candidates for {ranked_slots} slots of '{collage.component_name}'.")
 
-            # Get the value of the neighbor
-            neighbor_value = components_data[component_name][neighbor_row][neighbor_col]
-            print(f"Neighbor value at ({neighbor_row}, {neighbor_col}): {neighbor_value}")
 
-            # Check if the neighbor is free (tuple with second element '[]')
-            if isinstance(neighbor_value, tuple) and len(neighbor_value) == 2 and neighbor_value[1] == '[]':
-                print(f"Free neighbor found at ({neighbor_row}, {neighbor_col})")
-                return neighbor_row, neighbor_col
+# ---------------- Helper Methods ---------------- #
+
+
+def find_next_slot(collage: CollageState, row_idx: int, col_idx: int) -> Tuple[int, int]:
+    """
+    Find the slot the AI fills after a change at the given position.
+
+    This is the first free neighbor of the position, probed in the order of the slot graph of the
+    template: by edge weight, then distance (top, bottom, left, right on a rectangular grid). If all
+    neighbors are occupied, it is the free slot with the most placed neighbors in the whole grid.
 
-    print("No free neighbor found.")
-    return -1, -1  # No free neighbor found
+    Args:
+        collage: The collage.
+        row_idx: Row of the changed position.
+        col_idx: Column of the changed position.
+
+    Returns:
+        The (row_index, col_index) of the next slot.
+        Returns (-1, -1) if every slot is occupied.
+    """
+    frontier = collage.frontier
+    if frontier is None:
+        return -1, -1
+    slot = frontier.free_neighbor((row_idx, col_idx))
+    if slot is None:
+        slot = frontier.best_free_slot()
+    return slot if slot is not None else (-1, -1)
 
 
-def is_position_valid(row_idx: int, col_idx: int, component_name: str) -> bool:
+def is_position_valid(row_idx: int, col_idx: int, collage: CollageState) -> bool:
     """Check if the position is valid and not already occupied."""
     if row_idx == -1 or col_idx == -1:
-        print(f"No suitable position available for component '{component_name}'.")
+        print(f"No suitable position available for component '{collage.component_name}'.")
         return False
-    if components_data[component_name][row_idx][col_idx][1] != '[]':
+    if collage.data[row_idx][col_idx][1] != '[]':
         print(f"Position ({row_idx}, {col_idx}) is already occupied.")
         return False
     return True
 
 
-def load_encoded_image_tensors():
-    """Load encoded images and convert them back to tensors."""
-    with open(os.path.join(UPLOAD_DIR, "encoded_images.json"), "r") as f:
-        encoded_images = json.load(f)
-    return {k: torch.tensor(v) for k, v in encoded_images.items()}
+def get_neighbor_images(collage: CollageState, row_idx: int, col_idx: int) -> List[str]:
+    """Retrieve the names of the encoded images placed next to the given position."""
+    grid = collage.data
+    neighbors = [
+        grid[neighbor_row][neighbor_col][1]
+        for neighbor_row, neighbor_col in get_slot_graph(collage).neighbor_positions((row_idx, col_idx))
+        if grid[neighbor_row][neighbor_col][1] != '[]'
+    ]
 
+    # Only images with an embedding can be compared
+    return [neighbor for neighbor in neighbors if neighbor in embedding_store]
 
-def get_neighbor_tensors(component_name: str, row_idx: int, col_idx: int, encoded_tensors: dict):
-    """Retrieve the encoded tensors for neighboring images."""
-    neighbors = []
 
-    # Define all possible neighbor offsets (top, bottom, left, right)
-    neighbor_offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+def get_neighbor_tensors(neighbor_images: List[str]) -> torch.Tensor:
+    """Retrieve the encoded tensors for the given neighboring images."""
+    return torch.tensor(np.stack([embedding_store.get_raw(name) for name in neighbor_images]))
 
-    for offset in neighbor_offsets:
-        neighbor_row = row_idx + offset[0]
-        neighbor_col = col_idx + offset[1]
 
-        # Ensure neighbor position is within bounds
-        if 0 <= neighbor_row < len(components_data[component_name]) and \
-                0 <= neighbor_col < len(components_data[component_name][neighbor_row]):
+def find_most_similar_image(neighbor_images: List[str], collage: CollageState, excluded_images: Set[str] = frozenset(),
+                            slot_key: Tuple[int, int] = None, deadline: float = None):
+    """
+    Find the most similar image based on cosine similarity with the mean of the neighbors.
 
-            # Get the value of the neighbor
-            neighbor_value = components_data[component_name][neighbor_row][neighbor_col]
+    The first selection for a slot ranks RANKED_CANDIDATES images and caches them, every further
+    selection (re-roll) pops the next valid one. The cache is rebuilt once the neighbors of the
+    slot or the library change, or when it runs out of valid candidates. A ranking cut short by the
+    deadline is not cached.
 
-            # Check if the neighbor is a valid image tuple
-            if isinstance(neighbor_value, tuple) and len(neighbor_value) > 1 and neighbor_value[1] != '[]':
-                neighbors.append(neighbor_value[1])
+    Returns (image, score, partial).
+    """
+    placed_images = set(find_already_placed_images(collage))
+    cache_key = (frozenset(neighbor_images), embedding_store.version)
+
+    queue = None
+    cached = collage.candidate_queues.get(slot_key) if slot_key is not None else None
+    if cached is not None and cached[0] == cache_key:
+        queue = cached[1]
+    elif cached is not None and cached[0][1] == embedding_store.version and cached[0][0] < cache_key[0]:
+        # Neighbors were added since the ranking (the usual case after a drop next to a precomputed slot)
+        queue = deque(rerank_cached_candidates(cached[1], neighbor_images, cache_key[0] - cached[0][0],
+                                               placed_images | excluded_images))
+        collage.candidate_queues[slot_key] = (cache_key, queue)
+
+    if queue is not None:
+        candidate = pop_next_candidate(queue, placed_images | excluded_images)
+        if candidate is not None:
+            return candidate + (False,)
+
+    # No valid cached candidate left, rank again
+    ranked, partial = rank_candidates(neighbor_images, placed_images | excluded_images, RANKED_CANDIDATES, deadline)
+    queue = deque(ranked)
+    if slot_key is not None and not partial:
+        collage.candidate_queues[slot_key] = (cache_key, queue)
+
+    candidate = pop_next_candidate(queue, placed_images | excluded_images)
+    return candidate + (partial,) if candidate is not None else (None, -float("inf"), partial)
+
+
+def rerank_cached_candidates(queue: deque, neighbor_images: List[str], new_neighbors: Set[str],
+                             excluded: Set[str]) -> List[Tuple[str, float]]:
+    """
+    Re-scores a cached ranking after neighbors were added to the slot. The cached candidates and the
+    neighbor lists of the new neighbors are scored against the new neighbor mean, which avoids
+    searching the whole library again.
+    """
+    candidates = list(dict.fromkeys(
+        [name for name, _ in queue if name not in excluded and name in embedding_store]
+        + embedding_store.neighbor_candidates(new_neighbors, exclude=excluded)
+    ))
+    if not candidates:
+        return []
+    neighbor_features = embedding_store.vectors(neighbor_images).mean(axis=0)
+    neighbor_features /= max(float(np.linalg.norm(neighbor_features)), 1e-12)
+    scores = embedding_store.vectors(candidates) @ neighbor_features
+    return [(candidates[i], float(scores[i])) for i in np.argsort(-scores)[:RANKED_CANDIDATES]]
+
+
+def pop_next_candidate(queue: deque, excluded: Set[str]) -> Optional[Tuple[str, float]]:
+    """Pops candidates from the queue until one is neither excluded nor deleted, None if there is none."""
+    while queue:
+        image_name, score = queue.popleft()
+        if image_name not in excluded and image_name in embedding_store:
+            return image_name, score
+    return None
 
-    # Filter and stack valid tensors
-    tensor_list = [encoded_tensors[neighbor] for neighbor in neighbors if neighbor in encoded_tensors]
 
-    return torch.stack(tensor_list) if tensor_list else torch.empty(0)
+def rank_candidates(neighbor_images: List[str], excluded: Set[str], count: int,
+                    deadline: float = None) -> Tuple[List[Tuple[str, float]], bool]:
+    """
+    Ranks the images most similar to the mean of the neighbors, best first.
 
+    Sources are tried from cheap to expensive: the merged neighbor lists of the neighboring images,
+    then the nearest neighbor index probing a single list, then the index with its default nprobe.
+    Each source only runs while fewer than count images are ranked and the deadline has not passed,
+    except that a source always runs as long as nothing was found at all.
 
-def find_most_similar_image(available_images: list, neighbor_tensors: torch.Tensor, encoded_tensors: dict, component_name: str, exclude_image: str = None):
-    """Find the most similar image based on cosine similarity."""
-    placed_images = {
-        item[1]
-        for row in components_data[component_name]
-        for item in row
-        if isinstance(item, tuple) and len(item) > 1 and item[1] != '[]'
-    }
-    neighbor_features = neighbor_tensors.mean(dim=0)
-    best_score = -float("inf")
-    best_image = None
+    Returns:
+        The ranking and whether the deadline cut it short.
+    """
+    # Runs in a thread during speculation, every lookup has to go to the same store
+    store = embedding_store
+    neighbor_features = store.vectors(neighbor_images).mean(axis=0)
+    neighbor_features /= max(float(np.linalg.norm(neighbor_features)), 1e-12)
 
-    for image_name in available_images:
-        if image_name in placed_images or image_name == exclude_image or image_name not in encoded_tensors:
-            continue
-        score = torch.cosine_similarity(encoded_tensors[image_name], neighbor_features, dim=0).mean().item()
-        if score > best_score:
-            best_score = score
-            best_image = image_name
-    return best_image, best_score
+    candidates = store.neighbor_candidates(neighbor_images, exclude=excluded)
+    scores = store.vectors(candidates) @ neighbor_features
+    ranked = [(candidates[i], float(scores[i])) for i in np.argsort(-scores)[:count]]
 
+    for nprobe in (1, None):
+        if len(ranked) >= count:
+            break
+        if ranked and deadline is not None and time.monotonic() > deadline:
+            return ranked, True
+        ranked_names = {name for name, _ in ranked}
+        ranked.extend(store.search(neighbor_features, k=count - len(ranked),
+                                   exclude=excluded | ranked_names, nprobe=nprobe))
+        ranked.sort(key=lambda item: -item[1])
+    return ranked[:count], False
 
-def find_most_similar_face(available_images: list, neighbor_tensors: torch.Tensor, encoded_tensors: dict, component_name: str, exclude_image: str = None):
-    placed_images = {
-        item[1]
-        for row in components_data[component_name]
-        for item in row
-        if isinstance(item, tuple) and len(item) > 1 and item[1] != '[]'
-    }
+
+def find_most_similar_face(available_images: list, neighbor_tensors: torch.Tensor, collage: CollageState, excluded_images: Set[str] = frozenset(),
+                           deadline: float = None):
+    """
+    Find the image whose encoding is closest to the mean of the neighbors among the images showing a face.
+
+    Face detection is slow, so the images are visited in order of their stored CLIP similarity to the
+    neighbors and the search stops at the deadline, also if no face was found yet.
+
+    Returns (image, distance, partial), (None, inf, True) if the deadline passed before a face was found.
+    """
+    placed_images = set(find_already_placed_images(collage))
     neighbor_features = neighbor_tensors.mean(dim=0).numpy()
     best_score = float("inf")
     best_image = None
 
-    for image_name in available_images:
-        if image_name in placed_images or image_name == exclude_image or image_name not in encoded_tensors:
-            continue
+    candidates = [
+        image_name for image_name in available_images
+        if image_name not in placed_images and image_name not in excluded_images and image_name in embedding_store
+    ]
+    if candidates:
+        similarities = embedding_store.vectors(candidates) @ neighbor_features.reshape(-1)
+        candidates = [candidates[i] for i in np.argsort(-similarities)]
+
+    for visited, image_name in enumerate(candidates):
+        if deadline is not None and time.monotonic() > deadline:
+            print(f"Face search stopped at the deadline after {visited} of {len(candidates)} images.")
+            return best_image, best_score, True
 
         image_path = os.path.join(UPLOAD_DIR, image_name)
         image = face_recognition.load_image_file(image_path)
@@ -746,37 +1836,243 @@ def find_most_similar_face(available_images: list, neighbor_tensors: torch.Tenso
         if not face_encodings:
             continue
 
-        image_tensor = preprocess(Image.fromarray(image)).unsqueeze(0).to(device)
+        image_tensor = preprocess(Image.fromarray(image)).unsqueeze(0)
         with torch.no_grad():
-            encoded_face = model.encode_image(image_tensor).cpu().numpy()
+            encoded_face = encode_images(image_tensor).float().cpu().numpy()
 
         face_distance = np.linalg.norm(encoded_face - neighbor_features)
         if face_distance < best_score:
             best_score = face_distance
             best_image = image_name
 
-    return best_image, best_score
+    return best_image, best_score, False
 
 
-def update_component_data(component_name: str, row_idx: int, col_idx: int, image_name: str, score: float):
-    """Update components_data with the most similar image at the given position."""
-    components_data[component_name][row_idx][col_idx] = (
-        components_data[component_name][row_idx][col_idx][0],  # Keep existing ID
-        image_name,  # Set image name
-    )
+def autofill_component(collage: CollageState) -> List[Tuple[int, int]]:
+    """
+    Assigns library images to all free slots of a component in one go.
+
+    A slot is scored by the mean embedding of its placed neighbors, slots without placed
+    neighbors use the mean of all placed images of the collage. Images excluded for a slot
+    by an earlier re-roll are not assigned to it.
+
+    :param collage: State of the collage.
+    :return: The (row_idx, col_idx) positions that were filled.
+    """
+    grid = collage.data
+    placed_images = set(find_already_placed_images(collage))
+    placed_in_store = [name for name in placed_images if name in embedding_store]
+    if not placed_in_store:
+        print(f"No placed images to autofill {collage.component_name} from.")
+        return []
+
+    free_positions = [
+        (row_idx, col_idx)
+        for row_idx, row in enumerate(grid)
+        for col_idx, item in enumerate(row)
+        if isinstance(item, tuple) and len(item) > 1 and item[1] == '[]'
+    ]
+    available = set(get_available_images())
+    candidates = [name for name in embedding_store.image_names() if name in available and name not in placed_images]
+    if not free_positions or not candidates:
+        return []
+
+    collage_mean = embedding_store.vectors(placed_in_store).mean(axis=0)
+    slot_features = neighbor_mean_features(collage, free_positions, collage_mean)
+    return assign_images_to_slots(collage, free_positions, slot_features, candidates)
+
+
+def reshuffle_component(collage: CollageState, cell_ids: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+    """
+    Re-rolls several AI-placed slots at once, like one /new_selection per slot.
+
+    Every slot gets the mean embedding of its placed neighbors as they are before the reshuffle,
+    all slots are scored against the library in one matrix product and the assignment makes sure
+    no image is used twice. The image a slot held before is excluded for that slot.
+
+    :param collage: State of the collage.
+    :param cell_ids: Ids of the cells to re-roll, None re-rolls every cell placed by the AI.
+    :return: The (row_idx, col_idx) positions that changed.
+    """
+    grid = collage.data
+    cell_index = collage.cell_index
+    ai_placed = collage.ai_placed
+    if cell_ids is None:
+        cell_ids = sorted(ai_placed)
+
+    positions = []
+    for cell_id in dict.fromkeys(cell_ids):
+        if cell_id not in cell_index:
+            continue
+        row_idx, col_idx = cell_index[cell_id]
+        if grid[row_idx][col_idx][1] != '[]':
+            positions.append((row_idx, col_idx))
+    if not positions:
+        return []
+
+    placed_in_store = [name for name in find_already_placed_images(collage) if name in embedding_store]
+    if not placed_in_store:
+        print(f"No placed images to reshuffle {collage.component_name} from.")
+        return []
+    collage_mean = embedding_store.vectors(placed_in_store).mean(axis=0)
+    slot_features = neighbor_mean_features(collage, positions, collage_mean)
+
+    # Free the slots and exclude their current image, as a re-roll does
+    for row_idx, col_idx in positions:
+        cell_id, previous_image = grid[row_idx][col_idx]
+        collage.excluded_images.add((row_idx, col_idx), previous_image)
+        set_cell_image(collage, row_idx, col_idx, '[]')
+        ai_placed.discard(cell_id)
+
+    placed_images = set(find_already_placed_images(collage))
+    available = set(get_available_images())
+    candidates = [name for name in embedding_store.image_names() if name in available and name not in placed_images]
+
+    filled_positions = set(assign_images_to_slots(collage, positions, slot_features, candidates))
+    for row_idx, col_idx in positions:
+        if (row_idx, col_idx) not in filled_positions:
+            print(f"No suitable image found for ({row_idx}, {col_idx}) in '{collage.component_name}'.")
+    return positions
+
+
+def neighbor_mean_features(collage: CollageState, positions: List[Tuple[int, int]],
+                           fallback: np.ndarray) -> np.ndarray:
+    """
+    Computes the normalized mean embedding of the placed neighbors of every given slot, weighted by
+    the edge weights of the slot graph.
+
+    The neighbor relation is collected into a slots x images weight matrix first, so the means
+    of all slots come out of a single matrix product with the neighbor embeddings.
+
+    :param collage: State of the collage.
+    :param positions: The (row_idx, col_idx) positions of the slots.
+    :param fallback: Feature of slots without a placed neighbor.
+    :return: One unit-length feature row per slot.
+    """
+    grid = collage.data
+    slot_graph = get_slot_graph(collage)
+    neighbor_columns: Dict[str, int] = {}
+    entries = []
+    for slot, position in enumerate(positions):
+        graph_slot = slot_graph.index[position]
+        for neighbor, weight in zip(slot_graph.neighbors(graph_slot), slot_graph.neighbor_weights(graph_slot)):
+            n_row, n_col = slot_graph.positions[neighbor]
+            image_name = grid[n_row][n_col][1]
+            if image_name in embedding_store:
+                entries.append((slot, neighbor_columns.setdefault(image_name, len(neighbor_columns)), weight))
+
+    weights = np.zeros((len(positions), len(neighbor_columns)), dtype=np.float32)
+    for slot, column, weight in entries:
+        weights[slot, column] += weight
+    counts = weights.sum(axis=1, keepdims=True)
+    weights /= np.maximum(counts, 1.0)
+
+    if neighbor_columns:
+        slot_features = weights @ embedding_store.vectors(list(neighbor_columns))
+    else:
+        slot_features = np.zeros((len(positions), embedding_store.dim), dtype=np.float32)
+    slot_features[counts[:, 0] == 0] = fallback
+    slot_features /= np.maximum(np.linalg.norm(slot_features, axis=1, keepdims=True), 1e-12)
+    return slot_features
+
+
+def assign_images_to_slots(collage: CollageState, positions: List[Tuple[int, int]], slot_features: np.ndarray,
+                           candidates: List[str]) -> List[Tuple[int, int]]:
+    """
+    Scores every slot against every candidate by cosine similarity and places the images of the best
+    assignment, so every image is used at most once. Images excluded for a slot by an earlier
+    re-roll are not assigned to it.
+
+    :param collage: State of the collage.
+    :param positions: The (row_idx, col_idx) positions of the free slots.
+    :param slot_features: One unit-length feature row per slot.
+    :param candidates: Names of the images that may be placed.
+    :return: The (row_idx, col_idx) positions that were filled.
+    """
+    if not positions or not candidates:
+        return []
+
+    # Cosine similarity of every slot with every candidate
+    scores = slot_features @ embedding_store.vectors(candidates).T
+
+    excluded_score = -10.0  # Far below any cosine similarity
+    candidate_columns = {name: col for col, name in enumerate(candidates)}
+    for slot, (row_idx, col_idx) in enumerate(positions):
+        for name in collage.excluded_images.get((row_idx, col_idx)):
+            if name in candidate_columns:
+                scores[slot, candidate_columns[name]] = excluded_score
+
+    filled_positions = []
+    for slot, col in solve_assignment(scores):
+        if scores[slot, col] <= excluded_score:
+            continue
+        row_idx, col_idx = positions[slot]
+        update_component_data(collage, row_idx, col_idx, candidates[col], float(scores[slot, col]))
+        filled_positions.append((row_idx, col_idx))
+
+    return filled_positions
+
+
+def layout_component(collage: CollageState) -> Dict[Tuple[int, int], str]:
+    """
+    Computes an embedding-space layout of the library for all slots of a component that are
+    empty or hold an image placed by the AI. Does not modify the grid.
+
+    :param collage: State of the collage.
+    :return: Maps (row_idx, col_idx) to the image for that slot, '[]' if the slot stays empty.
+    """
+    grid = collage.data
+    ai_placed = collage.ai_placed
+    coordinates = collage.slot_coordinates
+
+    positions = []
+    user_placed = set()
+    for row_idx, row in enumerate(grid):
+        for col_idx, item in enumerate(row):
+            if not (isinstance(item, tuple) and len(item) > 1):
+                continue
+            if item[1] == '[]' or item[0] in ai_placed:
+                positions.append((row_idx, col_idx))
+            else:
+                user_placed.add(item[1])
+
+    store = embedding_store  # Runs in a thread, the store may be replaced meanwhile
+    available = set(get_available_images())
+    images = [name for name in store.image_names() if name in available and name not in user_placed]
+    if not positions or not images:
+        return {}
+
+    # Slots without a known pixel position fall back to their grid position
+    slot_coordinates = [
+        coordinates.get(grid[r][c][0], (c, r))
+        for r, c in positions
+    ]
+    points = project_to_2d(store.vectors(images))
+    assignment = dict(layout_on_slots(points, slot_coordinates))
+
+    return {
+        position: images[assignment[slot]] if slot in assignment else '[]'
+        for slot, position in enumerate(positions)
+    }
+
+
+def update_component_data(collage: CollageState, row_idx: int, col_idx: int, image_name: str, score: float):
+    """Update the grid of the collage with the most similar image at the given position."""
+    set_cell_image(collage, row_idx, col_idx, image_name)
+    collage.ai_placed.add(collage.data[row_idx][col_idx][0])
     print(
-        f"Inserted {image_name} at position ({row_idx}, {col_idx}) for component '{component_name}' with a similarity score of {score:.2f}.")
+        f"Inserted {image_name} at position ({row_idx}, {col_idx}) for component '{collage.component_name}' with a similarity score of {score:.2f}.")
 
 
-def find_already_placed_images(component_name: str):
-    """Function that returns all image names that have already been placed in a given component (component_name)."""
-    if component_name not in components_data:
+def find_already_placed_images(collage: CollageState):
+    """Function that returns all image names that have already been placed in a given collage."""
+    if not collage.data:
         return []
 
     # Creating set for unique content.
     placed_images = {
         item[1]
-        for row in components_data[component_name]
+        for row in collage.data
         for item in row
         if isinstance(item, tuple) and len(item) > 1 and item[1] != '[]'
     }
@@ -786,4 +2082,8 @@ def find_already_placed_images(component_name: str):
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    workers = WORKERS
+    if workers > 1 and not state_backend.shared:
+        print(f"{workers} workers need a shared state backend (STATE_BACKEND=sqlite), starting a single worker.")
+        workers = 1
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
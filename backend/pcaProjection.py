@@ -0,0 +1,69 @@
+"""
+Module for a PCA projection of the CLIP embeddings to a few dimensions. Most of the variance of
+the 1024-d RN50 embeddings lives in far fewer components, so inner products in the reduced space
+are a good and much cheaper estimate for prefiltering candidates, which are then re-ranked in
+the full space.
+"""
+
+# Standard library imports
+from pathlib import Path
+from typing import Optional
+
+# External library imports
+import numpy as np
+
+###########################################################################################
+
+
+class PCAProjection:
+    """
+    Projection onto the top principal components of a set of embeddings.
+
+    Images are centered before projecting, queries are not: for a fixed query q the ranking by
+    x . q equals the ranking by (x - mean) . q, which the reduced space approximates.
+    """
+
+    def __init__(self, dims: int = 128):
+        self.dims = dims
+        self.mean: Optional[np.ndarray] = None
+        self.components: Optional[np.ndarray] = None  # Shape (dims, full dimension)
+        self.fitted_size = 0
+        self.explained_variance = 0.0  # Share of the variance kept by the projection
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.components is not None
+
+    def fit(self, vectors: np.ndarray):
+        """Fits the projection to the given embeddings, shape (number of images, dimension)."""
+        vectors = np.asarray(vectors, dtype=np.float64)
+        self.mean = vectors.mean(axis=0)
+        centered = vectors - self.mean
+        eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        order = np.argsort(eigenvalues)[::-1][:self.dims]
+        self.components = eigenvectors[:, order].T.astype(np.float32)
+        self.mean = self.mean.astype(np.float32)
+        self.fitted_size = len(vectors)
+        self.explained_variance = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+
+    def transform(self, vectors: np.ndarray) -> np.ndarray:
+        """Projects embeddings of images, shape (number of images, dimension) -> (number of images, dims)."""
+        return (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+
+    def transform_query(self, query: np.ndarray) -> np.ndarray:
+        """Projects a query vector without centering it."""
+        return self.components @ np.asarray(query, dtype=np.float32)
+
+    def save(self, path: Path):
+        """Writes the projection to an .npz file."""
+        np.savez(path, mean=self.mean, components=self.components, fitted_size=np.array(self.fitted_size),
+                 explained_variance=np.array(self.explained_variance))
+
+    def load(self, path: Path):
+        """Reads a projection written by save."""
+        with np.load(path) as data:
+            self.mean = data["mean"]
+            self.components = data["components"]
+            self.fitted_size = int(data["fitted_size"])
+            self.explained_variance = float(data["explained_variance"])
+        self.dims = self.components.shape[0]
@@ -1,13 +1,48 @@
 import clip
+import time
 import torch
+import numpy as np
+from collections import OrderedDict
 from pathlib import Path
-from PIL import Image
-from typing import List
-import os
+from typing import Collection, List, Optional, Tuple
+from clipModel import active_encoder, encode_texts
+from encoderBatcher import EncoderBatcher
 
+# Text features of the most recent prompts by encoder id and prompt. A user keeps the same prompt for
+# many placements. The encoder is part of the key, features of another model do not match the embeddings.
+PROMPT_CACHE_SIZE = 64
+prompt_features: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("RN50", device=device)
+
+def remember_prompt(key: Tuple[str, str], features: np.ndarray):
+    prompt_features[key] = features
+    prompt_features.move_to_end(key)
+    while len(prompt_features) > PROMPT_CACHE_SIZE:
+        prompt_features.popitem(last=False)
+
+
+def encode_prompt(prompt: str) -> np.ndarray:
+    """Returns the CLIP text features of the prompt, encoding it only if it is not cached."""
+    key = (active_encoder().id, prompt)
+    features = prompt_features.get(key)
+    if features is None:
+        with torch.no_grad():
+            features = encode_texts(clip.tokenize([prompt])).float().cpu().numpy()[0]
+    remember_prompt(key, features)
+    return features
+
+
+async def encode_prompt_batched(prompt: str, text_encoder: EncoderBatcher) -> np.ndarray:
+    """
+    Same as encode_prompt, but encodes through the batcher, together with the prompts of concurrent
+    requests. Handlers call it before the selection, which then finds the prompt in the cache.
+    """
+    key = (active_encoder().id, prompt)
+    features = prompt_features.get(key)
+    if features is None:
+        features = await text_encoder.submit(clip.tokenize([prompt])[0])
+    remember_prompt(key, features)
+    return features
 
 
 def get_image_filenames(folder_path: str):
@@ -31,62 +66,36 @@ def get_image_filenames(folder_path: str):
     return [file.name for file in folder.iterdir() if file.suffix.lower() in allowed_extensions and file.is_file()]
 
 
-def find_image_according_to_prompt(already_selected_images: List[str], prompt: str) -> str:
+def find_image_according_to_prompt(already_selected_images: List[str], prompt: str,
+                                   excluded_images: Collection[str] = (),
+                                   deadline: Optional[float] = None) -> Tuple[str, bool]:
     # Importing here to avoid circular import with main.py
-    from main import UPLOAD_DIR
+    from main import embedding_store
     """
     Finds the image in the collection that best matches the prompt using CLIP.
+    Only the prompt is encoded, the images are looked up in the nearest neighbor
+    index of the embedding store.
 
     Parameters:
         already_selected_images (list): List of filenames already selected to exclude from search.
         prompt (str): The textual description of the desired image.
+        excluded_images (list): Filenames rejected for the slot, also excluded from search.
+        deadline (float): time.monotonic() value. If encoding the prompt already used up the time,
+            only a single list of the index is probed.
 
     Returns:
-        str: Filename of the best matching image.
+        tuple: Filename of the best matching image and whether the search was reduced to a single
+            list because of the deadline, so a better match may exist.
     """
-    # Get all available images (list of filenames as strings)
-    all_images = get_image_filenames(UPLOAD_DIR)
-    # Removing already placed images by ignoring them
-    all_images = list(set(all_images) - set(already_selected_images))
-
-    # Preprocess images
-    image_tensors = []
-    image_filenames = []
-    for img_name in all_images:
-        img_path = os.path.join(UPLOAD_DIR, img_name)# Construct the full path
-        try:
-            image = Image.open(img_path).convert("RGB")
-            image_tensor = preprocess(image).unsqueeze(0).to(device)
-            image_tensors.append(image_tensor)
-            image_filenames.append(img_name)
-        except Exception as e:
-            print(f"Error processing image {img_path}: {e}")
-
-    if not image_tensors:
+    # Compute CLIP features, the store normalizes the query
+    text_features = encode_prompt(prompt)
+
+    # Find the best match, ignoring already placed and excluded images
+    nprobe = 1 if deadline is not None and time.monotonic() > deadline else None
+    results = embedding_store.search(text_features, k=1, exclude=set(already_selected_images) | set(excluded_images),
+                                     nprobe=nprobe)
+    if not results:
         raise ValueError("No valid images were processed.")
 
-    # Concatenate image tensors
-    image_input = torch.cat(image_tensors)
-
-    # Tokenize the prompt
-    text_input = clip.tokenize([prompt]).to(device)
-
-    # Compute CLIP features
-    with torch.no_grad():
-        image_features = model.encode_image(image_input)
-        text_features = model.encode_text(text_input)
-
-        # Normalize features
-        image_features /= image_features.norm(dim=-1, keepdim=True)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
-
-        # Compute similarity
-        similarity = (image_features @ text_features.T).squeeze(1)
-
-    # Find the best match
-    best_match_idx = similarity.argmax().item()
-    best_image_filename = image_filenames[best_match_idx]
-
-    return best_image_filename
-
-
+    best_image_filename, _ = results[0]
+    return best_image_filename, nprobe is not None
@@ -0,0 +1,128 @@
+"""
+Module for the background job that re-encodes the image library into a new embedding namespace,
+see embeddingNamespace.py. The target store is the job's progress: encoded rows are appended to its
+files and its metadata is saved every few seconds, so a job that was interrupted resumes with the
+images that are still missing. Only one worker runs the job at a time, it holds a JobLock.
+"""
+
+# Standard library imports
+import time
+from pathlib import Path
+from typing import Any, Collection, Dict, List, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows, where only a single worker runs
+    fcntl = None
+
+# External library imports
+import torch
+from PIL import Image
+
+# Local imports
+from clipModel import ClipEncoder
+from embeddingStore import EmbeddingStore
+
+###########################################################################################
+
+# Images encoded per forward pass
+REENCODE_BATCH = 32
+
+# How often the metadata of the target store is saved, progress after the last save is redone on resume
+SAVE_INTERVAL_S = 10.0
+
+
+class JobLock:
+    """File lock held by the worker that runs the job, taken without waiting."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = None
+
+    def acquire(self) -> bool:
+        """Takes the lock, False if another worker holds it."""
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, "a+b")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()  # Closing releases the lock
+            self._file = None
+
+
+class ReencodeJob:
+    """
+    Encodes the images of the library with the encoder of the target namespace.
+
+    Attributes:
+        store: Store of the target namespace, loaded from its directory.
+        encoder: Encoder of the target namespace.
+        image_dir: Directory of the uploaded images.
+        progress: State of the job ("waiting", "encoding", "switched"), encoded and remaining
+            images and the images encoded per second, reported by /stats/encoders.
+    """
+
+    def __init__(self, store: EmbeddingStore, encoder: ClipEncoder, image_dir: Path, batch_size: int = REENCODE_BATCH):
+        self.store = store
+        self.encoder = encoder
+        self.image_dir = Path(image_dir)
+        self.batch_size = batch_size
+        self.failed: Set[str] = set()
+        self.progress: Dict[str, Any] = {"state": "waiting", "encoded": len(store), "remaining": None,
+                                         "images_per_s": 0.0}
+        self._last_save = time.monotonic()
+
+    def remaining(self, names: Collection[str]) -> List[str]:
+        """The images of the library that are not encoded yet."""
+        missing = [name for name in names if name not in self.store and name not in self.failed]
+        self.progress["remaining"] = len(missing)
+        return missing
+
+    def encode_batch(self, names: List[str]):
+        """Encodes images into the target store. Blocks, runs in a worker thread."""
+        self.progress["state"] = "encoding"
+        start = time.perf_counter()
+        encoded_names = []
+        image_tensors = []
+        for name in names:
+            try:
+                with Image.open(self.image_dir / name) as image:
+                    image_tensors.append(self.encoder.preprocess(image))
+                encoded_names.append(name)
+            except OSError as e:
+                # Deleted or unreadable, the active namespace has no usable embedding of it either
+                print(f"Re-encode skips {name}: {e}")
+                self.failed.add(name)
+        if not image_tensors:
+            return
+
+        with torch.no_grad():
+            features = self.encoder.encode_images(torch.stack(image_tensors)).float().cpu().numpy()
+        self.store.add_many(zip(encoded_names, features))
+        if time.monotonic() - self._last_save > SAVE_INTERVAL_S:
+            self.store.save()
+            self._last_save = time.monotonic()
+        self.progress["encoded"] = len(self.store)
+        self.progress["images_per_s"] = round(len(encoded_names) / (time.perf_counter() - start), 1)
+
+    def finish(self, names: Collection[str]):
+        """
+        Makes the target store hold exactly the given images and saves it, called once
+        remaining(names) is empty and before the switch.
+        """
+        live = set(names)
+        for name in self.store.image_names():
+            if name not in live:
+                self.store.remove(name)
+        self.store.save()
+        self.progress.update(state="switched", encoded=len(self.store), remaining=0)
+        print(f"Re-encoded {len(self.store)} images with {self.encoder.id}.")
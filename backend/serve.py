@@ -0,0 +1,135 @@
+"""
+Production entry point. Loads the CLIP model, the dlib face models and the memory-mapped embedding
+store once in a parent process, then forks the workers. The workers share the loaded weights
+copy-on-write, so the memory of N workers stays close to that of one. All workers accept
+connections on one listening socket created by the parent, every worker limits torch to its share
+of the cores, so N workers do not oversubscribe the CPU.
+
+Usage: STATE_BACKEND=sqlite SHARED_EMBEDDINGS=collage WORKERS=8 python serve.py
+
+With SHARED_EMBEDDINGS set the embedding store is published in shared memory as well, uploads
+then reach all workers as a new generation instead of a reload from disk in every worker.
+
+While the library is re-encoded for a newly configured CLIP_MODEL or CLIP_BACKEND, the parent loads
+both models, so the workers share both and can switch over without loading anything.
+
+The parent restarts workers that die and forwards SIGINT and SIGTERM to them. Forking needs a POSIX
+system, elsewhere a single worker is served.
+"""
+
+# Standard library imports
+import gc
+import os
+import signal
+import socket
+import sys
+from typing import Dict
+
+# External library imports
+import torch
+import uvicorn
+
+###########################################################################################
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8000"))
+
+# Torch threads per worker, defaults to the cores divided by the number of workers
+TORCH_THREADS = os.environ.get("TORCH_THREADS")
+
+
+def create_socket(host: str, port: int) -> socket.socket:
+    """Listening socket shared by all workers."""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(server, sock: socket.socket, threads: int):
+    """Serves the app on the inherited socket, runs in the forked child and never returns."""
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # The child of a fork has a single thread and this script as __main__, which is safe to import,
+    # so the ingest can fork its process pools from here. A fork server is only usable by the process
+    # that started it, every worker starts its own. Preloading this script saves every pool process
+    # from importing torch again when it runs the script as __mp_main__.
+    server.ingest_pipeline.start_fork_server(["serve"])
+    torch.set_num_threads(threads)
+    try:
+        uvicorn.run(server.app, fd=sock.fileno())
+    finally:
+        os._exit(0)
+
+
+def fork_worker(server, sock: socket.socket, threads: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        run_worker(server, sock, threads)
+    return pid
+
+
+def main():
+    # Keep the parent single-threaded while loading, a fork must not copy a busy torch thread pool
+    torch.set_num_threads(1)
+
+    # Importing main loads the models and the embedding store into the parent
+    import main as server
+    workers = server.WORKERS
+    if workers > 1 and not server.state_backend.shared:
+        print(f"{workers} workers need a shared state backend (STATE_BACKEND=sqlite), starting a single worker.")
+        workers = 1
+    threads = int(TORCH_THREADS) if TORCH_THREADS else max(1, (os.cpu_count() or 1) // workers)
+
+    if not hasattr(os, "fork"):
+        torch.set_num_threads(threads)
+        uvicorn.run(server.app, host=HOST, port=PORT)
+        return
+
+    sock = create_socket(HOST, PORT)
+
+    # Move everything loaded so far out of the garbage collector's reach, collections in the workers
+    # would otherwise write to the pages of these objects and unshare them
+    gc.collect()
+    gc.freeze()
+
+    children: Dict[int, int] = {}
+    for worker in range(workers):
+        children[fork_worker(server, sock, threads)] = worker
+    print(f"Serving on {HOST}:{PORT} with {workers} workers, {threads} torch threads each.")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker = children.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        print(f"Worker {worker} (pid {pid}) exited with status {status}, restarting it.")
+        children[fork_worker(server, sock, threads)] = worker
+    sock.close()
+    if server.shared_embeddings is not None:
+        server.shared_embeddings.destroy()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
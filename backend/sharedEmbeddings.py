@@ -0,0 +1,213 @@
+"""
+Module to publish the arrays of the embedding store (normalized matrix, compact and reduced copies,
+index lists, neighbor graph) in shared memory, so all worker processes map one copy instead of
+keeping their own. Every publication is a new generation in its own segment, the workers attach
+to it read-only and switch over as soon as the control segment names a newer generation.
+
+Segments:
+    <prefix>_ctl: The current generation as uint64, 0 while nothing is published.
+    <prefix>_g<generation>: A header (magic, length of the JSON description, generation), the JSON
+        description of the arrays (dtype, shape, offset) and the store metadata, then the arrays.
+
+The previous generation is unlinked as soon as a new one is published. Workers that still map it
+keep their mapping until they switch, a worker that loses the race to attach it just retries with
+the newer generation.
+"""
+
+# Standard library imports
+import json
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, Optional
+
+# External library imports
+import numpy as np
+
+###########################################################################################
+
+MAGIC = b"EMBS"
+
+# Magic, length of the JSON description, generation
+HEADER = struct.Struct("<4sIQ")
+
+# Arrays start at multiples of this many bytes
+ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _open_segment(name: str, create: bool = False, size: int = 0) -> shared_memory.SharedMemory:
+    """
+    Opens a segment without leaving it to the resource tracker, which would unlink it as soon as
+    the first worker exits. SharedEmbeddings unlinks its segments itself.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:  # Python < 3.13
+        segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+        if os.name == "posix":
+            resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+def _unlink_segment(segment: shared_memory.SharedMemory):
+    """Counterpart of _open_segment, before Python 3.13 unlink also unregisters from the resource tracker."""
+    if os.name == "posix" and not hasattr(segment, "_track"):
+        resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+class SharedGeneration:
+    """
+    One attached generation.
+
+    Attributes:
+        generation: Number of the generation.
+        arrays: Read-only views of the published arrays.
+        metadata: The metadata published with the arrays.
+    """
+
+    def __init__(self, generation: int, segment: shared_memory.SharedMemory, arrays: Dict[str, np.ndarray],
+                 metadata: Dict[str, Any]):
+        self.generation = generation
+        self.segment = segment
+        self.arrays = arrays
+        self.metadata = metadata
+
+    @property
+    def nbytes(self) -> int:
+        return self.segment.size
+
+    def close(self) -> bool:
+        """Unmaps the segment, False while views of it are still in use somewhere."""
+        self.arrays = {}
+        try:
+            self.segment.close()
+        except BufferError:
+            return False
+        return True
+
+
+class SharedEmbeddings:
+    """Publishes and attaches generations of the embedding store under one name prefix."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._control: Optional[shared_memory.SharedMemory] = None
+        self._generation: Optional[np.ndarray] = None
+        self._current: Optional[SharedGeneration] = None
+        self._retired: List[SharedGeneration] = []
+
+    def _segment_name(self, generation: int) -> str:
+        return f"{self.prefix}_g{generation}"
+
+    def _control_array(self) -> np.ndarray:
+        if self._generation is None:
+            try:
+                self._control = _open_segment(f"{self.prefix}_ctl", create=True, size=8)
+                self._control.buf[:8] = bytes(8)
+            except FileExistsError:
+                self._control = _open_segment(f"{self.prefix}_ctl")
+            self._generation = np.ndarray((1,), dtype=np.uint64, buffer=self._control.buf)
+        return self._generation
+
+    def generation(self) -> int:
+        """The published generation, 0 if there is none."""
+        return int(self._control_array()[0])
+
+    def publish(self, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]) -> int:
+        """
+        Writes the arrays into a new generation and makes it the current one. Publishers have to be
+        serialized by the caller, e.g. by the catalog lock of the state backend.
+
+        Returns:
+            The number of the new generation.
+        """
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        layout = {}
+        size = 0
+        for name, array in arrays.items():
+            size = _align(size)
+            layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": size}
+            size += array.nbytes
+        description = json.dumps({"arrays": layout, "metadata": metadata}).encode()
+        data_start = _align(HEADER.size + len(description))
+
+        generation = self.generation() + 1
+        try:
+            segment = _open_segment(self._segment_name(generation), create=True, size=data_start + size)
+        except FileExistsError:
+            # Left behind by a publisher that died before switching to it
+            self.unlink(generation)
+            segment = _open_segment(self._segment_name(generation), create=True, size=data_start + size)
+        HEADER.pack_into(segment.buf, 0, MAGIC, len(description), generation)
+        segment.buf[HEADER.size:HEADER.size + len(description)] = description
+        for name, array in arrays.items():
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf,
+                              offset=data_start + layout[name]["offset"])
+            view[...] = array
+            del view
+        segment.close()
+
+        # The switch for all workers, the segment is complete before its number is visible
+        self._control_array()[0] = generation
+        if generation > 1:
+            self.unlink(generation - 1)
+        print(f"Published embeddings generation {generation}, {(data_start + size) / 2 ** 20:.1f} MiB.")
+        return generation
+
+    def attach(self) -> Optional[SharedGeneration]:
+        """
+        Attaches the current generation, None if nothing is published or the published generation
+        cannot be opened. The views of the previous generation stay valid until they are dropped.
+        """
+        for _ in range(3):
+            generation = self.generation()
+            if generation == 0:
+                return None
+            if self._current is not None and self._current.generation == generation:
+                return self._current
+            try:
+                segment = _open_segment(self._segment_name(generation))
+            except FileNotFoundError:
+                continue  # Replaced by a newer generation in the meantime
+            magic, description_length, segment_generation = HEADER.unpack_from(segment.buf, 0)
+            if magic != MAGIC or segment_generation != generation:
+                segment.close()
+                continue
+            description = json.loads(bytes(segment.buf[HEADER.size:HEADER.size + description_length]))
+            data_start = _align(HEADER.size + description_length)
+            arrays = {}
+            for name, spec in description["arrays"].items():
+                view = np.ndarray(tuple(spec["shape"]), dtype=np.dtype(spec["dtype"]), buffer=segment.buf,
+                                  offset=data_start + spec["offset"])
+                view.flags.writeable = False
+                arrays[name] = view
+
+            if self._current is not None:
+                self._retired.append(self._current)
+            self._retired = [retired for retired in self._retired if not retired.close()]
+            self._current = SharedGeneration(generation, segment, arrays, description["metadata"])
+            return self._current
+        return None
+
+    def unlink(self, generation: int):
+        """Removes the name of a generation, processes that mapped it keep their mapping."""
+        try:
+            segment = _open_segment(self._segment_name(generation))
+        except FileNotFoundError:
+            return
+        _unlink_segment(segment)
+        segment.close()
+
+    def destroy(self):
+        """Unlinks the current generation and the control segment, called once the server shuts down."""
+        generation = self.generation()
+        if generation:
+            self.unlink(generation)
+        self._generation = None
+        _unlink_segment(self._control)
+        self._control.close()
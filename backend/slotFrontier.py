@@ -0,0 +1,116 @@
+"""
+Module to keep track of which free slots of a collage touch placed images. Every slot knows how
+many of its neighbors are occupied, the counts are updated on each placement or removal by
+visiting the neighbors of the changed slot only. A max-heap by count with lazy deletion yields
+the free slot with the most placed neighbors in O(log n) instead of rescanning the grid.
+"""
+
+# Standard library imports
+import heapq
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+###########################################################################################
+
+Slot = Hashable
+
+
+class SlotFrontier:
+    """
+    Occupancy, placed-neighbor counts and the frontier of the slots of one collage.
+
+    Attributes:
+        neighbors: Neighbor slots of every slot, in the order they are probed.
+        occupied: Slots holding an image.
+        counts: Number of occupied neighbors per slot.
+        frontier: Free slots with at least one occupied neighbor.
+    """
+
+    def __init__(self, neighbors: Dict[Slot, List[Slot]], occupied: Iterable[Slot] = ()):
+        self.neighbors = neighbors
+        self.occupied: Set[Slot] = set(occupied) & set(neighbors)
+        self.counts: Dict[Slot, int] = {
+            slot: sum(1 for neighbor in slot_neighbors if neighbor in self.occupied)
+            for slot, slot_neighbors in neighbors.items()
+        }
+        self.frontier: Set[Slot] = {
+            slot for slot, count in self.counts.items() if count > 0 and slot not in self.occupied
+        }
+        self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        # Slots compare by position, so ties go to the first slot in row-major order
+        self._heap: List[Tuple[int, Slot]] = [
+            (-count, slot) for slot, count in self.counts.items() if slot not in self.occupied
+        ]
+        heapq.heapify(self._heap)
+
+    def _push(self, slot: Slot):
+        heapq.heappush(self._heap, (-self.counts[slot], slot))
+        # Stale entries pile up with every update, drop them once they dominate the heap
+        if len(self._heap) > 4 * len(self.counts) + 64:
+            self._rebuild_heap()
+
+    def __contains__(self, slot: Slot) -> bool:
+        return slot in self.counts
+
+    def is_free(self, slot: Slot) -> bool:
+        return slot in self.counts and slot not in self.occupied
+
+    def place(self, slot: Slot):
+        """Marks the slot as occupied, O(degree log n)."""
+        if slot not in self.counts or slot in self.occupied:
+            return
+        self.occupied.add(slot)
+        self.frontier.discard(slot)
+        for neighbor in self.neighbors[slot]:
+            self.counts[neighbor] += 1
+            if neighbor not in self.occupied:
+                self.frontier.add(neighbor)
+                self._push(neighbor)
+
+    def remove(self, slot: Slot):
+        """Marks the slot as free, O(degree log n)."""
+        if slot not in self.occupied:
+            return
+        self.occupied.discard(slot)
+        if self.counts[slot] > 0:
+            self.frontier.add(slot)
+        self._push(slot)
+        for neighbor in self.neighbors[slot]:
+            self.counts[neighbor] -= 1
+            if neighbor not in self.occupied:
+                if self.counts[neighbor] == 0:
+                    self.frontier.discard(neighbor)
+                self._push(neighbor)
+
+    def set_occupied(self, slot: Slot, occupied: bool):
+        if occupied:
+            self.place(slot)
+        else:
+            self.remove(slot)
+
+    def best_free_slot(self) -> Optional[Slot]:
+        """
+        Returns the free slot with the most occupied neighbors, None if every slot is occupied.
+        Entries that no longer match the slot's state are dropped on the way.
+        """
+        while self._heap:
+            negative_count, slot = self._heap[0]
+            if slot not in self.occupied and self.counts[slot] == -negative_count:
+                return slot
+            heapq.heappop(self._heap)
+        return None
+
+    def best_free_slots(self, count: int) -> List[Slot]:
+        """
+        Returns up to count frontier slots, the one best_free_slot would return first, then by
+        decreasing number of occupied neighbors. O(f log count) for f frontier slots.
+        """
+        return heapq.nsmallest(count, self.frontier, key=lambda slot: (-self.counts[slot], slot))
+
+    def free_neighbor(self, slot: Slot) -> Optional[Slot]:
+        """Returns the first free neighbor of the slot, None if there is none."""
+        for neighbor in self.neighbors.get(slot, ()):
+            if neighbor not in self.occupied:
+                return neighbor
+        return None
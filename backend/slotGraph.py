@@ -0,0 +1,163 @@
+"""
+Module for the adjacency of the slots of a collage template. The neighbors of all slots are stored
+as compressed sparse rows: the neighbors of slot i are neighbor_ids[offsets[i]:offsets[i + 1]],
+optionally with one weight per edge. Rectangular templates can use the 4-neighborhood of the grid,
+templates with offset rows (hexagon, star, fish) take their neighbors from the slot coordinates,
+where the grid built by group_elements_fixed_10x10 does not tell which slots actually touch.
+"""
+
+# Standard library imports
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+# External library imports
+import numpy as np
+
+###########################################################################################
+
+# Slots at most this many slot sizes apart along one axis can be neighbors
+GAP_TOLERANCE = 0.5
+
+# ... if they overlap by at least this many slot sizes along the other axis
+MIN_OVERLAP = 0.25
+
+# Rows of the pairwise distance matrix computed at once when building from coordinates
+DISTANCE_CHUNK = 1024
+
+
+class SlotGraph:
+    """
+    Undirected slot adjacency in CSR form.
+
+    Attributes:
+        positions: Key of every slot, e.g. its (row_index, col_index) in the grid.
+        index: Maps a key back to its slot id.
+        offsets: Start of the neighbors of every slot in neighbor_ids, shape (slots + 1,).
+        neighbor_ids: Neighbor slot ids of all slots, concatenated.
+        weights: Weight per entry of neighbor_ids, None if all edges weigh the same.
+    """
+
+    def __init__(self, positions: Sequence[Hashable], offsets: np.ndarray, neighbor_ids: np.ndarray,
+                 weights: Optional[np.ndarray] = None):
+        self.positions = list(positions)
+        self.index: Dict[Hashable, int] = {position: slot for slot, position in enumerate(self.positions)}
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.neighbor_ids = np.asarray(neighbor_ids, dtype=np.int32)
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, position: Hashable) -> bool:
+        return position in self.index
+
+    @classmethod
+    def from_lists(cls, positions: Sequence[Hashable], neighbor_lists: Sequence[Sequence[int]],
+                   weight_lists: Optional[Sequence[Sequence[float]]] = None) -> "SlotGraph":
+        """Builds the CSR arrays from one neighbor list (and weight list) per slot."""
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(neighbors) for neighbors in neighbor_lists])
+        neighbor_ids = np.fromiter((n for neighbors in neighbor_lists for n in neighbors), dtype=np.int32,
+                                   count=int(offsets[-1]))
+        weights = None
+        if weight_lists is not None:
+            weights = np.fromiter((w for slot_weights in weight_lists for w in slot_weights), dtype=np.float32,
+                                  count=int(offsets[-1]))
+        return cls(positions, offsets, neighbor_ids, weights)
+
+    @classmethod
+    def from_grid(cls, positions: Sequence[Tuple[int, int]]) -> "SlotGraph":
+        """
+        4-neighborhood of (row_index, col_index) positions. Neighbors are ordered top, bottom, left, right.
+        """
+        index = {position: slot for slot, position in enumerate(positions)}
+        neighbor_offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        neighbor_lists = [
+            [index[(row_idx + d_row, col_idx + d_col)] for d_row, d_col in neighbor_offsets
+             if (row_idx + d_row, col_idx + d_col) in index]
+            for row_idx, col_idx in positions
+        ]
+        return cls.from_lists(positions, neighbor_lists)
+
+    @classmethod
+    def from_coordinates(cls, positions: Sequence[Hashable], coordinates: Sequence[Tuple[float, float]],
+                         gap_tolerance: float = GAP_TOLERANCE, min_overlap: float = MIN_OVERLAP) -> "SlotGraph":
+        """
+        Neighborhood of square slots at the given (left, top) coordinates.
+
+        The slot size is estimated as the median distance of a slot to its nearest slot. Two slots are
+        neighbors if they are at most gap_tolerance slot sizes apart along one axis and overlap by at least
+        min_overlap slot sizes along the other one, so slots that only touch at a corner are not. The edge
+        weight is the overlap as a fraction of the slot size, e.g. 0.5 for half-offset rows. Every slot is
+        connected to at least its nearest slot, so scattered templates do not leave slots without neighbors.
+        Neighbors are ordered by weight, then distance, then top to bottom and left to right.
+        """
+        points = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        count = len(points)
+        neighbor_sets: List[Dict[int, Tuple[float, float]]] = [dict() for _ in range(count)]
+        if count > 1:
+            size = _slot_size(points)
+            for start in range(0, count, DISTANCE_CHUNK):
+                block = points[start:start + DISTANCE_CHUNK]
+                delta = np.abs(block[:, None, :] - points[None, :, :])
+                overlap = size - delta  # Overlap along x and y, negative values are gaps
+                weights = np.clip(overlap.max(axis=2) / size, 0.0, 1.0)
+                touching = (
+                    ((-overlap[:, :, 0] <= gap_tolerance * size) & (overlap[:, :, 1] >= min_overlap * size)) |
+                    ((-overlap[:, :, 1] <= gap_tolerance * size) & (overlap[:, :, 0] >= min_overlap * size))
+                )
+                distances = np.sqrt((delta ** 2).sum(axis=2))
+                own = (np.arange(len(block)), np.arange(start, start + len(block)))
+                touching[own] = False
+                distances[own] = np.inf
+                nearest = np.argmin(distances, axis=1)
+
+                for offset in range(len(block)):
+                    slot = start + offset
+                    close = np.flatnonzero(touching[offset]).tolist()
+                    if not close:
+                        close = [int(nearest[offset])]
+                    for neighbor in close:
+                        edge = (max(float(weights[offset, neighbor]), 1e-3), float(distances[offset, neighbor]))
+                        neighbor_sets[slot][neighbor] = edge
+                        neighbor_sets[neighbor][slot] = edge
+
+        neighbor_lists, weight_lists = [], []
+        for slot, neighbors in enumerate(neighbor_sets):
+            ordered = sorted(neighbors, key=lambda n: (-round(neighbors[n][0], 3), round(neighbors[n][1], 3),
+                                                       points[n][1], points[n][0]))
+            neighbor_lists.append(ordered)
+            weight_lists.append([neighbors[n][0] for n in ordered])
+        return cls.from_lists(positions, neighbor_lists, weight_lists)
+
+    def neighbors(self, slot: int) -> np.ndarray:
+        """Neighbor slot ids of the slot."""
+        return self.neighbor_ids[self.offsets[slot]:self.offsets[slot + 1]]
+
+    def neighbor_weights(self, slot: int) -> np.ndarray:
+        """Edge weights of the neighbors of the slot, all 1 for an unweighted graph."""
+        if self.weights is None:
+            return np.ones(self.offsets[slot + 1] - self.offsets[slot], dtype=np.float32)
+        return self.weights[self.offsets[slot]:self.offsets[slot + 1]]
+
+    def neighbor_positions(self, position: Hashable) -> List[Hashable]:
+        """Keys of the neighbors of the slot with the given key, empty for unknown keys."""
+        slot = self.index.get(position)
+        if slot is None:
+            return []
+        return [self.positions[neighbor] for neighbor in self.neighbors(slot)]
+
+    def adjacency_lists(self) -> List[List[int]]:
+        """Neighbor slot ids of every slot as plain lists."""
+        return [self.neighbors(slot).tolist() for slot in range(len(self))]
+
+
+def _slot_size(points: np.ndarray) -> float:
+    """Median distance of a slot to its nearest slot, 1 if all slots share one position."""
+    nearest = np.full(len(points), np.inf)
+    for start in range(0, len(points), DISTANCE_CHUNK):
+        block = points[start:start + DISTANCE_CHUNK]
+        distances = np.sqrt(((block[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+        distances[np.arange(len(block)), np.arange(start, start + len(block))] = np.inf
+        nearest[start:start + len(block)] = distances.min(axis=1)
+    size = float(np.median(nearest))
+    return size if size > 0 else 1.0
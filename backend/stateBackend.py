@@ -0,0 +1,297 @@
+"""
+Module for the state that has to be shared when several worker processes serve one deployment:
+the collages, the exclusion history of their slots and the catalog of uploaded images. Every
+worker keeps working copies of its collages in its own CollageStore, persists them through the
+backend after a change and picks up the changes other workers made before reading them. Writes
+are a compare-and-swap on the collage version, so two workers changing the same collage at once
+cannot overwrite each other. The catalog version tells a worker that another worker added images
+to the embedding files, so it has to reload its embedding store.
+
+MemoryStateBackend shares nothing, the CollageStore of the only worker is the state.
+SqliteStateBackend keeps everything in one SQLite database in WAL mode, so readers never block
+the writer and all workers on one machine can use it at the same time.
+"""
+
+# Standard library imports
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+###########################################################################################
+
+STATE_BACKENDS = ("memory", "sqlite")
+
+# How long a worker waits for the write lock of the database before giving up
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+
+class StateBackend(ABC):
+    """
+    Interface of the shared state.
+
+    A collage is passed as the dictionary built by CollageState.snapshot: its "version", the grid
+    as "data", "slot_coordinates", "ai_placed" and the per-slot "exclusions".
+
+    Attributes:
+        shared: Whether other worker processes see the state, False if only one worker may run.
+    """
+
+    shared = False
+
+    @abstractmethod
+    def load_collage(self, collage_id: str, newer_than: int = -1) -> Optional[Dict[str, Any]]:
+        """Returns the stored collage, None if there is none or its version is not above newer_than."""
+
+    @abstractmethod
+    def save_collage(self, collage_id: str, state: Dict[str, Any], expected_version: int) -> bool:
+        """
+        Stores the collage if the stored version still is expected_version. A collage that is not
+        stored yet is always written.
+
+        Returns:
+            False if another worker changed the collage in the meantime, nothing is written then.
+        """
+
+    @abstractmethod
+    def collage_version(self, collage_id: str) -> int:
+        """Version of the stored collage, 0 if there is none."""
+
+    @abstractmethod
+    def purge_collages(self, idle_s: float) -> int:
+        """Deletes the collages not changed for idle_s seconds, returns how many were deleted."""
+
+    @abstractmethod
+    def add_images(self, image_names: List[str]) -> int:
+        """Adds uploaded images to the catalog, returns the new catalog version."""
+
+    @abstractmethod
+    def image_names(self) -> List[str]:
+        """Names of all images in the catalog, in upload order."""
+
+    @abstractmethod
+    def catalog_version(self) -> int:
+        """Incremented on every change of the catalog."""
+
+    @abstractmethod
+    def catalog_lock(self) -> ContextManager[None]:
+        """Held while the embedding files are written, so only one worker appends to them at a time."""
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    State of a single worker. Collages are not copied anywhere, every write succeeds because the
+    lock of the collage already serializes the requests changing it.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._images: Dict[str, None] = {}
+        self._catalog_version = 0
+        self._lock = threading.Lock()
+
+    def load_collage(self, collage_id: str, newer_than: int = -1) -> Optional[Dict[str, Any]]:
+        return None
+
+    def save_collage(self, collage_id: str, state: Dict[str, Any], expected_version: int) -> bool:
+        return True
+
+    def collage_version(self, collage_id: str) -> int:
+        return 0
+
+    def purge_collages(self, idle_s: float) -> int:
+        return 0
+
+    def add_images(self, image_names: List[str]) -> int:
+        for name in image_names:
+            self._images[name] = None
+        self._catalog_version += 1
+        return self._catalog_version
+
+    def image_names(self) -> List[str]:
+        return list(self._images)
+
+    def catalog_version(self) -> int:
+        return self._catalog_version
+
+    @contextmanager
+    def catalog_lock(self) -> Iterator[None]:
+        with self._lock:
+            yield
+
+
+class SqliteStateBackend(StateBackend):
+    """
+    State in a SQLite database shared by all workers on one machine. Every thread gets its own
+    connection, writes run in BEGIN IMMEDIATE transactions so the version check and the write
+    cannot interleave with another worker.
+    """
+
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS collages (
+            collage_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS exclusions (
+            collage_id TEXT NOT NULL,
+            row_idx INTEGER NOT NULL,
+            col_idx INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            image_name TEXT NOT NULL,
+            PRIMARY KEY (collage_id, row_idx, col_idx, position)
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            name TEXT PRIMARY KEY,
+            added_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self._local = threading.local()
+        self._thread_lock = threading.Lock()
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        # A connection must not be used across fork, workers forked by serve.py open their own
+        if db is None or self._local.pid != os.getpid():
+            # Autocommit mode, transactions are started explicitly
+            db = sqlite3.connect(str(self.path), isolation_level=None, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def load_collage(self, collage_id: str, newer_than: int = -1) -> Optional[Dict[str, Any]]:
+        db = self._connection()
+        # One read transaction, so the exclusions belong to the same version as the collage
+        db.execute("BEGIN")
+        try:
+            row = db.execute("SELECT version, state FROM collages WHERE collage_id = ? AND version > ?",
+                             (collage_id, newer_than)).fetchone()
+            if row is None:
+                return None
+            exclusions: Dict[tuple, List[str]] = {}
+            for row_idx, col_idx, image_name in db.execute(
+                    "SELECT row_idx, col_idx, image_name FROM exclusions WHERE collage_id = ? "
+                    "ORDER BY row_idx, col_idx, position", (collage_id,)):
+                exclusions.setdefault((row_idx, col_idx), []).append(image_name)
+        finally:
+            db.execute("COMMIT")
+
+        state = json.loads(row[1])
+        state["version"] = row[0]
+        state["exclusions"] = [[row_idx, col_idx, names] for (row_idx, col_idx), names in exclusions.items()]
+        return state
+
+    def save_collage(self, collage_id: str, state: Dict[str, Any], expected_version: int) -> bool:
+        stored = {key: value for key, value in state.items() if key not in ("version", "exclusions")}
+        with self._transaction() as db:
+            row = db.execute("SELECT version FROM collages WHERE collage_id = ?", (collage_id,)).fetchone()
+            if row is not None and row[0] != expected_version:
+                return False
+            db.execute("INSERT OR REPLACE INTO collages (collage_id, version, state, updated_at) VALUES (?, ?, ?, ?)",
+                       (collage_id, state["version"], json.dumps(stored), time.time()))
+            db.execute("DELETE FROM exclusions WHERE collage_id = ?", (collage_id,))
+            db.executemany(
+                "INSERT INTO exclusions (collage_id, row_idx, col_idx, position, image_name) VALUES (?, ?, ?, ?, ?)",
+                [(collage_id, row_idx, col_idx, position, name)
+                 for row_idx, col_idx, names in state.get("exclusions", [])
+                 for position, name in enumerate(names)],
+            )
+        return True
+
+    def collage_version(self, collage_id: str) -> int:
+        row = self._connection().execute("SELECT version FROM collages WHERE collage_id = ?",
+                                         (collage_id,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def purge_collages(self, idle_s: float) -> int:
+        with self._transaction() as db:
+            deleted = db.execute("DELETE FROM collages WHERE updated_at < ?", (time.time() - idle_s,)).rowcount
+            db.execute("DELETE FROM exclusions WHERE collage_id NOT IN (SELECT collage_id FROM collages)")
+        return deleted
+
+    def add_images(self, image_names: List[str]) -> int:
+        now = time.time()
+        with self._transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO images (name, added_at) VALUES (?, ?)",
+                           [(name, now) for name in image_names])
+            db.execute("INSERT INTO meta (key, value) VALUES ('catalog_version', 1) "
+                       "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+            return db.execute("SELECT value FROM meta WHERE key = 'catalog_version'").fetchone()[0]
+
+    def image_names(self) -> List[str]:
+        return [name for name, in self._connection().execute("SELECT name FROM images ORDER BY added_at, rowid")]
+
+    def catalog_version(self) -> int:
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'catalog_version'").fetchone()
+        return row[0] if row is not None else 0
+
+    @contextmanager
+    def catalog_lock(self) -> Iterator[None]:
+        # The thread lock covers the threads of this worker, the file lock the other workers
+        with self._thread_lock, open(self.lock_path, "a+b") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                import msvcrt
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def create_state_backend(name: str, path: Path) -> StateBackend:
+    """
+    Creates the backend with the given name.
+
+    Parameters:
+        name (str): One of STATE_BACKENDS.
+        path (Path): Database file of the sqlite backend.
+    """
+    if name == "memory":
+        return MemoryStateBackend()
+    if name == "sqlite":
+        return SqliteStateBackend(path)
+    raise ValueError(f"Unknown state backend '{name}', expected one of {STATE_BACKENDS}.")
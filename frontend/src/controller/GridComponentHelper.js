@@ -66,6 +66,7 @@ export async function newSelection(componentName, target_id) {
   try {
     const response = await fetch(`${store.apiUrl}/new_selection`, {
       method: "POST",
+      headers: { "X-Session-Id": store.sessionId },
       body: formData,
     });
 
@@ -73,12 +74,56 @@ export async function newSelection(componentName, target_id) {
       throw new Error(`Failed to send information. Status: ${response.status}`);
     }
 
-    await response.json();
+    const data = await response.json();
+    if (data.version !== undefined) {
+      store.componentVersions[componentName] = data.version;
+    }
   } catch (error) {
     console.error("Error sending information to the backend:", error);
   }
 }
 
+/**
+ * Sends only the changed cell to the backend instead of the whole grid.
+ * Falls back to false if the backend does not know the grid yet or it changed in the meantime,
+ * the caller then has to resend the whole grid via extractGridPositions.
+ * @param {String} componentName - Name of the component the cell belongs to.
+ * @param {Number} cellId - Id (index) of the changed cell.
+ * @param {String|null} fileName - File name placed in the cell, null if the cell was cleared.
+ * @param {String} userPrompt - User prompt to send to the backend.
+ * @returns {Promise<Boolean>} - Whether the backend accepted the update.
+ */
+export async function updateCell(componentName, cellId, fileName, userPrompt) {
+  const version = store.componentVersions[componentName];
+  if (version === undefined) {
+    return false;
+  }
+
+  try {
+    const response = await fetch(`${store.apiUrl}/components/${componentName}/cells/${cellId}`, {
+      method: "PATCH",
+      headers: { "Content-Type": "application/json", "X-Session-Id": store.sessionId },
+      body: JSON.stringify({ fileName: fileName, version: version, user_prompt: userPrompt }),
+    });
+
+    if (response.status === 404 || response.status === 409) {
+      delete store.componentVersions[componentName];
+      return false;
+    }
+    if (!response.ok) {
+      throw new Error(`Failed to update cell. Status: ${response.status}`);
+    }
+
+    const data = await response.json();
+    store.componentVersions[componentName] = data.version;
+    return true;
+  } catch (error) {
+    console.error("Error updating cell:", error);
+    delete store.componentVersions[componentName];
+    return false;
+  }
+}
+
 /**
  * Extracts grid positions of items inside a container.
  * @param {HTMLElement} gridContainer - The container element of the grid.
@@ -119,6 +164,7 @@ export async function extractGridPositions(gridContainer, gridItems, items, comp
   try {
     const response = await fetch(`${store.apiUrl}/positions`, {
       method: "POST",
+      headers: { "X-Session-Id": store.sessionId },
       body: formData,
     });
 
@@ -126,7 +172,8 @@ export async function extractGridPositions(gridContainer, gridItems, items, comp
       throw new Error(`Failed to send grid positions. Status: ${response.status}`);
     }
 
-    await response.json();
+    const data = await response.json();
+    store.componentVersions[componentName] = data.version;
   } catch (error) {
     console.error("Error sending grid positions to the backend:", error);
   }
@@ -142,6 +189,7 @@ export async function clearCollage(componentName) {
   try {
     const response = await fetch(`${store.apiUrl}/clearCollage`, {
       method: "POST",
+      headers: { "X-Session-Id": store.sessionId },
       body: formData,
     });
 
@@ -58,6 +58,7 @@ export async function fetchAndStoreComponentData(componentName, items) {
       params: { component_name: componentName },
       headers: {
         'Content-Type': 'application/json',
+        'X-Session-Id': store.sessionId,
       },
     });
 
@@ -90,4 +91,48 @@ export async function fetchAndStoreComponentData(componentName, items) {
   }
 }
 
+/**
+ * Subscribes to the cells the backend changes in a component and updates only those items,
+ * instead of refetching the whole grid after every interaction.
+ * @param {String} componentName - Name of the component to subscribe to.
+ * @param {Array} items - Array of items to update.
+ * @returns {WebSocket} - The socket, to be closed when the component is unmounted.
+ */
+export function subscribeToComponentUpdates(componentName, items) {
+  const socket = new WebSocket(
+    `${store.apiUrl.replace(/^http/, 'ws')}/ws/components/${componentName}?session_id=${encodeURIComponent(store.sessionId)}`
+  );
 
+  socket.onmessage = async (event) => {
+    const update = JSON.parse(event.data);
+    if (store.componentVersions[componentName] !== undefined && store.componentVersions[componentName] < update.version) {
+      store.componentVersions[componentName] = update.version;
+    }
+
+    for (const cell of update.cells) {
+      if (cell.id >= items.length) {
+        continue;
+      }
+
+      let imageUrl = null;
+      if (cell.thumbnailUrl) {
+        try {
+          imageUrl = await scaleImage(`${store.apiUrl}${cell.thumbnailUrl}`);
+        } catch (error) {
+          console.error(`Failed to load thumbnail for ${cell.fileName}:`, error);
+        }
+      }
+
+      items[cell.id] = {
+        src: imageUrl,
+        fileName: cell.fileName,
+      };
+    }
+  };
+
+  socket.onerror = (error) => {
+    console.error(`WebSocket error for ${componentName}:`, error);
+  };
+
+  return socket;
+}
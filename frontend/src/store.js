@@ -1,8 +1,23 @@
 import { reactive } from 'vue';
 
+/**
+ * Id of this browser tab, so the backend keeps a separate collage per session.
+ * Survives reloads of the tab, a new tab starts a new session.
+ */
+function getSessionId() {
+    let sessionId = sessionStorage.getItem('sessionId');
+    if (!sessionId) {
+        sessionId = crypto.randomUUID();
+        sessionStorage.setItem('sessionId', sessionId);
+    }
+    return sessionId;
+}
+
 export const store = reactive({
     photoUrls: [],
     photoBlobs: [],
     galleryBlobs: [],
+    componentVersions: {},
+    sessionId: getSessionId(),
     apiUrl: 'http://localhost:8000'
 });